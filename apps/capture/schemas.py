@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/24 14:00
+# @Author  : Heshouyi
+# @File    : schemas.py
+# @Software: PyCharm
+# @description:
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel, conint, field_validator
+
+from core.packet_capture import RECEIVED, SENT
+
+
+# 枚举类
+class CaptureDirection(Enum):
+    """收发方向"""
+    SENT = "sent"
+    RECEIVED = "received"
+
+
+# 数据模型
+class CaptureQueryModel(BaseModel):
+    """抓包查询数据模型，时间为Unix时间戳（秒），各条件为空时不过滤"""
+    device: Optional[str] = None
+    startTime: Optional[float] = None
+    endTime: Optional[float] = None
+    direction: Optional[CaptureDirection] = None
+    limit: conint(ge=1, le=100000) = 100
+
+    @field_validator("direction")
+    @classmethod
+    def transform_direction(cls, v: Optional[CaptureDirection]):
+        """转换收发方向为抓包记录中的取值"""
+        if v is None:
+            return None
+        return SENT if v == CaptureDirection.SENT else RECEIVED
+
+
+if __name__ == '__main__':
+    pass
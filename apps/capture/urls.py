@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/24 14:00
+# @Author  : Heshouyi
+# @File    : urls.py
+# @Software: PyCharm
+# @description: 二进制抓包的状态、查询和pcapng导出接口
+
+from fastapi import APIRouter
+from fastapi.responses import Response
+from core.packet_capture import DIRECTIONS, packet_capture
+from core.util import handle_exceptions, return_success_response
+from .schemas import CaptureQueryModel
+
+# 创建路由
+capture_router = APIRouter()
+
+
+# API 路由
+@capture_router.get("/status", summary="查询抓包状态")
+@handle_exceptions(model_name="抓包相关接口")
+def get_status():
+    """返回是否开启抓包，以及主进程和各工作进程抓包文件的记录数、保留的记录数和时间范围"""
+    return return_success_response(data={"enabled": packet_capture.enabled, "directory": packet_capture.directory,
+                                         "processes": packet_capture.get_status()})
+
+
+@capture_router.post("/query", summary="查询抓包记录")
+@handle_exceptions(model_name="抓包相关接口")
+def query_records(data: CaptureQueryModel):
+    """
+    按设备（源IP）、时间范围和收发方向查询抓包记录，按时间排序，超过limit时返回最近的limit条
+    载荷以十六进制字符串返回
+    """
+    records = packet_capture.query(data.device, data.startTime, data.endTime, data.direction, data.limit)
+    result = [
+        {"time": timestamp, "process": process, "device": device, "direction": DIRECTIONS[direction],
+         "length": len(payload), "payload": payload.hex()}
+        for timestamp, process, device, direction, payload in records
+    ]
+    return return_success_response(data=result)
+
+
+@capture_router.post("/export", summary="导出抓包记录为pcapng", response_class=Response)
+@handle_exceptions(model_name="抓包相关接口")
+def export_records(data: CaptureQueryModel):
+    """
+    按与查询相同的条件导出pcapng文件，每个设备为一个接口，收发方向记录在包的方向标记中
+    链路类型为USER0，Wireshark中可用自定义解析器或按字节查看
+    """
+    records = packet_capture.query(data.device, data.startTime, data.endTime, data.direction, data.limit)
+    return Response(packet_capture.export_pcapng(records), media_type="application/octet-stream",
+                    headers={"Content-Disposition": "attachment; filename=capture.pcapng"})
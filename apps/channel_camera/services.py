@@ -7,9 +7,14 @@
 # @description:
 
 import threading
-from core.connections.tcp_connection import TCPClient
+import time
+from core.connections.event_loop import PeriodicTask
+from core.connections.tcp_connection import FrameSplitter, TCPClient, peek_command_code
+from core.heartbeat_monitor import heartbeat_monitor
+from core.report_correlation import CHANNEL_EVENT, PLATE, report_correlation
+from core.telemetry import DECODE_ERRORS_TOTAL, telemetry
 from .protocols import ChannelCameraModel
-from core.logger import logger
+from core.logger import logger, packet_log
 
 
 class ChannelCameraService:
@@ -22,11 +27,14 @@ class ChannelCameraService:
         self.local_ip = local_ip  # 用于连接服务器的设备IP
         self.is_reporting = False  # 是否正在上报数据
         self.heartbeat_interval = 30  # 心跳间隔时间，单位为秒
-        self.timer = None  # 用于定时发送心跳包的定时器
+        self.heartbeat_task = PeriodicTask(self.heartbeat_interval, self.send_heartbeat, blocking=True)  # 定时心跳
         self.register_confirmation_event = (
             threading.Event()
         )  # 线程事件对象，用于注册时阻塞发送进程，等待服务器返回确认信息
         self.channel_camera_model = ChannelCameraModel()  # 通道相机数据模型实例
+        self.client.placement_key = device_id   # 多台通道相机可共用源IP，按设备编号分配目标服务器
+        self.client.set_telemetry(telemetry.device("channel_camera", device_id), peek_command_code)
+        self.heartbeat_tracker = heartbeat_monitor.tracker("channel_camera")    # 按时间戳匹配心跳和返回，统计往返时延和丢失
 
     def connect(self):
         status = self.client.is_connected()
@@ -37,10 +45,14 @@ class ChannelCameraService:
             # 设置接收数据和断开连接的回调函数
             self.client.set_receive_callback(self.handle_received_data)
             self.client.set_disconnect_callback(self.disconnect)
+            self.client.set_reconnect_callback(self.restore_session)
+            # 服务器连续下发的多个包可能在一次recv中到达，按协议头尾切分后逐包处理
+            self.client.set_frame_splitter(FrameSplitter(self.channel_camera_model.PROTOCOL_HEAD, self.channel_camera_model.PROTOCOL_TAIL))
             # 连接服务器
             self.client.connect(self.server_ip, self.server_port, self.local_ip)
             # 连接后发送注册包
             self.send_register_packet()
+            self.client.resume_outbox()
             # 注册后开始持续心跳
             self.start_heartbeat()
             # 设置接收数据和断开连接的回调函数
@@ -55,9 +67,10 @@ class ChannelCameraService:
             packet = self.channel_camera_model.create_register_packet(
                 self.device_id, self.device_version
             )
+            self.register_confirmation_event.clear()  # 发送前设置事件为未触发状态，避免确认包先于clear到达
+            send_time = time.perf_counter()
             self.client.send_data(packet, need_log=False)
             # 阻塞等待服务器返回注册确认包
-            self.register_confirmation_event.clear()  # 设置事件为未触发状态
             if not self.register_confirmation_event.wait(
                 timeout=5
             ):  # 等待事件被触发，超时时间为5秒
@@ -65,13 +78,28 @@ class ChannelCameraService:
                 raise Exception(
                     "通道相机5秒内没有接收到服务器返回的注册确认包，注册失败"
                 )
+            latency = time.perf_counter() - send_time
+            self.client.metrics.record_ack(latency)    # 注册确认的等待时间计入确认时延
+            self.client.telemetry.observe_ack("register", latency)
         except Exception as e:
             raise e
 
+    def restore_session(self):
+        """断线自动重连成功后恢复会话：重新注册，断线前在运行的心跳按原间隔重新开始"""
+        self.heartbeat_tracker.reset()     # 断线前未返回的心跳不会再有返回，不计为丢失
+        self.send_register_packet()
+        self.client.resume_outbox()    # 补发断线期间缓存的事件
+        if self.is_reporting:
+            self.stop_heartbeat()
+            self.start_heartbeat()
+        logger.info(f"通道相机{self.local_ip}重连后重新注册成功")
+
     def start_heartbeat(self):
         try:
             self.is_reporting = True
-            self.schedule_next_heartbeat()
+            self.heartbeat_task.interval = self.heartbeat_interval
+            self.client.metrics.set_heartbeat_interval(self.heartbeat_interval)
+            self.heartbeat_task.start()     # 立即发送一次，之后按间隔发送
             logger.debug("通道相机定时心跳开始")
         except Exception as e:
             raise e
@@ -79,23 +107,21 @@ class ChannelCameraService:
     def stop_heartbeat(self):
         try:
             self.is_reporting = False
-            if self.timer:
-                self.timer.cancel()
-                self.timer = None
-                logger.debug("通道相机定时心跳停止")
+            self.heartbeat_task.cancel()
+            self.client.metrics.set_heartbeat_interval(0)
+            logger.debug("通道相机定时心跳停止")
         except Exception as e:
             raise e
 
-    def schedule_next_heartbeat(self):
+    def send_heartbeat(self):
+        """发送一次心跳，由共用事件循环上的定时任务调用"""
         if self.is_reporting:
             heartbeat_packet = self.channel_camera_model.create_heartbeat_packet(
                 self.device_id
             )
+            if self.client.is_connected():    # 未连接时心跳发不出去，不会有返回，不登记，避免记为丢失
+                self.heartbeat_tracker.sent(None)     # 心跳返回不回显cmdTime，按发送顺序匹配
             self.client.send_data(heartbeat_packet, need_log=False)
-            self.timer = threading.Timer(
-                self.heartbeat_interval, self.schedule_next_heartbeat
-            )
-            self.timer.start()
 
     def send_command(self, command_data: dict, command_code="T"):
         """
@@ -106,29 +132,44 @@ class ChannelCameraService:
         """
         try:
             # 根据协议和数据体构造包
-            logger.info(f"xxx{command_data}")
+            if packet_log.sample(self.local_ip):
+                logger.info("通道相机发送指令: {}", command_data)
             packet = self.channel_camera_model.construct_packet(
                 command_data, command_code
             )
 
-            self.client.send_data(packet)
+            self.client.send_event(packet)
+            if command_data.get("eventId"):     # 来去车等事件，等待平台上报，统计端到端时延
+                keys = [(CHANNEL_EVENT, command_data["eventId"])]
+                if command_data.get("plate"):
+                    keys.append((PLATE, command_data["plate"]))
+                report_correlation.record(*keys)
         except Exception as e:
             raise e
 
     def handle_received_data(self, data):
         """接收到服务器数据时的处理函数"""
-        logger.debug(f"通道相机收到来自服务器的数据，开始解包 {data}")
+        sampled = packet_log.sample(self.local_ip)
+        if sampled:
+            logger.debug("通道相机收到来自服务器的数据，开始解包 {}", data)
         # 根据数据内容进行处理
         try:
             parsed_data = self.channel_camera_model.deconstruct_packet(data)
+            self.client.telemetry.frame_received(parsed_data.get("command_code"), len(data))
             if "heartbeatResult" in str(parsed_data):
-                logger.debug(f"通道相机收到服务器的心跳返回：{parsed_data}")
+                if sampled:
+                    logger.debug("通道相机收到服务器的心跳返回：{}", parsed_data)
+                self.client.metrics.record_heartbeat()
+                rtt = self.heartbeat_tracker.replied()
+                if rtt is not None:
+                    self.client.telemetry.observe_ack("heartbeat", rtt)
             elif "cameraLoginResult" in str(parsed_data):
-                logger.debug(f"通道相机收到服务器注册结果：{parsed_data}")
+                logger.debug("通道相机收到服务器注册结果：{}", parsed_data)
                 self.register_confirmation_event.set()  # 触发事件解除等待状态
             else:
-                logger.info(f"通道相机收到服务器下发数据，解包结果: {parsed_data}")
+                logger.info("通道相机收到服务器下发数据，解包结果: {}", parsed_data)
         except Exception as e:
+            self.client.count_error(DECODE_ERRORS_TOTAL)
             logger.exception(f"通道相机解析服务器下发数据失败: {e}")
 
     def disconnect(self):
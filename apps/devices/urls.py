@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/27 10:00
+# @Author  : Heshouyi
+# @File    : urls.py
+# @Software: PyCharm
+# @description: 按设备查询收发和连接状态的时间序列
+
+from typing import Optional
+from fastapi import APIRouter
+from core.device_timeseries import device_timeseries
+from core.util import handle_exceptions, return_success_response
+
+# 创建路由
+devices_router = APIRouter()
+
+
+# API 路由
+@devices_router.get("", summary="查询记录时间序列的设备")
+@handle_exceptions(model_name="设备时间序列相关接口")
+def get_devices():
+    """
+    返回时间序列的开关、保留时长、每台设备占用的内存和所有设备标识
+    单台设备以设备名称标识，如 parking_camera；批量设备（需开启device_timeseries.fleet）以设备类型和序号标识，如 parking_camera-3
+    """
+    return return_success_response(data=device_timeseries.get_status())
+
+
+@devices_router.get("/{device_id}/timeseries", summary="查询设备时间序列")
+@handle_exceptions(model_name="设备时间序列相关接口")
+def get_timeseries(device_id: str, since: Optional[float] = None):
+    """
+    返回一台设备每秒/每分钟的发送帧数、接收帧数、发送字节数、接收字节数、错误数，
+    按秒的部分附带每秒末的连接状态（0未连接 1已连接 2已注册），按分钟的部分附带该分钟内处于连接状态的秒数
+    最近一小时左右按秒返回，更早的按分钟返回，since为秒级时间戳，只返回该时间之后的数据
+    """
+    return return_success_response(data=device_timeseries.query(device_id, since))
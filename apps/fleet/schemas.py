@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/21 11:00
+# @Author  : Heshouyi
+# @File    : schemas.py
+# @Software: PyCharm
+# @description:
+from enum import Enum
+
+from pydantic import BaseModel, conint, field_validator
+
+
+# 枚举类
+class FleetDeviceType(Enum):
+    """批量设备类型，与配置文件fleet节点下的设备类型一致"""
+    CHANNEL_CAMERA = "channel_camera"
+    PARKING_CAMERA = "parking_camera"
+    LORA_NODE = "lora_node"
+    FOUR_BYTES_NODE = "four_bytes_node"
+    NETWORK_LED = "network_led"
+    NETWORK_LCD = "network_lcd"
+
+
+class FleetStatusState(Enum):
+    """批量设备状态过滤条件，connected包含已注册的设备"""
+    DISCONNECTED = "disconnected"
+    CONNECTED = "connected"
+    REGISTERED = "registered"
+    HEARTBEATING = "heartbeating"
+
+
+class FleetStatusFormat(Enum):
+    """批量设备状态的输出格式"""
+    JSON = "json"
+    BINARY = "binary"
+
+
+# 数据模型
+class FleetCommandModel(BaseModel):
+    """批量设备指令数据模型，params为设备服务方法的关键字参数"""
+    deviceType: FleetDeviceType
+    index: conint(ge=1)
+    command: str
+    params: dict = {}
+
+    @field_validator("deviceType")
+    @classmethod
+    def transform_device_type(cls, v: FleetDeviceType):
+        """转换字段成员对象为真实值，方便后续使用"""
+        return v.value
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/21 11:00
+# @Author  : Heshouyi
+# @File    : urls.py
+# @Software: PyCharm
+# @description: 批量设备的指令转发和工作进程状态接口
+
+from typing import List, Optional
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import Response
+from core.logger import logger
+from .schemas import FleetCommandModel, FleetDeviceType, FleetStatusFormat, FleetStatusState
+from core.device_manager import DeviceManager
+from core.util import handle_exceptions, return_success_response
+
+# 创建路由
+fleet_router = APIRouter()
+
+
+# API 路由
+@fleet_router.post("/command", summary="向批量设备发送指令")
+@handle_exceptions(model_name="批量设备相关接口")
+def execute_command(data: FleetCommandModel):
+    """
+    对一台批量设备执行指令，如 start_heartbeat、send_parking_status，params为指令的参数
+    设备在工作进程中时指令经管道转发到所在进程执行，在线程池中阻塞等待执行结果，多个指令可并发执行
+    """
+    result = DeviceManager.execute_fleet_command(data.deviceType, data.index, data.command, data.params)
+    logger.info(f"批量设备{data.deviceType}第{data.index}台成功执行指令{data.command}")
+    return return_success_response(message=f"成功执行指令{data.command}", data=result)
+
+
+@fleet_router.get("/workers", summary="查询工作进程状态")
+@handle_exceptions(model_name="批量设备相关接口")
+def get_workers():
+    """查询批量设备各工作进程的存活状态、设备数和等待返回的指令数，批量设备未分片时返回空列表"""
+    supervisor = DeviceManager.fleet_supervisor
+    return return_success_response(data=supervisor.get_stats() if supervisor else [])
+
+
+@fleet_router.get("/agents", summary="查询集群代理状态")
+@handle_exceptions(model_name="批量设备相关接口")
+def get_agents():
+    """本机作为集群协调器时，查询在线代理领取的分片、设备数、源IP缺口和最近一次上报距今的秒数，否则返回空列表"""
+    coordinator = DeviceManager.cluster_coordinator
+    return return_success_response(data=coordinator.get_stats() if coordinator else [])
+
+
+@fleet_router.get("/metrics", summary="查询批量设备收发统计")
+@handle_exceptions(model_name="批量设备相关接口")
+def get_metrics():
+    """
+    查询每台批量设备和每种设备类型的收发包数、字节数、重连次数、确认时延和队列深度
+    直接读取工作进程写入的共享内存计数表，不向工作进程发送请求
+    """
+    return return_success_response(data=DeviceManager.get_fleet_metrics())
+
+
+@fleet_router.get("/status", summary="查询批量设备状态")
+@handle_exceptions(model_name="批量设备相关接口")
+def get_status(deviceType: Optional[List[FleetDeviceType]] = Query(None), state: Optional[FleetStatusState] = None,
+               ipRange: Optional[str] = None,
+               outputFormat: FleetStatusFormat = Query(FleetStatusFormat.JSON, alias="format"),
+               useGzip: bool = Query(False, alias="gzip")):
+    """
+    返回每台批量设备的连接状态（0未连接 1已连接 2已注册）、是否在按时心跳、最近接收/发送/心跳时间（毫秒级时间戳，0表示从未发生）和错误数
+    按列输出，设备类型按deviceTypes字典编码；可按设备类型（可多个）、状态（disconnected/connected/registered/heartbeating，
+    connected包含已注册的设备）和源IP范围（网段或起止地址，如192.168.30.0/24、192.168.30.10-192.168.30.99）过滤
+    connectPending为启动后尚未完成首次连接的设备数，设备在后台并发连接，降为0前连接状态为0的设备可能仍在连接中
+    format为binary时输出列描述JSON和各列的原始字节，gzip为true时压缩后返回，大批量设备时可显著减小响应
+    IP范围格式错误或设备类型不在当前批量设备中时返回400
+    """
+    device_types = [device_type.value for device_type in deviceType] if deviceType else None
+    try:
+        body = DeviceManager.get_fleet_status(device_types, state.value if state else None, ipRange,
+                                              outputFormat.value, useGzip)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"查询条件不合法: {e}")
+    headers = {"Content-Encoding": "gzip"} if useGzip else None
+    media_type = "application/octet-stream" if outputFormat == FleetStatusFormat.BINARY else "application/json"
+    return Response(content=body, media_type=media_type, headers=headers)
@@ -6,21 +6,25 @@
 # @Software: PyCharm
 # @description:
 
-import threading
+from core.connections.event_loop import PeriodicTask
 from core.connections.tcp_connection import TCPClient
+from core.report_correlation import LORA_STATUS, report_correlation
 from .protocols import LoraNodeModel
-from core.logger import logger
+from core.logger import logger, packet_log
+from core.telemetry import telemetry
 
 
 class LoraNodeService:
 
     def __init__(self, server_ip, server_port, local_ip):
         self.client = TCPClient()  # TCP客户端连接
+        self.client.set_telemetry(telemetry.device("lora_node", local_ip))    # 节点上报包没有命令码
         self.server_ip = server_ip  # 服务器IP
         self.server_port = server_port  # 服务器端口
         self.local_ip = local_ip  # 用于连接服务器的设备IP
         self.is_reporting = False  # 是否正在上报数据
-        self.timer = None       # 用于持续发送探测器状态的定时器
+        self.report_task = PeriodicTask(0, self.send_scheduled_report, blocking=True)     # 持续上报探测器状态的定时任务
+        self.report_args = None     # 持续上报的参数，断线恢复后按原参数继续上报
         self.lora_node_model = LoraNodeModel()  # Lora节点数据模型实例
 
     def connect(self):
@@ -29,10 +33,19 @@ class LoraNodeService:
             if status:
                 logger.debug(f"Lora节点尝试连接服务器时，已有连接，断开后重连")
                 self.client.disconnect()
+            self.client.set_reconnect_callback(self.restore_session)
             self.client.connect(self.server_ip, self.server_port, self.local_ip)
+            self.client.resume_outbox()    # 节点连接后无需注册，会话直接就绪
         except Exception as e:
             raise e
 
+    def restore_session(self):
+        """断线自动重连成功后恢复会话，先补发断线期间缓存的上报，断线前在运行的持续上报按原参数重新开始"""
+        self.client.resume_outbox()
+        if self.is_reporting:
+            self.start_reporting(*self.report_args)
+        logger.info(f"Lora节点{self.local_ip}重连成功")
+
     def disconnect(self):
         try:
             self.stop_reporting()   # 停止持续上报
@@ -50,8 +63,11 @@ class LoraNodeService:
         """
         try:
             packet = self.lora_node_model.construct_status_report_packet(sensor_addr, sensor_status, fault_details)
-            logger.debug(f"Lora节点发送数据: {packet}")
-            self.client.send_data(packet)
+            if packet_log.sample(self.local_ip):
+                logger.debug("Lora节点发送数据: {}", packet)
+            # 断线期间存入缓冲区，同一探测器只保留最新状态，重连后补发
+            self.client.send_event(packet, key=f"sensor:{sensor_addr}")
+            report_correlation.record((LORA_STATUS, sensor_addr))   # 等待平台上报，统计端到端时延
         except Exception as e:
             raise e
 
@@ -64,7 +80,9 @@ class LoraNodeService:
                 self.stop_reporting()
             # 启动定时器
             self.is_reporting = True
-            self.schedule_next_report(sensor_addr, sensor_status, fault_details, report_interval)
+            self.report_args = (sensor_addr, sensor_status, fault_details, report_interval)
+            self.report_task.interval = report_interval
+            self.report_task.start()
         except Exception as e:
             raise e
 
@@ -72,25 +90,16 @@ class LoraNodeService:
         """停止持续上报"""
         try:
             self.is_reporting = False
-            if self.timer:
-                self.timer.cancel()
-                self.timer = None
+            self.report_task.cancel()
         except Exception as e:
             raise e
 
-    def schedule_next_report(self, sensor_addr, sensor_status, fault_details, report_interval):
-        """调度下一次上报"""
+    def send_scheduled_report(self):
+        """执行一次定时上报，由共用事件循环上的定时任务调用"""
         if self.is_reporting:
+            sensor_addr, sensor_status, fault_details, _ = self.report_args
             try:
                 # 执行上报逻辑
                 self.report_status(sensor_addr, sensor_status, fault_details)
             except Exception as e:
                 logger.exception(f"Lora节点上报失败: {e}")
-
-            # 调度下一次上报
-            self.timer = threading.Timer(
-                report_interval,
-                self.schedule_next_report,
-                args=[sensor_addr, sensor_status, fault_details, report_interval]
-            )
-            self.timer.start()
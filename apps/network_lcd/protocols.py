@@ -23,6 +23,18 @@ class NetworkLcdModel:
         }
         return packet
 
+    @staticmethod
+    def peek_command_code(message: str) -> str:
+        """
+        取上行消息的cmd字段，用于按命令码统计，不完整解析JSON
+        指令响应包没有cmd字段，记为response
+        """
+        start = message.find('"cmd": "')
+        if start < 0:
+            return "response"
+        start += len('"cmd": "')
+        return message[start:message.find('"', start)]
+
     @ staticmethod
     def create_command_response_packet(reqid):
         """
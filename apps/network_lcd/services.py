@@ -6,10 +6,11 @@
 # @Software: PyCharm
 # @description:
 import json
-import threading
+from core.connections.event_loop import PeriodicTask
 from core.connections.websocket_connection import WebSocketClient
+from core.telemetry import DECODE_ERRORS_TOTAL, telemetry
 from .protocols import NetworkLcdModel
-from core.logger import logger
+from core.logger import logger, packet_log
 from core.file_path import db_path
 from ..models import DeviceMessageModel
 
@@ -18,13 +19,14 @@ class NetworkLcdService:
 
     def __init__(self, server_ip, server_port, local_ip, server_url):
         self.client = WebSocketClient()  # TCP连接客户端
+        self.client.set_telemetry(telemetry.device("network_lcd", local_ip), NetworkLcdModel.peek_command_code)
         self.server_ip = server_ip      # 服务器IP地址
         self.server_port = server_port  # 服务器端口
         self.local_ip = local_ip    # 用于连接服务器的设备IP
         self.server_url = server_url    # 服务器websocket地址
         self.is_reporting = False  # 是否正在上报数据
         self.heartbeat_interval = 5  # 心跳间隔时间，单位为秒
-        self.timer = None       # 用于定时发送心跳包的定时器
+        self.heartbeat_task = PeriodicTask(self.heartbeat_interval, self.send_heartbeat)  # 共用事件循环上的定时心跳
         self.network_lcd_model = NetworkLcdModel()  # LCD一体屏数据模型实例
 
     def connect(self):
@@ -36,6 +38,7 @@ class NetworkLcdService:
             # 设置接收数据和断开连接的回调函数
             self.client.set_receive_callback(self.handle_received_data)
             self.client.set_disconnect_callback(self.disconnect)
+            self.client.set_reconnect_callback(self.restore_session)
             # 连接服务器
             self.client.connect(self.server_url, self.server_ip, self.server_port, self.local_ip)
             # 启动心跳
@@ -43,10 +46,18 @@ class NetworkLcdService:
         except Exception as e:
             raise e
 
+    def restore_session(self):
+        """断线自动重连成功后恢复会话，断线前在运行的心跳按原间隔重新开始"""
+        if self.is_reporting:
+            self.start_heartbeat()
+        logger.info(f"LCD一体屏{self.local_ip}重连成功")
+
     def start_heartbeat(self):
         try:
             self.is_reporting = True
-            self.schedule_next_heartbeat()
+            self.heartbeat_task.interval = self.heartbeat_interval
+            self.client.metrics.set_heartbeat_interval(self.heartbeat_interval)
+            self.heartbeat_task.start()     # 立即发送一次，之后按间隔发送
             logger.debug("LCD一体屏定时心跳开始")
         except Exception as e:
             raise e
@@ -54,31 +65,32 @@ class NetworkLcdService:
     def stop_heartbeat(self):
         try:
             self.is_reporting = False
-            if self.timer:
-                self.timer.cancel()
-                self.timer = None
-                logger.debug("LCD一体屏定时心跳停止")
+            self.heartbeat_task.cancel()
+            self.client.metrics.set_heartbeat_interval(0)
+            logger.debug("LCD一体屏定时心跳停止")
         except Exception as e:
             raise e
 
-    def schedule_next_heartbeat(self):
-        if self.is_reporting:
+    def send_heartbeat(self):
+        """发送一次心跳，在事件循环线程中执行，断线期间跳过，等待重连后恢复"""
+        if self.is_reporting and self.client.is_connected():
             heartbeat_packet = json.dumps(self.network_lcd_model.create_heartbeat_packet(), ensure_ascii=False)
             self.client.send_data(heartbeat_packet, need_log=False)
-            self.timer = threading.Timer(self.heartbeat_interval, self.schedule_next_heartbeat)
-            self.timer.start()
+            self.client.metrics.record_heartbeat()    # 心跳没有返回，发出即记为最近一次心跳
 
     async def handle_received_data(self, data):
         """接收到服务器数据时的处理函数"""
-        logger.debug(f"LCD一体屏收到来自服务器的数据，原始数据： {data}")
+        if packet_log.sample(self.local_ip):
+            logger.debug("LCD一体屏收到来自服务器的数据，原始数据： {}", data)
         # 根据数据内容进行处理
         try:
             parsed_data = json.loads(data)
+            self.client.telemetry.frame_received(parsed_data.get("cmd", ""), len(data))
             if not isinstance(data, str):
                 logger.error(f"LCD一体屏收到来自服务器的非str数据：{type(data)}")
                 return
 
-            logger.info(f"LCD一体屏收到来自服务器的指令 {parsed_data}")
+            logger.info("LCD一体屏收到来自服务器的指令 {}", parsed_data)
 
             # 根据接收的指令，返回响应包
             reqid = parsed_data.get("reqid")
@@ -91,9 +103,10 @@ class NetworkLcdService:
 
             # 将接收到的服务器下发的指令录入数据库
             await self.store_received_command(data)
-            logger.info(f"LCD一体屏录入接收到的下发指令到数据库成功{data}")
+            logger.info("LCD一体屏录入接收到的下发指令到数据库成功{}", data)
 
         except Exception as e:
+            self.client.count_error(DECODE_ERRORS_TOTAL)
             logger.exception(f"LCD一体屏解析服务器下发数据失败: {e}")
 
     async def store_received_command(self, command_data):
@@ -15,16 +15,17 @@ class NetworkLedModel:
     PROTOCOL_TAIL = 0xfe    # 协议尾
 
     @staticmethod
-    def construct_packet(command_data: bytes, command_code: str) -> bytes:
+    def construct_packet(command_data: bytes, command_code: str, timestamp=None) -> bytes:
         """
         构造事件数据包
         :param command_data: 要发送的数据体
         :param command_code: 命令码
+        :param timestamp: 时间戳，为空时取当前时间
         :return:
         """
         try:
             data_bytes = command_data     # 要发送的数据体，bytes格式
-            timestamp = int(time.time())    # 时间戳
+            timestamp = timestamp or int(time.time())    # 时间戳
             command_code_ascii = ord(command_code)  # 命令码转换为ASCII码
             total_packets = 1   # 总包数，默认只有一个
             packet_number = 0   # 包序号，默认为0
@@ -130,7 +131,7 @@ class NetworkLedModel:
         return packet
 
     @staticmethod
-    def create_heartbeat_packet():
-        """按参数封装心跳包"""
-        packet = NetworkLedModel.construct_packet(b"", command_code='F')    # led的心跳包数据为空
+    def create_heartbeat_packet(timestamp=None):
+        """按参数封装心跳包，服务器的心跳返回中回显该时间戳"""
+        packet = NetworkLedModel.construct_packet(b"", command_code='F', timestamp=timestamp)    # led的心跳包数据为空
         return packet
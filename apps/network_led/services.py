@@ -6,13 +6,15 @@
 # @Software: PyCharm
 # @description:
 
-import threading
-
+import time
 import tortoise
 
-from core.connections.tcp_connection import TCPClient
+from core.connections.event_loop import PeriodicTask
+from core.connections.tcp_connection import FrameSplitter, TCPClient, peek_command_code
+from core.heartbeat_monitor import heartbeat_monitor
+from core.telemetry import DECODE_ERRORS_TOTAL, telemetry
 from .protocols import NetworkLedModel
-from core.logger import logger
+from core.logger import logger, packet_log
 from core.file_path import db_path
 from apps.models import DeviceMessageModel
 
@@ -21,6 +23,7 @@ class NetworkLedService:
 
     def __init__(self, server_ip, server_port, local_ip, device_type, device_version):
         self.client = TCPClient()  # TCP连接客户端
+        self.client.set_telemetry(telemetry.device("network_led", local_ip), peek_command_code)
         self.server_ip = server_ip  # 服务器IP
         self.server_port = server_port  # 服务器端口
         self.local_ip = local_ip  # 用于连接服务器的设备IP
@@ -28,7 +31,9 @@ class NetworkLedService:
         self.device_version = device_version  # 设备版本
         self.is_reporting = False  # 是否正在上报数据
         self.heartbeat_interval = 30  # 心跳间隔时间，单位为秒
-        self.timer = None  # 用于定时发送心跳包的定时器
+        self.heartbeat_task = PeriodicTask(self.heartbeat_interval, self.send_heartbeat, blocking=True)  # 定时心跳
+        self.register_sent_time = None  # 最近一次注册包的发送时间，收到注册返回时计算确认时延
+        self.heartbeat_tracker = heartbeat_monitor.tracker("network_led")    # 按时间戳匹配心跳和返回，统计往返时延和丢失
         self.network_led_model = NetworkLedModel()  # 网络LED屏数据模型实例
 
     def connect(self):
@@ -40,6 +45,9 @@ class NetworkLedService:
             # 设置接收数据和断开连接的回调函数
             self.client.set_receive_callback(self.handle_received_data)
             self.client.set_disconnect_callback(self.disconnect)
+            self.client.set_reconnect_callback(self.restore_session)
+            # 服务器连续下发的多个包可能在一次recv中到达，按协议头尾切分后逐包处理
+            self.client.set_frame_splitter(FrameSplitter(self.network_led_model.PROTOCOL_HEAD, self.network_led_model.PROTOCOL_TAIL))
             # 连接服务器
             self.client.connect(self.server_ip, self.server_port, self.local_ip)
             # 连接后发送注册包
@@ -55,14 +63,26 @@ class NetworkLedService:
             packet = self.network_led_model.create_register_packet(
                 self.device_type, self.device_version
             )
+            self.register_sent_time = time.perf_counter()
             self.client.send_data(packet, need_log=False)
         except Exception as e:
             raise e
 
+    def restore_session(self):
+        """断线自动重连成功后恢复会话：重新注册，断线前在运行的心跳按原间隔重新开始"""
+        self.heartbeat_tracker.reset()     # 断线前未返回的心跳不会再有返回，不计为丢失
+        self.send_register_packet()
+        if self.is_reporting:
+            self.stop_heartbeat()
+            self.start_heartbeat()
+        logger.info(f"LED网络屏{self.local_ip}重连后重新注册成功")
+
     def start_heartbeat(self):
         try:
             self.is_reporting = True
-            self.schedule_next_heartbeat()
+            self.heartbeat_task.interval = self.heartbeat_interval
+            self.client.metrics.set_heartbeat_interval(self.heartbeat_interval)
+            self.heartbeat_task.start()     # 立即发送一次，之后按间隔发送
             logger.debug("LED网络屏定时心跳开始")
         except Exception as e:
             raise e
@@ -70,43 +90,54 @@ class NetworkLedService:
     def stop_heartbeat(self):
         try:
             self.is_reporting = False
-            if self.timer:
-                self.timer.cancel()
-                self.timer = None
-                logger.debug("LED网络屏定时心跳停止")
+            self.heartbeat_task.cancel()
+            self.client.metrics.set_heartbeat_interval(0)
+            logger.debug("LED网络屏定时心跳停止")
         except Exception as e:
             raise e
 
-    def schedule_next_heartbeat(self):
+    def send_heartbeat(self):
+        """发送一次心跳，由共用事件循环上的定时任务调用"""
         if self.is_reporting:
-            heartbeat_packet = self.network_led_model.create_heartbeat_packet()
+            timestamp = int(time.time())
+            heartbeat_packet = self.network_led_model.create_heartbeat_packet(timestamp)
+            if self.client.is_connected():    # 未连接时心跳发不出去，不会有返回，不登记，避免记为丢失
+                self.heartbeat_tracker.sent(timestamp)
             self.client.send_data(heartbeat_packet, need_log=False)
-            self.timer = threading.Timer(
-                self.heartbeat_interval, self.schedule_next_heartbeat
-            )
-            self.timer.start()
 
     async def handle_received_data(self, data):
         """接收到服务器数据时的处理函数"""
-        logger.debug(f"LED网络屏收到来自服务器的数据，开始解包 {data}")
+        sampled = packet_log.sample(self.local_ip)
+        if sampled:
+            logger.debug("LED网络屏收到来自服务器的数据，开始解包 {}", data)
         # 根据数据内容进行处理
         try:
             parsed_data = self.network_led_model.deconstruct_packet(data)
+            self.client.telemetry.frame_received(parsed_data.get("command_code"), len(data))
             if parsed_data.get("command_code") == "C":  # 注册包
-                logger.debug(f"LED网络屏收到服务器的注册返回包：{parsed_data}")
+                logger.debug("LED网络屏收到服务器的注册返回包：{}", parsed_data)
+                if self.register_sent_time is not None:
+                    self.client.telemetry.observe_ack("register", time.perf_counter() - self.register_sent_time)
+                    self.register_sent_time = None
             elif parsed_data.get("command_code") == "F":  # 心跳包
-                logger.debug(f"LED网络屏收到服务器的心跳返回包：{parsed_data}")
+                if sampled:
+                    logger.debug("LED网络屏收到服务器的心跳返回包：{}", parsed_data)
+                self.client.metrics.record_heartbeat()
+                rtt = self.heartbeat_tracker.replied(parsed_data.get("timestamp"))
+                if rtt is not None:
+                    self.client.telemetry.observe_ack("heartbeat", rtt)
             elif parsed_data.get("command_code") == "T":  # T包为服务器下发的显示数据包
-                logger.info(f"LED网络屏收到服务器下发的屏显示包：{parsed_data}")
+                logger.info("LED网络屏收到服务器下发的屏显示包：{}", parsed_data)
                 # 下发的屏显示数据写入数据库
                 command_data = parsed_data.get("data_content")  # 提取屏显示指令部分
                 await self.store_received_command(command_data)
-                logger.info(f"LED网络屏写入接收指令到数据库成功：{command_data}")
+                logger.info("LED网络屏写入接收指令到数据库成功：{}", command_data)
             else:
                 logger.info(
                     f"LED网络屏收到服务器下发的未知类型数据，解包结果: {parsed_data}"
                 )
         except Exception as e:
+            self.client.count_error(DECODE_ERRORS_TOTAL)
             logger.exception(f"LED网络屏解析服务器下发数据失败: {e}")
 
     async def store_received_command(self, command_data):
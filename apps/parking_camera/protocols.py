@@ -126,9 +126,9 @@ class ParkingCameraModel:
         packet = self.construct_packet(registration_data, timestamp, command_code='C')
         return packet
 
-    def create_heartbeat_packet(self):
-        """按参数封装心跳包"""
-        timestamp = int(time.time())
+    def create_heartbeat_packet(self, timestamp=None):
+        """按参数封装心跳包，timestamp为空时取当前时间，服务器的心跳返回中回显该时间戳"""
+        timestamp = timestamp or int(time.time())
         packet = self.construct_packet(b"", timestamp, command_code='F')     # 心跳包没有任何数据内容
         return packet
 
@@ -164,7 +164,7 @@ class ParkingCameraModel:
         packet = self.construct_packet(data, timestamp, command_code='S')
         return packet
 
-    def create_parking_picture_head_packet(self, park_num: int, timestamp, total_packets, image_bytes: bytes, command_code="J",
+    def create_parking_picture_head_packet(self, park_num: int, timestamp, total_packets, image_length: int, command_code="J",
                                            plate_color: int = 3, plate_number: str = '川ABC123', confidence: int = 900):
         """
         按参数封装软识别模式车位图片头包
@@ -172,7 +172,7 @@ class ParkingCameraModel:
         :param total_packets: 总包数
         :param timestamp: 时间戳
         :param park_num: 车位号
-        :param image_bytes: 车位图片二进制数据
+        :param image_length: 车位图片数据总长度，头包只需要长度，图片内容由后续数据包分片发送
         :param command_code: 命令码
         :param confidence: 车牌可信度，用于硬识别，暂不支持，直接填充默认值
         :param plate_number: 车牌号，用于硬识别，暂不支持，直接填充默认值
@@ -205,7 +205,7 @@ class ParkingCameraModel:
             data_content += struct.pack(">B B 11s H", port_with_car, plate_color, plate_number_encoded, confidence)
 
         # 总图像数据长度
-        total_image_length = struct.pack(">I", len(image_bytes))
+        total_image_length = struct.pack(">I", image_length)
 
         # 组装头包（包含有卡/无卡标志位、车位信息和图像数据总长度）
         head_packet = self.construct_packet(
@@ -217,7 +217,7 @@ class ParkingCameraModel:
         )
         return head_packet
 
-    def create_parking_picture_hard_head_packet(self, park_num: int, timestamp, total_packets, image_bytes: bytes,
+    def create_parking_picture_hard_head_packet(self, park_num: int, timestamp, total_packets, image_length: int,
                                                 plate_color: int, plate_number: str, confidence: int, command_code="J"):
         """
         按参数封装硬识别模式的车位图片头包
@@ -225,7 +225,7 @@ class ParkingCameraModel:
         :param total_packets: 总包数
         :param timestamp: 时间戳
         :param park_num: 车位号
-        :param image_bytes: 车位图片二进制数据
+        :param image_length: 车位图片数据总长度，头包只需要长度，图片内容由后续数据包分片发送
         :param command_code: 命令码
         :param confidence: 车牌可信度
         :param plate_number: 车牌号
@@ -264,7 +264,7 @@ class ParkingCameraModel:
                 data_content += struct.pack(">B B 11s H", port_without_car, plate_color, plate_number_encoded, confidence)
 
         # 总图像数据长度
-        total_image_length = struct.pack(">I", len(image_bytes))
+        total_image_length = struct.pack(">I", image_length)
 
         # 组装头包（包含有卡/无卡标志位、车位信息和图像数据总长度）
         head_packet = self.construct_packet(
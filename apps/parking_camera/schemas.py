@@ -5,9 +5,9 @@
 # @File    : schemas.py
 # @Software: PyCharm
 # @description:
-from typing import Optional
+from typing import List, Optional
 
-from pydantic import BaseModel, conint, field_validator
+from pydantic import BaseModel, conint, confloat, field_validator
 from fastapi import Form, File, UploadFile
 from enum import Enum
 
@@ -53,10 +53,31 @@ class UploadParkingPictureModel(BaseModel):
     parkNum: conint(ge=1, le=6) = Form(..., description="车位号，范围1-6")
     model: conint(ge=1, le=2) = Form(..., description="识别模式：1（硬识别），2（软识别）")
     image: Optional[UploadFile] = File(None, description="车牌图片文件，base64编码")
-    innerPic: Optional[str] = Form(None, description="内置图片名称")
+    innerPic: Optional[str] = Form(None, description="内置图片名称，或 synthetic:<size>:<seed> 生成合成图片")
     plateColor: Optional[conint(ge=1, le=5)] = Form(None, description="车牌颜色：1:白 2:黑 3:蓝 4:黄 5:绿")
     plateNumber: Optional[str] = Form(None, description="车牌号")
     confidence: Optional[conint(ge=0, le=1000)] = Form(None, description="识别可信度，范围0-1000")
+    chunkSize: Optional[conint(ge=64, le=65535)] = Form(None, description="图片分包大小，不传使用设备链路配置")
+    chunkGapMs: Optional[confloat(ge=0)] = Form(None, description="数据包间隔毫秒数，不传使用设备链路配置")
+    bandwidth: Optional[conint(ge=0)] = Form(None, description="带宽上限，字节/秒，0不限速，不传使用设备链路配置")
+
+
+class BurstPictureModel(BaseModel):
+    """批量上传中的单张图片数据模型，图片只支持内置图片或合成图片"""
+    parkNum: conint(ge=1, le=6)
+    model: conint(ge=1, le=2)
+    innerPic: str
+    plateColor: Optional[conint(ge=1, le=5)] = None
+    plateNumber: Optional[str] = None
+    confidence: Optional[conint(ge=0, le=1000)] = None
+    chunkSize: Optional[conint(ge=64, le=65535)] = None
+    chunkGapMs: Optional[confloat(ge=0)] = None
+    bandwidth: Optional[conint(ge=0)] = None
+
+
+class UploadParkingPictureBurstModel(BaseModel):
+    """批量连续上传车位图片数据模型"""
+    pictures: List[BurstPictureModel]
 
 
 if __name__ == '__main__':
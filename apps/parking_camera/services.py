@@ -6,18 +6,30 @@
 # @Software: PyCharm
 # @description:
 
+import io
 import threading
 import time
-from core.connections.tcp_connection import TCPClient
+from typing import BinaryIO, Optional, Union
+from core.connections.event_loop import PeriodicTask
+from core.connections.tcp_connection import FrameSplitter, TCPClient, peek_command_code
+from core.heartbeat_monitor import heartbeat_monitor
+from core.link_profile import LinkProfile
+from core.report_correlation import PARKING_STATUS, report_correlation
+from core.telemetry import DECODE_ERRORS_TOTAL, telemetry
+from core.tracing import tracer
+from core.util import get_stream_length
 from .protocols import ParkingCameraModel
-from core.logger import logger
+from .upload_scheduler import PictureUploadJob, PictureUploadScheduler
+from core.logger import logger, packet_log
 
 
 class ParkingCameraService:
-    def __init__(self, server_ip, server_port, local_ip, device_type, device_version):
+    def __init__(self, server_ip, server_port, local_ip, device_type, device_version, link_profile=None,
+                 upload_resume_config=None):
         self.device_type = device_type          # 设备类型，默认为0x00
         self.device_version = device_version    # 设备版本号，默认为0x0400
         self.client = TCPClient()           # TCP客户端连接
+        self.client.set_telemetry(telemetry.device("parking_camera", local_ip), peek_command_code)
         self.server_ip = server_ip          # 服务器IP
         self.server_port = server_port      # 服务器端口
         self.local_ip = local_ip            # 用于连接服务器的设备IP
@@ -25,8 +37,14 @@ class ParkingCameraService:
         self.is_reporting_parking_status = False     # 是否正在上报车位状态
         self.heartbeat_interval = 30        # 心跳间隔时间，单位为秒
         self.reporting_interval = 30        # 上报车位状态的间隔时间，单位为秒
-        self.timer = None                   # 用于定时发送心跳包的定时器
-        self.image_confirmation_event = threading.Event()  # 线程事件对象，用于发送图片时阻塞发送进程，等待服务器返回确认信息
+        self.heartbeat_task = PeriodicTask(self.heartbeat_interval, self.send_heartbeat, blocking=True)    # 定时心跳
+        self.heartbeat_tracker = heartbeat_monitor.tracker("parking_camera")    # 按时间戳匹配心跳和返回，统计往返时延和丢失
+        self.report_task = PeriodicTask(self.reporting_interval, self.send_scheduled_parking_status, blocking=True)  # 定时上报车位状态
+        self.report_args = None             # 持续上报的车位号和车位状态，断线恢复后按原参数继续上报
+        self.link_profile = link_profile or LinkProfile()    # 链路参数，控制图片分包大小、包间隔和带宽
+        self.upload_scheduler = PictureUploadScheduler(self, **(upload_resume_config or {}))  # 图片上传调度器
+        self.session_generation = 0         # 会话代数，每次注册成功加1，用于判断断线后会话是否已恢复
+        self.session_condition = threading.Condition()  # 会话恢复的条件变量
         self.register_confirmation_event = threading.Event()  # 线程事件对象，用于注册时阻塞发送进程，等待服务器返回确认信息
         self.parking_camera_model = ParkingCameraModel()    # 车位相机的数据模型实例
 
@@ -40,12 +58,17 @@ class ParkingCameraService:
             # 设置接收数据和断开连接的回调函数
             self.client.set_receive_callback(self.handle_received_data)
             self.client.set_disconnect_callback(self.disconnect)
+            self.client.set_reconnect_callback(self.restore_session)
+            # 服务器连续下发的多个包可能在一次recv中到达，按协议头尾切分后逐包处理
+            self.client.set_frame_splitter(FrameSplitter(self.parking_camera_model.PROTOCOL_HEAD, self.parking_camera_model.PROTOCOL_TAIL))
             # 连接服务器
             self.client.connect(self.server_ip, self.server_port, self.local_ip)
             # 连接后发送注册包
             self.send_register_packet()
             # 特殊步骤，注册后立即发一个无实际业务数据的车位状态上报，全部用9占位，用于服务器识别设备类型
             self.send_all9_packet_for_recognition()
+            self.mark_session_ready()
+            self.client.resume_outbox()
             # 注册后开始持续心跳
             self.start_heartbeat()
         except Exception as e:
@@ -55,15 +78,52 @@ class ParkingCameraService:
         """发送注册包"""
         try:
             packet = self.parking_camera_model.create_register_packet(self.device_type, self.device_version)
+            self.register_confirmation_event.clear()  # 发送前设置事件为未触发状态，避免确认包先于clear到达
+            send_time = time.perf_counter()
             self.client.send_data(packet, need_log=False)
             # 阻塞等待服务器返回注册确认包
-            self.register_confirmation_event.clear()  # 设置事件为未触发状态
             if not self.register_confirmation_event.wait(timeout=5):  # 等待事件被触发，超时时间为5秒
                 logger.exception("车位相机5秒内没有接收到服务器返回的注册确认包")
                 raise Exception("车位相机5秒内没有接收到服务器返回的注册确认包，注册失败")
+            latency = time.perf_counter() - send_time
+            self.client.metrics.record_ack(latency)    # 注册确认的等待时间计入确认时延
+            self.client.telemetry.observe_ack("register", latency)
         except Exception as e:
             raise e
 
+    def restore_session(self):
+        """
+        断线自动重连成功后恢复会话：重新注册并发送识别包，之后被中断的图片上传可以继续，
+        断线前在运行的心跳和车位状态上报定时任务按原参数重新开始
+        """
+        self.heartbeat_tracker.reset()     # 断线前未返回的心跳不会再有返回，不计为丢失
+        self.send_register_packet()
+        self.send_all9_packet_for_recognition()
+        self.mark_session_ready()
+        self.client.resume_outbox()    # 补发断线期间缓存的车位状态
+        if self.is_reporting:
+            self.stop_heartbeat()
+            self.start_heartbeat()
+        if self.is_reporting_parking_status:
+            self.start_parking_status_report(*self.report_args)
+        logger.info(f"车位相机{self.local_ip}重连后重新注册成功")
+
+    def mark_session_ready(self):
+        """注册完成，会话代数加1并唤醒等待会话恢复的线程"""
+        with self.session_condition:
+            self.session_generation += 1
+            self.session_condition.notify_all()
+
+    def wait_session_after(self, generation, timeout):
+        """
+        等待会话恢复
+        :param generation: 中断前的会话代数，会话代数大于该值即表示已重新注册
+        :param timeout: 最长等待时间，单位为秒
+        :return: 是否在超时前恢复
+        """
+        with self.session_condition:
+            return self.session_condition.wait_for(lambda: self.session_generation > generation, timeout=timeout)
+
     def send_all9_packet_for_recognition(self):
         """
         特殊步骤
@@ -81,7 +141,9 @@ class ParkingCameraService:
         """开启持续心跳"""
         try:
             self.is_reporting = True
-            self.schedule_next_heartbeat()
+            self.heartbeat_task.interval = self.heartbeat_interval
+            self.client.metrics.set_heartbeat_interval(self.heartbeat_interval)
+            self.heartbeat_task.start()     # 立即发送一次，之后按间隔发送
             logger.debug("车位相机定时心跳开始")
         except Exception as e:
             raise e
@@ -90,19 +152,20 @@ class ParkingCameraService:
         """停止心跳"""
         try:
             self.is_reporting = False
-            if self.timer:
-                self.timer.cancel()
-                self.timer = None
-                logger.debug("车位相机定时心跳停止")
+            self.heartbeat_task.cancel()
+            self.client.metrics.set_heartbeat_interval(0)
+            logger.debug("车位相机定时心跳停止")
         except Exception as e:
             raise e
 
-    def schedule_next_heartbeat(self):
+    def send_heartbeat(self):
+        """发送一次心跳，由共用事件循环上的定时任务调用"""
         if self.is_reporting:
-            heartbeat_packet = self.parking_camera_model.create_heartbeat_packet()
+            timestamp = int(time.time())
+            heartbeat_packet = self.parking_camera_model.create_heartbeat_packet(timestamp)
+            if self.client.is_connected():    # 未连接时心跳发不出去，不会有返回，不登记，避免记为丢失
+                self.heartbeat_tracker.sent(timestamp)
             self.client.send_data(heartbeat_packet, need_log=False)
-            self.timer = threading.Timer(self.heartbeat_interval, self.schedule_next_heartbeat)
-            self.timer.start()
 
     def send_command(self, command_data: bytes, command_code: str):
         """
@@ -129,14 +192,17 @@ class ParkingCameraService:
                 logger.debug("车位相机当前已存在定时任务，被新上报覆盖")
                 self.stop_reporting_parking_status()
             self.is_reporting_parking_status = True
-            self.schedule_next_parking_status_report(park_num, park_event)
+            self.report_args = (park_num, park_event)
+            self.report_task.interval = self.reporting_interval
+            self.report_task.start()
             logger.debug("车位相机定时上报车位状态开始")
         except Exception as e:
             raise e
 
-    def schedule_next_parking_status_report(self, park_num, park_event):
-        """调度下一次上报"""
+    def send_scheduled_parking_status(self):
+        """执行一次定时上报，由共用事件循环上的定时任务调用"""
         if self.is_reporting_parking_status:
+            park_num, park_event = self.report_args
             try:
                 # 执行上报逻辑
                 self.send_parking_status(park_num, park_event)
@@ -144,21 +210,11 @@ class ParkingCameraService:
             except Exception as e:
                 logger.exception(f"车位相机定时上报失败: {e}")
 
-            # 调度下一次上报
-            self.timer = threading.Timer(
-                self.reporting_interval,
-                self.schedule_next_parking_status_report,
-                args=[park_num, park_event]
-            )
-            self.timer.start()
-
     def stop_reporting_parking_status(self):
         """停止持续上报"""
         try:
-            self.is_reporting = False
-            if self.timer:
-                self.timer.cancel()
-                self.timer = None
+            self.is_reporting_parking_status = False
+            self.report_task.cancel()
         except Exception as e:
             raise e
 
@@ -171,85 +227,85 @@ class ParkingCameraService:
         """
         try:
             packet = self.parking_camera_model.create_parking_status_packet(selected_port, status_values)
-            self.client.send_data(packet)
+            # 断线期间存入缓冲区，同一车位只保留最新状态，重新注册后补发
+            self.client.send_event(packet, key=f"parking_status:{selected_port}")
+            report_correlation.record((PARKING_STATUS, self.local_ip, selected_port))   # 等待平台上报，统计端到端时延
         except Exception as e:
             raise e
 
-    def upload_picture(self, park_num: int, image_bytes: bytes,
-                       model: int, plate_color: int, plate_number: str, confidence: int):
+    def upload_picture(self, park_num: int, image: Union[bytes, BinaryIO],
+                       model: int, plate_color: int, plate_number: str, confidence: int,
+                       image_length: Optional[int] = None, link_profile: Optional[LinkProfile] = None):
         """
         给服务器上传图片数据包，包类型为J包
-        首先发送一次头包，阻塞进程等待服务器的确认返回，接收到返回后分包发送图片的二进制内容
+        首先发送一次头包，等待服务器的确认返回，接收到返回后分包发送图片的二进制内容
+        图片支持以二进制流传入，分包时每次只从流中读取一包的数据（默认1024字节），避免整张图片常驻内存
+        实际发送由上传调度器完成，此方法阻塞等待上传结束
         :param confidence: 可信度
         :param plate_number: 车牌号
         :param plate_color: 车牌颜色
         :param model: 识别模式 1：硬识别 2：软识别
         :param park_num: 车位号
-        :param image_bytes: 图片二进制数据
-        :return:
+        :param image: 图片二进制数据，或可读取的二进制流
+        :param image_length: 图片总长度，不传时从数据或流中获取
+        :param link_profile: 本次上传使用的链路参数，不传时使用设备默认链路参数
+        :return: 上传耗时信息
         """
-        try:
-            # 流程中需要共同的参数
-            total_packets = len(image_bytes) // 1024 + (1 if len(image_bytes) % 1024 != 0 else 0)
-            timestamp_all = int(time.time())  # 协议要求一个图片的所有包共用同一个时间戳
-
-            # 构造头包后发送
-            if model == 1:  # 硬识别模式
-                head_packet = self.parking_camera_model.create_parking_picture_hard_head_packet(
-                    park_num, timestamp_all, total_packets, image_bytes, plate_color, plate_number, confidence
-                )
-            else:   # 软识别模式
-                head_packet = self.parking_camera_model.create_parking_picture_head_packet(
-                    park_num, timestamp_all, total_packets, image_bytes
-                )
-            self.client.send_data(head_packet)
-
-            # 等待服务器返回确认
-            logger.debug("图片头包已发送，等待服务器返回确认")
-            self.image_confirmation_event.clear()  # 设置事件为未触发状态
-            if not self.image_confirmation_event.wait(timeout=5):  # 等待事件被触发，超时时间为5秒
-                logger.exception("车位相机5秒内没有接收到服务器返回的图片头包确认包，停止上传图片")
-                raise Exception("车位相机5秒内没有接收到服务器返回的图片头包确认包，停止上传图片")
-            logger.debug("车位相机收到服务器的头包确认返回，开始发送图片数据")
-
-            # 分包发送图片数据
-            for i in range(total_packets):
-                chunk = image_bytes[i * 1024:(i + 1) * 1024]    # 每1024字节为一包
-                packet = self.parking_camera_model.construct_packet(
-                    command_data=chunk,
-                    command_code="J",
-                    timestamp=timestamp_all,
-                    total_packets=total_packets,
-                    packet_number=i + 1  # 图片数据包的序号从1开始
-                )
-                self.client.send_data(packet, need_log=False)
-        except Exception as e:
-            raise e
+        # 统一按二进制流处理，bytes包装为BytesIO，不产生额外拷贝
+        image_stream = io.BytesIO(image) if isinstance(image, (bytes, bytearray)) else image
+        if image_length is None:
+            image_length = get_stream_length(image_stream)
+        with tracer.span("upload_picture", "service", parkNum=park_num, imageLength=image_length):
+            future = self.submit_picture_upload(park_num, image_stream, image_length, model,
+                                                plate_color, plate_number, confidence, link_profile)
+            return future.result()
+
+    def submit_picture_upload(self, park_num: int, image_stream: BinaryIO, image_length: int,
+                              model: int, plate_color: int, plate_number: str, confidence: int,
+                              link_profile: Optional[LinkProfile] = None):
+        """
+        提交图片上传任务到调度器，不阻塞等待，用于同一台相机多个车位短时间内连续上报图片
+        :return: 上传结果Future，完成后返回上传耗时信息
+        """
+        job = PictureUploadJob(park_num, image_stream, image_length, model, plate_color, plate_number, confidence,
+                               link_profile or self.link_profile)
+        return self.upload_scheduler.submit(job)
 
     def handle_received_data(self, data):
         """接收到服务器数据时的处理函数"""
-        logger.debug(f"车位相机收到来自服务器的数据，开始解包 {data}")
+        sampled = packet_log.sample(self.local_ip)
+        if sampled:
+            logger.debug("车位相机收到来自服务器的数据，开始解包 {}", data)
         # 根据数据内容进行处理
         try:
             parsed_data = self.parking_camera_model.deconstruct_packet(data)
+            self.client.telemetry.frame_received(parsed_data.get("command_code"), len(data))
             if parsed_data.get("command_code") == "F":    # 处理车位相机的F心跳包
-                logger.debug(f"车位相机收到服务器的心跳返回：{parsed_data}")
+                if sampled:
+                    logger.debug("车位相机收到服务器的心跳返回：{}", parsed_data)
+                self.client.metrics.record_heartbeat()
+                rtt = self.heartbeat_tracker.replied(parsed_data.get("timestamp"))
+                if rtt is not None:
+                    self.client.telemetry.observe_ack("heartbeat", rtt)
             elif parsed_data.get("command_code") == "C":    # 处理注册确认C包
-                logger.debug(f"车位相机收到服务器的注册确认包：{parsed_data}")
+                logger.debug("车位相机收到服务器的注册确认包：{}", parsed_data)
                 self.register_confirmation_event.set()  # 触发事件解除等待状态
             elif parsed_data.get("command_code") == "J":  # 处理服务器返回的图片头包ACK返回包，返回J包视为确认通过
-                logger.debug(f"车位相机收到服务器的图片头包确认返回：{parsed_data}")
-                self.image_confirmation_event.set()  # 触发事件解除等待状态
+                logger.debug("车位相机收到服务器的图片头包确认返回：{}", parsed_data)
+                self.upload_scheduler.on_head_ack(parsed_data.get("timestamp"))  # 交给上传调度器匹配对应的上传任务
             elif parsed_data.get("command_code") == "S":    # 处理车位相机的F心跳包
-                logger.info(f"车位相机收到服务器的车位状态上报返回：{parsed_data}")
+                if sampled:
+                    logger.info("车位相机收到服务器的车位状态上报返回：{}", parsed_data)
             else:
-                logger.info(f"车位相机收到服务器下发数据，解包结果: {parsed_data}")
+                logger.info("车位相机收到服务器下发数据，解包结果: {}", parsed_data)
         except Exception as e:
+            self.client.count_error(DECODE_ERRORS_TOTAL)
             logger.exception(f"车位相机解析服务器下发数据失败: {e}")
 
     def disconnect(self):
         try:
             self.stop_heartbeat()
+            self.stop_reporting_parking_status()
             self.client.disconnect()
         except Exception as e:
             raise e
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/11 10:05
+# @Author  : Heshouyi
+# @File    : upload_scheduler.py
+# @Software: PyCharm
+# @description: 车位相机图片上传调度器，同一台相机的多个图片上传任务排队后在一条连接上有序发送
+
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from core.link_profile import LinkProfile
+from core.logger import logger
+from core.tracing import tracer
+from core.util import read_stream_chunk
+
+
+class UploadInterrupted(Exception):
+    """上传过程中连接中断，数据包未能写入套接字"""
+
+
+class PictureUploadJob:
+    """单张图片的上传任务"""
+
+    def __init__(self, park_num, image_stream, image_length, model, plate_color, plate_number, confidence,
+                 link_profile: LinkProfile):
+        self.park_num = park_num            # 车位号
+        self.image_stream = image_stream    # 图片二进制流
+        self.stream_offset = image_stream.tell()    # 图片数据在流中的起始位置，续传时据此定位
+        self.image_length = image_length    # 图片总长度
+        self.model = model                  # 识别模式 1：硬识别 2：软识别
+        self.plate_color = plate_color
+        self.plate_number = plate_number
+        self.confidence = confidence
+        self.link_profile = link_profile    # 本次上传使用的链路参数
+        chunk_size = link_profile.chunk_size
+        self.total_packets = image_length // chunk_size + (1 if image_length % chunk_size != 0 else 0)
+        self.timestamp = None               # 协议要求一个图片的所有包共用同一个时间戳，由调度器分配，续传时保持不变
+        self.head_pending = True            # 是否需要（重新）发送头包
+        self.session_generation = 0         # 发送头包时设备的会话代数，用于判断中断后会话是否已恢复
+        self.ack_event = threading.Event()  # 头包确认事件
+        self.future = Future()              # 上传结果，完成时返回上传耗时信息
+        self.submit_time = time.perf_counter()  # 任务提交时间
+        self.head_sent_time = None          # 首次发送头包的时间
+        self.ack_time = None                # 收到头包确认的时间
+        self.chunk_start_time = None        # 开始发送第一个数据包的时间
+        self.finish_time = None             # 最后一个数据包写入套接字的时间
+        self.bytes_sent = 0                 # 数据包实际写入套接字的字节数（转义后，含重传）
+        self.acked_packets = 0              # 已被服务器TCP确认的数据包数量，续传从下一包开始
+        self.acked_bytes = 0                # 上次从头重发以来已被确认的数据包字节数
+        self.written_bytes = 0              # 当前连接上本任务已写入套接字的字节数，用于换算TCP确认位置
+        self.inflight = deque()             # 已写入套接字但尚未确认的数据包 (写入后累计字节数, 包序号, 包长度)
+        self.retries = 0                    # 连接中断后的重试次数
+        self.wasted_bytes = 0               # 因中断需要重发而浪费的字节数
+        self.trace = tracer.current()       # 提交任务的调用所在的跨度，调度线程中的埋点归入这次调用，未采样时为空跨度
+
+    def result_info(self):
+        """上传耗时信息，单位毫秒，实际速率按数据包写入套接字的字节数计算，单位字节/秒"""
+        chunk_duration = self.finish_time - self.chunk_start_time
+        return {
+            "parkNum": self.park_num,
+            "timestamp": self.timestamp,
+            "imageLength": self.image_length,
+            "totalPackets": self.total_packets,
+            "queueMs": round((self.head_sent_time - self.submit_time) * 1000, 3),
+            "ackWaitMs": round((self.ack_time - self.head_sent_time) * 1000, 3),
+            "latencyMs": round((self.finish_time - self.head_sent_time) * 1000, 3),    # 头包发出到最后一包写完
+            "bytesSent": self.bytes_sent,
+            "achievedRate": round(self.bytes_sent / chunk_duration, 1) if chunk_duration > 0 else None,
+            "linkProfile": self.link_profile.to_dict(),
+            "retries": self.retries,
+            "wastedBytes": self.wasted_bytes,
+        }
+
+
+class PictureUploadScheduler:
+    """
+    车位相机图片上传调度器
+    每台相机一个调度线程，所有包都在这个线程中顺序写入同一条连接，保证包不会交错
+    当前图片收到头包确认开始发送数据包前，先把下一张图片的头包发出去，下一张图片的确认在当前图片发送期间返回，
+    当前图片发送完成后即可直接发送下一张，不再额外等待确认
+    上传过程中连接中断时，等待设备重连并重新注册后，用相同的时间戳重发头包，并从最后一个被服务器TCP确认的数据包之后续传，
+    mode为restart时从第一个数据包重新发送，重试次数超过retry_budget后上传失败
+    """
+
+    RESUME_MODES = ("resume", "restart")
+
+    def __init__(self, service, ack_timeout=5, history_size=1000, mode="resume", retry_budget=3,
+                 recovery_timeout=60):
+        if mode not in self.RESUME_MODES:
+            raise ValueError(f"图片上传中断恢复模式只支持{self.RESUME_MODES}，实际为: {mode}")
+        self.service = service              # 所属的车位相机服务实例
+        self.ack_timeout = ack_timeout      # 头包确认超时时间，单位为秒
+        self.mode = mode                    # 中断恢复模式，resume：续传 restart：重新发送整张图片
+        self.retry_budget = retry_budget    # 单张图片允许的中断重试次数
+        self.recovery_timeout = recovery_timeout    # 中断后等待设备重新注册的最长时间，单位为秒
+        self.jobs = queue.Queue()           # 待上传任务队列
+        self.backlog = deque()              # 已从队列取出、因连接中断退回等待重新发送的任务
+        self.pending_acks = deque()         # 已发送头包、等待确认的任务，按发送顺序排列
+        self.pending_lock = threading.Lock()
+        self.active_timestamps = set()      # 已分配给尚未完成的任务的时间戳，只在调度线程中读写
+        self.worker = None                  # 调度线程
+        self.worker_lock = threading.Lock()   # 保护调度线程的启动和退出判断，避免任务提交时线程恰好退出
+        self.history = deque(maxlen=history_size)   # 最近完成的上传耗时信息
+        self.history_lock = threading.Lock()    # 调度线程追加、接口线程读取统计时都持有
+        self.completed_count = 0            # 上传成功数量
+        self.failed_count = 0               # 上传失败数量
+        self.retry_count = 0                # 连接中断后的重试总次数
+        self.wasted_bytes = 0               # 因中断重发浪费的总字节数
+
+    def submit(self, job: PictureUploadJob) -> Future:
+        """提交上传任务，返回任务结果Future"""
+        with self.worker_lock:
+            self.jobs.put(job)
+            if self.worker is None:
+                self.start_worker()
+        return job.future
+
+    def start_worker(self):
+        """启动调度线程，调用方持有worker_lock"""
+        self.worker = threading.Thread(target=self.run, name=f"picture-upload-{self.service.local_ip}", daemon=True)
+        self.worker.start()
+
+    def on_head_ack(self, timestamp):
+        """
+        收到服务器返回的图片头包确认
+        优先按时间戳匹配等待确认的任务，匹配不到时按发送顺序确认最早的一个
+        """
+        with self.pending_lock:
+            if not self.pending_acks:
+                logger.warning(f"车位相机收到图片头包确认，但没有等待确认的上传任务，时间戳: {timestamp}")
+                return
+            job = next((pending for pending in self.pending_acks if pending.timestamp == timestamp), None)
+            if job is None:
+                job = self.pending_acks[0]
+            self.pending_acks.remove(job)
+        job.ack_time = time.perf_counter()
+        job.trace.interval("ack_wait", job.head_sent_time, job.ack_time, timestamp=job.timestamp)
+        self.service.client.metrics.record_ack(job.ack_time - job.head_sent_time)
+        self.service.client.telemetry.observe_ack("image", job.ack_time - job.head_sent_time)
+        job.ack_event.set()
+
+    def next_timestamp(self):
+        """
+        分配图片时间戳，服务器按时间戳区分同时在传的不同图片
+        只有当前秒已被尚未完成的任务占用时才顺延到下一秒，顺延量不超过流水线中的任务数，时钟不会随图片数量持续超前
+        """
+        timestamp = int(time.time())
+        while timestamp in self.active_timestamps:
+            timestamp += 1
+        self.active_timestamps.add(timestamp)
+        return timestamp
+
+    def send_packet(self, job: PictureUploadJob, packet: bytes, need_log=False):
+        """发送一个包，写入套接字失败时抛出UploadInterrupted"""
+        if not self.service.client.send_data(packet, need_log=need_log):
+            job.wasted_bytes += len(packet)
+            raise UploadInterrupted(f"车位相机{job.park_num}号车位图片上传时连接中断")
+
+    def send_head(self, job: PictureUploadJob):
+        """构造并发送头包，续传时沿用首次分配的时间戳"""
+        model = self.service.parking_camera_model
+        if job.timestamp is None:
+            job.timestamp = self.next_timestamp()
+        if job.model == 1:  # 硬识别模式
+            head_packet = model.create_parking_picture_hard_head_packet(
+                job.park_num, job.timestamp, job.total_packets, job.image_length,
+                job.plate_color, job.plate_number, job.confidence
+            )
+        else:   # 软识别模式
+            head_packet = model.create_parking_picture_head_packet(
+                job.park_num, job.timestamp, job.total_packets, job.image_length
+            )
+        job.ack_event.clear()
+        job.session_generation = self.service.session_generation
+        with self.pending_lock:
+            self.pending_acks.append(job)
+        if job.head_sent_time is None:
+            job.head_sent_time = time.perf_counter()
+            job.trace.interval("queue", job.submit_time, job.head_sent_time, parkNum=job.park_num)
+        elif job.retries:
+            job.wasted_bytes += len(head_packet)    # 重发的头包计入浪费字节
+        job.head_pending = False
+        job.written_bytes = 0
+        job.inflight.clear()
+        with tracer.activate(job.trace), job.trace.span("send_head", "upload", timestamp=job.timestamp,
+                                                        retries=job.retries):
+            self.send_packet(job, head_packet, need_log=True)
+        job.written_bytes += len(head_packet)
+        logger.debug(f"车位相机{job.park_num}号车位图片头包已发送，时间戳: {job.timestamp}")
+
+    def wait_head_ack(self, job: PictureUploadJob):
+        """等待头包确认，超时时如果期间连接已中断，按中断处理"""
+        if job.ack_event.wait(timeout=self.ack_timeout):
+            return
+        if not self.service.client.is_connected() or self.service.session_generation != job.session_generation:
+            raise UploadInterrupted(f"车位相机{job.park_num}号车位图片等待头包确认时连接中断")
+        logger.error(f"车位相机{self.ack_timeout}秒内没有接收到服务器返回的图片头包确认包，停止上传图片")
+        raise Exception(f"车位相机{self.ack_timeout}秒内没有接收到服务器返回的图片头包确认包，停止上传图片")
+
+    def send_chunks(self, job: PictureUploadJob):
+        """
+        分包发送图片数据，按链路参数从流中读取每包数据，从最后一个成功写入的数据包之后开始
+        配置了带宽时按写入套接字的字节数经令牌桶整形，配置了包间隔时每包之间固定等待
+        """
+        model = self.service.parking_camera_model
+        chunk_size = job.link_profile.chunk_size
+        chunk_gap = job.link_profile.chunk_gap_ms / 1000
+        shaper = job.link_profile.create_shaper()
+        if job.chunk_start_time is None:
+            job.chunk_start_time = time.perf_counter()
+        start = job.acked_packets
+        job.image_stream.seek(job.stream_offset + start * chunk_size)
+        with tracer.activate(job.trace), job.trace.span("send_chunks", "upload", firstPacket=start + 1,
+                                                        totalPackets=job.total_packets):
+            for i in range(start, job.total_packets):
+                if i > start and chunk_gap:
+                    time.sleep(chunk_gap)
+                chunk = read_stream_chunk(job.image_stream, min(chunk_size, job.image_length - i * chunk_size))
+                if not chunk:
+                    raise Exception(f"车位相机图片数据不足，声明长度{job.image_length}字节，实际只读取到{i}包")
+                packet = model.construct_packet(
+                    command_data=chunk,
+                    command_code="J",
+                    timestamp=job.timestamp,
+                    total_packets=job.total_packets,
+                    packet_number=i + 1  # 图片数据包的序号从1开始
+                )
+                if shaper:
+                    with tracer.span("shaping", bytes=len(packet)):
+                        shaper.acquire(len(packet))
+                self.send_packet(job, packet)
+                job.bytes_sent += len(packet)
+                job.written_bytes += len(packet)
+                job.inflight.append((job.written_bytes, i, len(packet)))
+                self.update_acked(job)
+        job.finish_time = time.perf_counter()
+
+    def update_acked(self, job: PictureUploadJob):
+        """
+        根据套接字发送队列中未确认的字节数，更新已被服务器确认的数据包位置
+        写入套接字只代表进入内核发送缓冲区，连接中断时缓冲区中的数据会丢失，因此续传位置以TCP确认为准，
+        同一连接上心跳等其他包也计入未确认字节数，换算结果偏保守；平台不支持查询时退化为以写入成功为准
+        """
+        unacked = self.service.client.get_unacked_bytes()
+        acked = job.written_bytes if unacked is None else job.written_bytes - unacked
+        while job.inflight and job.inflight[0][0] <= acked:
+            _, packet_index, length = job.inflight.popleft()
+            job.acked_packets = packet_index + 1
+            job.acked_bytes += length
+
+    def reset_head(self, job: PictureUploadJob):
+        """连接中断后，已发送的头包作废，需要重新发送"""
+        with self.pending_lock:
+            if job in self.pending_acks:
+                self.pending_acks.remove(job)
+        job.head_pending = True
+
+    def recover(self, job: PictureUploadJob, error: UploadInterrupted):
+        """
+        连接中断后等待设备重连并重新注册
+        :return: 是否可以重试，超过重试次数或等待超时返回False
+        """
+        self.reset_head(job)
+        # 已写入但未被确认的数据包需要重发，计入浪费字节
+        job.wasted_bytes += sum(length for _, _, length in job.inflight)
+        job.inflight.clear()
+        if job.retries >= self.retry_budget:
+            logger.error(f"{error}，已重试{job.retries}次，超过重试上限")
+            return False
+        job.retries += 1
+        self.retry_count += 1
+        logger.warning(f"{error}，已确认{job.acked_packets}/{job.total_packets}包，等待设备重新注册后第{job.retries}次重试")
+        recovery_start = time.perf_counter()
+        recovered = self.service.wait_session_after(job.session_generation, self.recovery_timeout)
+        job.trace.interval("recovery", recovery_start, time.perf_counter(), retries=job.retries)
+        if not recovered:
+            logger.error(f"车位相机{self.recovery_timeout}秒内没有完成重连注册，停止上传图片")
+            return False
+        if self.mode == "restart" and job.acked_packets:
+            # 重新发送整张图片，已确认的数据包也作废；未确认的部分上面已计入，之前各次重发的部分在当时已计入
+            job.wasted_bytes += job.acked_bytes
+            job.acked_packets = 0
+            job.acked_bytes = 0
+        return True
+
+    def complete(self, job: PictureUploadJob):
+        self.completed_count += 1
+        self.wasted_bytes += job.wasted_bytes
+        self.active_timestamps.discard(job.timestamp)
+        result = job.result_info()
+        with self.history_lock:
+            self.history.append(result)
+        job.future.set_result(result)
+        logger.debug(f"车位相机{job.park_num}号车位图片上传完成: {result}")
+
+    def fail(self, job: PictureUploadJob, error: Exception):
+        with self.pending_lock:
+            if job in self.pending_acks:
+                self.pending_acks.remove(job)
+        self.active_timestamps.discard(job.timestamp)
+        self.failed_count += 1
+        self.wasted_bytes += job.wasted_bytes
+        job.future.set_exception(error)
+
+    def take_next(self):
+        """取出下一个待上传任务，优先取因中断退回的任务，没有时返回None"""
+        if self.backlog:
+            return self.backlog.popleft()
+        try:
+            return self.jobs.get_nowait()
+        except queue.Empty:
+            return None
+
+    def run(self):
+        """
+        调度线程，队列为空一段时间后退出，有新任务时重新启动
+        线程退出（包括异常退出）时在锁内清除线程标记，退出判断之后才入队的任务由这里重新启动线程处理，不会滞留
+        """
+        try:
+            self.process_jobs()
+        except Exception as e:
+            logger.exception(f"车位相机图片上传调度线程异常退出: {e}")
+        finally:
+            with self.worker_lock:
+                self.worker = None
+                if not self.jobs.empty():
+                    self.start_worker()
+
+    def process_jobs(self):
+        """依次处理队列中的任务，队列空闲超过30秒时返回"""
+        current = None
+        while True:
+            if current is None:
+                current = self.take_next()
+            if current is None:
+                try:
+                    current = self.jobs.get(timeout=30)
+                except queue.Empty:
+                    return
+
+            following = None
+            try:
+                if current.head_pending:
+                    self.send_head(current)
+                # 等待当前图片的头包确认
+                self.wait_head_ack(current)
+                # 发送当前图片数据前，先发出下一张图片的头包
+                following = self.take_next()
+                if following is not None and following.head_pending:
+                    self.send_head(following)
+                self.send_chunks(current)
+                self.complete(current)
+                current = following
+            except UploadInterrupted as e:
+                if following is not None:
+                    # 下一张图片的头包同样作废，退回等待当前图片处理完后重新发送
+                    self.reset_head(following)
+                    self.backlog.appendleft(following)
+                if not self.recover(current, e):
+                    self.fail(current, e)
+                    current = None
+            except Exception as e:
+                if following is not None:
+                    self.backlog.appendleft(following)
+                self.fail(current, e)
+                current = None
+
+    def get_stats(self):
+        """上传统计，包含最近完成的上传耗时分布"""
+        with self.history_lock:
+            history = list(self.history)
+        latencies = sorted(item["latencyMs"] for item in history)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        return {
+            "queued": self.jobs.qsize() + len(self.backlog),
+            "waitingAck": len(self.pending_acks),
+            "completed": self.completed_count,
+            "failed": self.failed_count,
+            "retries": self.retry_count,
+            "wastedBytes": self.wasted_bytes,
+            "latencyMsP50": percentile(0.5),
+            "latencyMsP99": percentile(0.99),
+            "latencyMsMax": latencies[-1] if latencies else None,
+            "recent": history[-10:],
+        }
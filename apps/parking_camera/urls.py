@@ -6,11 +6,14 @@
 # @Software: PyCharm
 # @description:
 
+import io
 from fastapi import APIRouter
 from core.device_manager import DeviceManager
 from core.logger import logger
-from core.util import get_inner_picture
-from .schemas import ParkingStatusReportModel, StartParkingStatusReportModel, UploadParkingPictureModel
+from core.tracing import tracer
+from core.util import get_inner_picture, get_stream_length
+from .schemas import ParkingStatusReportModel, StartParkingStatusReportModel, UploadParkingPictureModel, \
+    UploadParkingPictureBurstModel
 from .services import ParkingCameraService
 from core.util import return_success_response, handle_exceptions
 
@@ -124,7 +127,7 @@ def stop_parking_status_report():
 
 @parking_camera_router.post("/uploadParkingPicture", summary="上传车位图片")
 @handle_exceptions(model_name="车位相机相关接口")
-async def upload_parking_picture(data: UploadParkingPictureModel):
+def upload_parking_picture(data: UploadParkingPictureModel):
     """
     上报车位图片，目前只支持软识别模式
     必填参数：
@@ -132,40 +135,104 @@ async def upload_parking_picture(data: UploadParkingPictureModel):
         model (int): 识别模式 1：硬识别 2：软识别
     以下两个必填其一：
         image (file): 车牌图片，base64编码
-        innerPic (str): 内置图片名称
+        innerPic (str): 内置图片名称，或 synthetic:<size>:<seed> 按种子生成指定大小的合成图片，如 synthetic:500kb:1
     当模式为1：硬识别时，以下参数必填：
         plateColor (int) = 车牌颜色 1：白；2：黑；3：蓝，4：黄，5：绿
         plateNumber (str) = 车牌号
         confidence (int) = 识别可信度 0-1000
+    选填参数，不传时使用设备链路配置：
+        chunkSize (int): 图片分包大小，默认1024字节
+        chunkGapMs (float): 数据包之间的间隔毫秒数
+        bandwidth (int): 带宽上限，字节/秒，0不限速
     """
-    park_num = data.parkNum
-    model = data.model
+    with tracer.span("validate"):     # 参数校验和读取图片，追踪时与排队、套接字写入和确认等待分开统计
+        park_num = data.parkNum
+        model = data.model
+
+        # 校验image和innerPic至少存在一个
+        image = data.image  # 上传的图片文件
+        inner_pic = data.innerPic  # 内置图片名称
+        if not image and not inner_pic:
+            return return_success_response(message="image或innerPic至少需要填一个")
+
+        # 尝试获取三个选填参数
+        plate_color = data.plateColor
+        plate_number = data.plateNumber
+        confidence = data.confidence
+
+        # 当模式为硬识别时，三个参数必填
+        if model == 1:
+            if any(i is None for i in [plate_color, plate_number, confidence]):
+                return return_success_response(message="模式为硬识别时，plateColor、plateNumber和confidence三个参数必填")
+
+        # 获取图片数据
+        if inner_pic:  # 如果有内置图片，尝试获取，忽略自定义上传图片参数
+            image_data = get_inner_picture(inner_pic)
+            if image_data is None:
+                return return_success_response(message=f"无法找到内置图片: {inner_pic}")
+            image_length = len(image_data)
+        else:
+            # 上传文件已由框架缓存在SpooledTemporaryFile中（超过阈值自动落盘），这里直接把文件流交给分包逻辑，
+            # 不再整体read到内存，单次上传的内存占用与图片大小无关
+            image_data = image.file
+            image_data.seek(0)
+            image_length = image.size if image.size is not None else get_stream_length(image_data)
 
-    # 校验image和innerPic至少存在一个
-    image = data.image  # 上传的图片文件
-    inner_pic = data.innerPic  # 内置图片名称
-    if not image and not inner_pic:
-        return return_success_response(message="image或innerPic至少需要填一个")
+    parking_camera = get_parking_camera()
+    link_profile = parking_camera.link_profile.merge(data.chunkSize, data.chunkGapMs, data.bandwidth)
+    result = parking_camera.upload_picture(park_num, image_data, model, plate_color, plate_number, confidence,
+                                           image_length=image_length, link_profile=link_profile)
+    logger.info(f"车位相机{park_num}号车位成功上报车位图片")
+    return return_success_response(message=f"车位相机{park_num}号车位成功上报车位图片", data=result)
 
-    # 尝试获取三个选填参数
-    plate_color = data.plateColor
-    plate_number = data.plateNumber
-    confidence = data.confidence
 
-    # 当模式为硬识别时，三个参数必填
-    if model == 1:
-        if any(i is None for i in [plate_color, plate_number, confidence]):
+@parking_camera_router.post("/uploadParkingPictureBurst", summary="批量连续上传多个车位图片")
+@handle_exceptions(model_name="车位相机相关接口")
+def upload_parking_picture_burst(data: UploadParkingPictureBurstModel):
+    """
+    模拟相机短时间内连续上报多个车位的图片，所有任务一次性提交给上传调度器，在同一条连接上流水线发送
+    必填参数：
+        pictures (list): 图片任务列表，每个元素包含：
+            parkNum (int): 车位号
+            model (int): 识别模式 1：硬识别 2：软识别
+            innerPic (str): 内置图片名称，或 synthetic:<size>:<seed>
+            plateColor/plateNumber/confidence: 硬识别时必填
+            chunkSize/chunkGapMs/bandwidth: 选填，链路参数，不传时使用设备链路配置
+    返回每张图片从头包发出到最后一包写完的耗时
+    """
+    parking_camera = get_parking_camera()
+    # 先校验所有图片并准备好数据，有一张不合法时整批都不提交，避免前面的图片已经开始上传
+    uploads = []
+    for picture in data.pictures:
+        if picture.model == 1 and any(i is None for i in [picture.plateColor, picture.plateNumber, picture.confidence]):
             return return_success_response(message="模式为硬识别时，plateColor、plateNumber和confidence三个参数必填")
-
-    # 获取图片数据
-    if inner_pic:  # 如果有内置图片，尝试获取，忽略自定义上传图片参数
-        image_bytes = get_inner_picture(inner_pic)
+        image_bytes = get_inner_picture(picture.innerPic)
         if image_bytes is None:
-            return return_success_response(message=f"无法找到内置图片: {inner_pic}")
-    else:
-        image_bytes = await image.read()  # 如果没有指定内置图片，将上传的文件转换为二进制数据
-
+            return return_success_response(message=f"无法找到内置图片: {picture.innerPic}")
+        link_profile = parking_camera.link_profile.merge(picture.chunkSize, picture.chunkGapMs, picture.bandwidth)
+        uploads.append((picture, image_bytes, link_profile))
+
+    futures = [
+        parking_camera.submit_picture_upload(
+            picture.parkNum, io.BytesIO(image_bytes), len(image_bytes), picture.model,
+            picture.plateColor, picture.plateNumber, picture.confidence, link_profile
+        )
+        for picture, image_bytes, link_profile in uploads
+    ]
+
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append({"error": str(e)})
+    logger.info(f"车位相机批量上传图片完成，共{len(results)}张")
+    return return_success_response(message=f"车位相机批量上传图片完成，共{len(results)}张", data=results)
+
+
+@parking_camera_router.get("/uploadStats", summary="查询图片上传统计")
+@handle_exceptions(model_name="车位相机相关接口")
+def upload_stats():
+    """查询图片上传调度器的队列长度、成功失败数量和上传耗时分布"""
     parking_camera = get_parking_camera()
-    parking_camera.upload_picture(park_num, image_bytes, model, plate_color, plate_number, confidence)
-    logger.info(f"车位相机{park_num}号车位成功上报车位图片")
-    return return_success_response(message=f"车位相机{park_num}号车位成功上报车位图片")
+    return return_success_response(data=parking_camera.upload_scheduler.get_stats())
@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/25 10:00
+# @Author  : Heshouyi
+# @File    : __init__.py
+# @Software: PyCharm
+# @description:
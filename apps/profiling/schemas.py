@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/25 10:00
+# @Author  : Heshouyi
+# @File    : schemas.py
+# @Software: PyCharm
+# @description:
+from enum import Enum
+
+from pydantic import BaseModel, confloat, conint, field_validator
+
+
+# 枚举类
+class TracemallocAction(Enum):
+    """tracemalloc操作"""
+    START = "start"
+    BASELINE = "baseline"
+    DIFF = "diff"
+    STOP = "stop"
+
+
+# 数据模型
+class ProfileModel(BaseModel):
+    """采样剖析数据模型，seconds为采样时长，interval为采样间隔，单位均为秒"""
+    seconds: conint(ge=1, le=300) = 10
+    interval: confloat(ge=0.001, le=1) = 0.005
+
+
+class TracemallocModel(BaseModel):
+    """tracemalloc数据模型，frames只在start时生效"""
+    action: TracemallocAction
+    limit: conint(ge=1, le=1000) = 20
+    frames: conint(ge=1, le=64) = 1
+
+    @field_validator("action")
+    @classmethod
+    def transform_action(cls, v: TracemallocAction):
+        """转换字段成员对象为真实值，方便后续使用"""
+        return v.value
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/25 10:00
+# @Author  : Heshouyi
+# @File    : urls.py
+# @Software: PyCharm
+# @description: 运行中引擎的剖析接口：采样剖析、线程栈、tracemalloc和事件循环延迟，主进程和各工作进程同时执行
+
+from fastapi import APIRouter
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
+from core.device_manager import DeviceManager
+from core.util import handle_exceptions, return_success_response
+from .schemas import ProfileModel, TracemallocModel
+
+# 创建路由
+profiling_router = APIRouter()
+# handle_exceptions把路由包装为协程，同步执行的诊断会占住接口的事件循环，诊断都放到线程池中执行
+
+
+# API 路由
+@profiling_router.post("/profile", summary="采样剖析", response_class=PlainTextResponse)
+@handle_exceptions(model_name="剖析相关接口")
+async def profile(data: ProfileModel):
+    """
+    在主进程和所有工作进程中按interval采样所有线程的调用栈，持续seconds秒后返回
+    返回折叠栈文本，每行为“进程;线程;外层函数;...;内层函数 采样次数”，可直接输入flamegraph.pl或speedscope
+    """
+    results = await run_in_threadpool(DeviceManager.run_diagnostic, "profile", extra_timeout=data.seconds,
+                                      seconds=data.seconds, interval=data.interval)
+    lines = [f"{process};{stack} {count}"
+             for process, counts in results.items()
+             for stack, count in sorted(counts.items(), key=lambda item: -item[1])]
+    return PlainTextResponse("\n".join(lines) + "\n")
+
+
+@profiling_router.get("/threads", summary="查询所有线程的调用栈")
+@handle_exceptions(model_name="剖析相关接口")
+async def get_threads():
+    """返回主进程和各工作进程中所有线程的名称和当前调用栈，按源IP命名的线程附带使用该IP的设备"""
+    results = await run_in_threadpool(DeviceManager.run_diagnostic, "threads")
+    labels = DeviceManager.get_device_labels()
+    for threads in results.values():
+        for thread in threads:
+            thread["devices"] = labels.get(thread["device"], []) if thread["device"] else []
+    return return_success_response(data=results)
+
+
+@profiling_router.post("/tracemalloc", summary="tracemalloc内存快照")
+@handle_exceptions(model_name="剖析相关接口")
+async def trace_memory(data: TracemallocModel):
+    """
+    在主进程和各工作进程中执行tracemalloc操作
+    start：开始跟踪 baseline：保存基准快照 diff：返回相对基准增长最多的分配位置（无基准时返回占用最多的位置） stop：停止跟踪
+    跟踪期间进程明显变慢，排查完应stop
+    """
+    results = await run_in_threadpool(DeviceManager.run_diagnostic, "tracemalloc", action=data.action,
+                                      limit=data.limit, frames=data.frames)
+    return return_success_response(data=results)
+
+
+@profiling_router.get("/loop_lag", summary="查询事件循环延迟")
+@handle_exceptions(model_name="剖析相关接口")
+async def get_loop_lag():
+    """测量主进程和各工作进程共用事件循环的调度延迟，单位为毫秒，延迟大说明心跳、重连等定时任务被推迟"""
+    return return_success_response(data=await run_in_threadpool(DeviceManager.run_diagnostic, "loop_lag"))
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/22 16:00
+# @Author  : Heshouyi
+# @File    : urls.py
+# @Software: PyCharm
+# @description: Prometheus文本格式的设备收发和协议指标接口，以及心跳往返时延统计接口
+
+from fastapi import APIRouter
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
+from core.device_manager import DeviceManager
+from core.util import handle_exceptions, return_success_response
+
+# 创建路由
+prometheus_router = APIRouter()
+
+
+# API 路由
+@prometheus_router.get("/metrics", summary="Prometheus指标", response_class=PlainTextResponse)
+@handle_exceptions(model_name="监控指标相关接口")
+async def get_metrics():
+    """
+    按设备类型（开启per_device时按单台设备）输出建连、重连、按命令码的收发包数和字节数、发送失败次数、
+    注册/心跳/图片头包的确认时延直方图，以及断线缓冲区和发送队列深度；
+    各进程（main、worker<编号>）的事件循环调度延迟、线程数、RSS、GC暂停，以及按设备类型抽样估算的单台设备内存占用
+    """
+    text = await run_in_threadpool(DeviceManager.render_telemetry)     # 等待工作进程返回快照时不占用接口的事件循环
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@prometheus_router.get("/heartbeats", summary="查询心跳往返时延")
+@handle_exceptions(model_name="监控指标相关接口")
+async def get_heartbeats():
+    """
+    按设备类型返回心跳的发送、返回、丢失、无法匹配和等待中的次数，
+    以及启动以来和各滑动窗口内往返时延的p50、p99、p999和最大值，单位为毫秒
+    """
+    return return_success_response(message="查询心跳往返时延成功", data=await run_in_threadpool(DeviceManager.get_heartbeat_stats))
@@ -10,6 +10,7 @@ from fastapi import APIRouter, Request
 from core.util import handle_exceptions
 from .schemas import GetHistoryReportModel
 from core.logger import logger
+from core.report_correlation import report_correlation
 from core.util import return_success_response
 from .services import FindcarReportService
 
@@ -28,6 +29,7 @@ async def findcar_field_report(request: Request):
     """接收服务器发来的单车场上报数据，存库后格式化返回"""
     message = await request.json()  # 获取所有json数据
     logger.info(f"接收到寻车单车场上报数据 {message}")
+    report_correlation.match(message)   # 关联发出的设备事件，统计端到端时延
     # 数据入库
     findcar_report_service = get_findcar_report_service()
     await findcar_report_service.store_received_message(1, message)
@@ -40,6 +42,7 @@ async def findcar_unified_report(request: Request):
     """接收服务器发来的统一平台上报数据，存库后格式化返回"""
     message = await request.json()
     logger.info(f"接收到寻车统一平台上报数据 {message}")
+    report_correlation.match(message)
     # 数据入库
     findcar_report_service = get_findcar_report_service()
     await findcar_report_service.store_received_message(2, message)
@@ -58,3 +61,13 @@ async def get_history_report(data: GetHistoryReportModel):
     result = await findcar_report_service.get_db_history_report(page_no, page_size, source)
     logger.info(f"寻车上报服务查询历史记录成功，返回结果：{result}")
     return return_success_response(data=result)
+
+
+@receive_report_router.get('/latency', summary="查询事件到上报的端到端时延")
+@handle_exceptions(model_name="寻车上报相关接口")
+def get_report_latency():
+    """
+    按事件类型返回已发送、已匹配上报、超时未收到上报（缺失）、上报找不到对应事件和等待中的事件数，
+    以及设备发出事件到收到平台上报的时延分位数，单位为毫秒
+    """
+    return return_success_response(data=report_correlation.get_stats())
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/19 16:40
+# @Author  : Heshouyi
+# @File    : schemas.py
+# @Software: PyCharm
+# @description:
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel, confloat, field_validator, model_validator
+
+
+# 枚举类
+class RateLimitScope(Enum):
+    """限速级别，global：全局；port：服务器端口；device：单台设备"""
+    GLOBAL = "global"
+    PORT = "port"
+    DEVICE = "device"
+
+
+# 数据模型
+class SetRateLimitModel(BaseModel):
+    """调整发送限速数据模型，速率为0表示不限速"""
+    scope: RateLimitScope
+    target: Optional[str] = None    # scope为port时为服务器端口，为device时为设备IP
+    packetsPerSecond: confloat(ge=0) = 0
+    bytesPerSecond: confloat(ge=0) = 0
+
+    @field_validator("scope")
+    @classmethod
+    def transform_scope(cls, v: RateLimitScope):
+        """转换字段成员对象为真实值，方便后续使用"""
+        return v.value
+
+    @model_validator(mode="after")
+    def check_target(self):
+        """端口和设备级别必须指定限速对象，端口需为数字"""
+        if self.scope in ("port", "device") and not self.target:
+            raise ValueError("端口和设备级别的限速必须指定target")
+        if self.scope == "port" and not self.target.isdigit():
+            raise ValueError("端口级别的target必须为端口号")
+        return self
+
+if __name__ == '__main__':
+    pass
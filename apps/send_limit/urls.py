@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/19 16:40
+# @Author  : Heshouyi
+# @File    : urls.py
+# @Software: PyCharm
+# @description: 设备发送限速的查询和运行时调整接口
+
+from fastapi import APIRouter
+from core.logger import logger
+from .schemas import SetRateLimitModel
+from core.connections.send_limiter import send_rate_limiter
+from core.util import handle_exceptions, return_success_response
+
+# 创建路由
+send_limit_router = APIRouter()
+
+
+# API 路由
+@send_limit_router.get("/rateLimits", summary="查询发送限速")
+@handle_exceptions(model_name="发送限速相关接口")
+def get_rate_limits():
+    """查询全局、各服务器端口和单独限速设备的设定速率，以及本次设定以来的实测速率"""
+    return return_success_response(data=send_rate_limiter.get_stats())
+
+
+@send_limit_router.post("/setRateLimit", summary="调整发送限速")
+@handle_exceptions(model_name="发送限速相关接口")
+def set_rate_limit(data: SetRateLimitModel):
+    """
+    运行时调整某一级的包速率和字节速率，立即生效，速率为0表示不限速
+    用于按阶梯逐级加压，调整后该级的实测速率重新开始统计
+    """
+    send_rate_limiter.set_rate(data.scope, data.target, data.packetsPerSecond, data.bytesPerSecond)
+    logger.info(f"发送限速已调整，级别：{data.scope}，对象：{data.target}，"
+                f"包速率：{data.packetsPerSecond}，字节速率：{data.bytesPerSecond}")
+    return return_success_response(message="成功调整发送限速")
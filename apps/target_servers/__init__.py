@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/20 15:40
+# @Author  : Heshouyi
+# @File    : __init__.py
+# @Software: PyCharm
+# @description:
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/20 15:40
+# @Author  : Heshouyi
+# @File    : urls.py
+# @Software: PyCharm
+# @description: 目标服务器的可用状态、连接数和发送量查询接口
+
+from fastapi import APIRouter
+from core.connections.target_pool import target_pool
+from core.util import handle_exceptions, return_success_response
+
+# 创建路由
+target_servers_router = APIRouter()
+
+
+# API 路由
+@target_servers_router.get("/targets", summary="查询目标服务器状态")
+@handle_exceptions(model_name="目标服务器相关接口")
+def get_targets():
+    """查询各协议端口上每个目标服务器的可用状态、当前连接数和累计发送的包数、字节数"""
+    return return_success_response(data=target_pool.get_stats())
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/26 10:00
+# @Author  : Heshouyi
+# @File    : schemas.py
+# @Software: PyCharm
+# @description:
+from typing import Optional
+
+from pydantic import BaseModel, confloat, conint
+
+
+# 数据模型
+class TracingConfigModel(BaseModel):
+    """追踪配置数据模型，为空的字段保持不变，clear为True时清空已记录的事件"""
+    enabled: Optional[bool] = None
+    sampleRate: Optional[confloat(ge=0, le=1)] = None
+    clear: bool = False
+
+
+class TraceQueryModel(BaseModel):
+    """追踪查询数据模型，traceId为响应头X-Trace-Id中的调用编号，minDurationMs为根跨度的最小耗时，limit为每个进程最多返回的调用数"""
+    traceId: Optional[str] = None
+    minDurationMs: Optional[confloat(ge=0)] = None
+    limit: Optional[conint(ge=1, le=10000)] = None
+
+
+if __name__ == '__main__':
+    pass
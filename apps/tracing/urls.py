@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/26 10:00
+# @Author  : Heshouyi
+# @File    : urls.py
+# @Software: PyCharm
+# @description: 调用链追踪的开关、查询和导出接口，查询结果为Chrome Trace Event格式，可直接导入chrome://tracing或Perfetto
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from core.device_manager import DeviceManager
+from core.tracing import trace_document, tracer
+from core.util import handle_exceptions, return_success_response
+from .schemas import TraceQueryModel, TracingConfigModel
+
+# 创建路由
+tracing_router = APIRouter()
+
+
+# API 路由
+@tracing_router.get("/status", summary="查询追踪状态")
+@handle_exceptions(model_name="追踪相关接口")
+def get_status():
+    """返回主进程和各工作进程是否开启追踪、采样比例和已记录的事件数"""
+    return return_success_response(data=DeviceManager.run_diagnostic("tracing"))
+
+
+@tracing_router.post("/config", summary="调整追踪配置")
+@handle_exceptions(model_name="追踪相关接口")
+def configure(data: TracingConfigModel):
+    """
+    在主进程和各工作进程中开关追踪、调整采样比例或清空已记录的事件
+    采样比例只影响未带X-Trace: 1请求头的接口调用，带该请求头的调用只要开启追踪就记录
+    """
+    results = DeviceManager.run_diagnostic("tracing", enabled=data.enabled, sample_rate=data.sampleRate,
+                                           clear=data.clear)
+    return return_success_response(message="调整追踪配置成功", data=results)
+
+
+@tracing_router.post("/query", summary="查询追踪事件")
+@handle_exceptions(model_name="追踪相关接口")
+def query_trace(data: TraceQueryModel):
+    """
+    按调用编号、根跨度的最小耗时和调用数筛选主进程和各工作进程记录的事件，条件都为空时返回全部
+    返回Chrome Trace Event格式的JSON，每次调用显示为一行，排队、等待确认等与其他跨度交错的时间段显示为异步事件
+    """
+    events = DeviceManager.collect_trace(data.traceId, data.minDurationMs, data.limit)
+    return JSONResponse(trace_document(events))
+
+
+@tracing_router.post("/export", summary="导出追踪事件到文件")
+@handle_exceptions(model_name="追踪相关接口")
+def export_trace(data: TraceQueryModel):
+    """按与查询相同的条件把事件写入日志目录下trace目录中的JSON文件，返回文件路径"""
+    events = DeviceManager.collect_trace(data.traceId, data.minDurationMs, data.limit)
+    path = tracer.export(events)
+    return return_success_response(message="导出追踪事件成功", data={"path": path, "eventCount": len(events)})
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/22 10:00
+# @Author  : Heshouyi
+# @File    : cluster.py
+# @Software: PyCharm
+# @description: 多机分布式压测，协调器把批量设备拆成分片分配给各代理，代理在自己的主机上创建设备并定期上报计数表
+
+import argparse
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+from core.configer import config
+from core.fleet_workers import FLEET_COMMANDS
+from core.logger import logger
+from core.metrics_table import SLOT_WIDTH, aggregate_rows, apply_slots, changed_slots, rows_from_snapshot
+
+# 控制通道基于multiprocessing.connection，收发的消息都会被反序列化，能通过认证的一方即可在对端执行任意代码
+# 因此只能在可信网络中使用，认证密钥不写入仓库中的配置文件，从环境变量或本机的密钥文件读取
+AUTHKEY_ENV = "FINDCAR_CLUSTER_AUTHKEY"
+SHIPPED_AUTHKEYS = ("findcar-automation",)  # 曾随仓库发布过的密钥，视为已公开
+
+
+def resolve_authkey(cluster_config):
+    """按 环境变量 > authkey_file指向的本机文件 > 配置中的authkey 的顺序读取认证密钥"""
+    cluster_config = cluster_config or {}
+    authkey = os.environ.get(AUTHKEY_ENV)
+    if not authkey and cluster_config.get("authkey_file"):
+        with open(cluster_config["authkey_file"], encoding="utf-8") as file:
+            authkey = file.read().strip()
+    return authkey or cluster_config.get("authkey") or ""
+
+
+def check_authkey(authkey):
+    """密钥为空或仍是公开过的值时拒绝启动协调器或代理"""
+    if not authkey or authkey in SHIPPED_AUTHKEYS:
+        raise Exception(f"集群控制通道的认证密钥未设置或为公开的默认值，"
+                        f"请通过环境变量{AUTHKEY_ENV}或cluster.authkey_file设置本机的密钥")
+    return authkey.encode()
+
+
+def split_fleet(fleet_configs, slice_count):
+    """
+    把fleet配置中各设备类型的数量均分为slice_count个分片，每个分片内的设备序号连续且全局唯一
+    :return: [{设备类型: {cidr, count, max_devices_per_ip, first_index}}, ...]
+    """
+    slices = [{} for _ in range(max(1, slice_count))]
+    for device_type, fleet_config in (fleet_configs or {}).items():
+        count = fleet_config.get("count", 0)
+        first_index = 1
+        for slice_id, fleet_slice in enumerate(slices):
+            slice_count_of_type = count // len(slices) + (1 if slice_id < count % len(slices) else 0)
+            if slice_count_of_type:
+                fleet_slice[device_type] = {
+                    "cidr": fleet_config["cidr"],
+                    "count": slice_count_of_type,
+                    "max_devices_per_ip": fleet_config.get("max_devices_per_ip", 0),
+                    "first_index": first_index,
+                }
+            first_index += slice_count_of_type
+    return slices
+
+
+class AgentHandle:
+    """协调器中一个代理的连接和状态"""
+
+    def __init__(self, agent_id, conn, address, slice_id):
+        self.agent_id = agent_id
+        self.conn = conn
+        self.address = address
+        self.slice_id = slice_id    # 领取的分片
+        self.send_lock = threading.Lock()
+        self.pending = {}           # 指令编号 -> Future
+        self.devices = []           # 代理上报的 [(设备类型, 设备序号, 源IP), ...]，与计数表的槽顺序一致
+        self.summaries = []         # 代理分配源IP的汇总
+        self.stats = bytearray()    # 按代理的上报合并出的完整计数表原始字节
+        self.stats_time = None
+        self.alive = True
+
+
+class ClusterCoordinator:
+    """
+    集群协调器，在控制端口上等待代理注册，每个代理领取一个未被占用的分片
+    控制端口默认只监听本机，跨主机使用时只能监听可信网络中的地址，见AUTHKEY_ENV处的说明
+    代理断开后其分片释放，下一个注册的代理接替；接口层对批量设备的指令按设备序号转发到所在代理
+    代理首次上报整张计数表的原始字节，之后只上报有变化的设备槽，由协调器合并；协调器汇总时不向代理发送请求
+    """
+
+    def __init__(self, host="127.0.0.1", port=9099, authkey="", agents=1, fleet_configs=None, scenario=None,
+                 stats_interval=1, command_timeout=30):
+        self.address = (host, port)
+        self.authkey = check_authkey(authkey)
+        self.slices = split_fleet(fleet_configs, agents)
+        self.scenario = list(scenario or [])
+        self.stats_interval = stats_interval    # 代理上报计数表的间隔，单位为秒
+        self.command_timeout = command_timeout  # 等待代理返回指令结果的超时，单位为秒
+        self.lock = threading.Lock()
+        self.agents = {}            # 代理编号 -> AgentHandle，只保存在线的代理
+        self.owners = {}            # (设备类型, 设备序号) -> AgentHandle
+        self.request_ids = itertools.count(1)
+        self.listener = None
+
+    @classmethod
+    def from_config(cls, cluster_config, fleet_configs):
+        """从配置文件的cluster节点和fleet节点创建"""
+        cluster_config = cluster_config or {}
+        return cls(
+            host=cluster_config.get("host", "127.0.0.1"),
+            port=cluster_config.get("control_port", 9099),
+            authkey=resolve_authkey(cluster_config),
+            agents=cluster_config.get("agents", 1),
+            fleet_configs=fleet_configs,
+            scenario=cluster_config.get("scenario"),
+            stats_interval=cluster_config.get("stats_interval", 1),
+            command_timeout=cluster_config.get("command_timeout", 30),
+        )
+
+    def start(self):
+        self.listener = Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self.accept_agents, name="cluster-accept", daemon=True).start()
+        logger.info(f"集群协调器已在{self.address[0]}:{self.address[1]}上等待代理注册，共{len(self.slices)}个分片")
+
+    def accept_agents(self):
+        while self.listener:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                break   # 协调器已停止
+            except Exception as e:  # 认证失败等
+                logger.warning(f"代理连接被拒绝: {e}")
+                continue
+            threading.Thread(target=self.serve_agent, args=(conn, self.listener.last_accepted),
+                             name="cluster-agent", daemon=True).start()
+
+    def serve_agent(self, conn, address):
+        """处理一个代理的注册、状态上报和指令结果，代理断开后释放其分片"""
+        try:
+            _, agent_id = conn.recv()
+        except Exception as e:
+            logger.warning(f"代理{address}注册失败: {e}")
+            conn.close()
+            return
+        with self.lock:
+            used_slices = {agent.slice_id for agent in self.agents.values()}
+            free_slices = [slice_id for slice_id in range(len(self.slices)) if slice_id not in used_slices]
+            if agent_id in self.agents or not free_slices:
+                reason = f"代理编号{agent_id}已在线" if agent_id in self.agents else "没有未分配的分片"
+                agent = None
+            else:
+                agent = AgentHandle(agent_id, conn, address, free_slices[0])
+                self.agents[agent_id] = agent
+        if agent is None:
+            logger.warning(f"拒绝代理{agent_id}（{address}）注册: {reason}")
+            conn.send(("reject", reason))
+            conn.close()
+            return
+        conn.send(("assign", agent.slice_id, self.slices[agent.slice_id], self.scenario, self.stats_interval))
+        logger.info(f"代理{agent_id}（{address}）已注册，领取分片{agent.slice_id}: {self.slices[agent.slice_id]}")
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == "stats":
+                agent.stats, agent.stats_time = bytearray(message[1]), time.monotonic()
+            elif message[0] == "stats_delta":
+                _, indices, data = message
+                apply_slots(agent.stats, indices, data)
+                agent.stats_time = time.monotonic()
+            elif message[0] == "reply":
+                _, request_id, success, value = message
+                future = agent.pending.pop(request_id, None)
+                if future is None:
+                    continue    # 已超时放弃等待的指令
+                if success:
+                    future.set_result(value)
+                else:
+                    future.set_exception(Exception(value))
+            elif message[0] == "ready":
+                _, agent.devices, agent.summaries = message
+                with self.lock:
+                    for device_type, index, _ in agent.devices:
+                        self.owners[(device_type, index)] = agent
+                for summary in agent.summaries:
+                    if summary["shortfall"]:
+                        logger.error(f"代理{agent_id}的{summary['deviceType']}源IP不足，缺少{summary['shortfall']}台")
+                logger.info(f"代理{agent_id}已创建{len(agent.devices)}台批量设备")
+        agent.alive = False
+        with self.lock:
+            self.agents.pop(agent_id, None)
+            for device_type, index, _ in agent.devices:
+                if self.owners.get((device_type, index)) is agent:
+                    del self.owners[(device_type, index)]
+        for future in list(agent.pending.values()):
+            future.set_exception(Exception(f"代理{agent_id}已断开"))
+        agent.pending.clear()
+        if self.listener:
+            logger.error(f"代理{agent_id}已断开，分片{agent.slice_id}等待其他代理领取")
+
+    def has_device(self, device_type, index):
+        return (device_type, index) in self.owners
+
+    def call(self, device_type, index, command, kwargs=None):
+        """在设备所在的代理上执行设备方法，阻塞等待结果"""
+        if command not in FLEET_COMMANDS:
+            raise Exception(f"不支持转发给批量设备的指令: {command}")
+        agent = self.owners.get((device_type, index))
+        if agent is None or not agent.alive:
+            raise Exception(f"批量设备{device_type}第{index}台所在的代理不在线")
+        request_id = next(self.request_ids)
+        future = Future()
+        agent.pending[request_id] = future
+        with agent.send_lock:
+            agent.conn.send((request_id, device_type, index, command, kwargs or {}))
+        try:
+            return future.result(self.command_timeout)
+        finally:
+            agent.pending.pop(request_id, None)
+
+    def aggregate(self):
+        """按各代理最近一次上报的计数表汇总整个集群的批量设备，尚未上报的设备计数为0"""
+        devices, snapshot = self.snapshot()
+        return aggregate_rows(devices, rows_from_snapshot(snapshot))
+
+    def snapshot(self):
+        """
+        拼接各代理最近一次上报的计数表
+        :return: ([(设备类型, 设备序号, 源IP), ...], 与设备顺序一致的计数表原始字节)，尚未上报的设备计数为0
+        """
+        devices = []
+        chunks = []
+        for agent in list(self.agents.values()):
+            size = len(agent.devices) * SLOT_WIDTH * 8
+            devices.extend(agent.devices)
+            chunks.append(bytes(agent.stats[:size]).ljust(size, b"\x00"))
+        return devices, b"".join(chunks)
+
+    def get_stats(self):
+        now = time.monotonic()
+        return [
+            {
+                "agentId": agent.agent_id,
+                "address": f"{agent.address[0]}:{agent.address[1]}" if isinstance(agent.address, tuple)
+                else str(agent.address),
+                "sliceId": agent.slice_id,
+                "deviceCount": len(agent.devices),
+                "shortfall": sum(summary["shortfall"] for summary in agent.summaries),
+                "statsAge": round(now - agent.stats_time, 3) if agent.stats_time else None,
+                "pendingCommands": len(agent.pending),
+            }
+            for agent in sorted(list(self.agents.values()), key=lambda agent: agent.slice_id)
+        ]
+
+    def stop(self):
+        """通知所有代理注销设备并退出，停止接受新的代理"""
+        listener, self.listener = self.listener, None
+        for agent in list(self.agents.values()):
+            try:
+                with agent.send_lock:
+                    agent.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        if listener:
+            listener.close()
+
+
+class ClusterAgent:
+    """
+    集群代理，连接协调器领取分片后在本机按分片分配源IP并创建批量设备
+    之后每stats_interval秒上报一次计数表，并执行协调器转发的指令，直到协调器通知退出或断开
+    以无接口模式运行引擎：python -m core.cluster --agent-id agent-1 --coordinator 127.0.0.1:9099
+    """
+
+    def __init__(self, agent_id, coordinator_host="127.0.0.1", port=9099, authkey="", retry_interval=3,
+                 command_threads=8):
+        self.agent_id = agent_id
+        self.address = (coordinator_host, port)
+        self.authkey = check_authkey(authkey)
+        self.retry_interval = retry_interval    # 协调器不可用时的重试间隔，单位为秒
+        self.command_threads = command_threads
+        self.conn = None
+        self.send_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    @classmethod
+    def from_config(cls, agent_id, cluster_config):
+        cluster_config = cluster_config or {}
+        return cls(
+            agent_id,
+            coordinator_host=cluster_config.get("coordinator_host", "127.0.0.1"),
+            port=cluster_config.get("control_port", 9099),
+            authkey=resolve_authkey(cluster_config),
+            retry_interval=cluster_config.get("retry_interval", 3),
+            command_threads=(config.get("fleet_workers") or {}).get("command_threads", 8),
+        )
+
+    def connect(self):
+        """连接协调器，协调器未启动时按retry_interval重试"""
+        while True:
+            try:
+                return Client(self.address, authkey=self.authkey)
+            except ConnectionRefusedError:
+                logger.info(f"协调器{self.address[0]}:{self.address[1]}不可用，{self.retry_interval}秒后重试")
+                time.sleep(self.retry_interval)
+
+    def run(self):
+        from core.device_manager import DeviceManager   # 代理进程中才导入设备服务，协调器导入本模块时不产生循环依赖
+        from core.events import get_all_local_ips
+        from core.ip_pool import SourceIPPool
+        self.conn = self.connect()
+        self.conn.send(("register", self.agent_id))
+        message = self.conn.recv()
+        if message[0] == "reject":
+            raise Exception(f"协调器拒绝代理{self.agent_id}注册: {message[1]}")
+        _, slice_id, fleet_slice, scenario, stats_interval = message
+        logger.info(f"代理{self.agent_id}领取分片{slice_id}: {fleet_slice}")
+
+        plan, summaries = DeviceManager.plan_fleet(SourceIPPool(get_all_local_ips()), fleet_slice)
+        SourceIPPool.log_summary(summaries)
+        DeviceManager.initialize_fleet(plan, {device_type: fleet_config["first_index"]
+                                              for device_type, fleet_config in fleet_slice.items()})
+        self.conn.send(("ready", DeviceManager.fleet_devices, summaries))
+        threading.Thread(target=self.report_stats, args=(DeviceManager, stats_interval), name="cluster-stats",
+                         daemon=True).start()
+
+        executor = ThreadPoolExecutor(max_workers=self.command_threads, thread_name_prefix="cluster-command")
+        executor.submit(self.run_scenario, DeviceManager, scenario)
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                logger.error(f"代理{self.agent_id}与协调器断开")
+                break
+            if message is None:
+                logger.info(f"协调器通知代理{self.agent_id}退出")
+                break
+            executor.submit(self.execute, DeviceManager, *message)
+        self.stopped.set()
+        executor.shutdown(wait=False)
+        DeviceManager.shutdown_all_devices()
+        self.conn.close()
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+    def execute(self, device_manager, request_id, device_type, index, command, kwargs):
+        try:
+            reply = ("reply", request_id, True, device_manager.execute_fleet_command(device_type, index, command, kwargs))
+        except Exception as e:
+            reply = ("reply", request_id, False, str(e))
+        try:
+            self.send(reply)
+        except (OSError, ValueError):
+            pass    # 协调器已断开
+        except Exception as e:  # 返回值无法序列化等
+            self.send(("reply", request_id, False, f"指令执行结果无法返回协调器: {e}"))
+
+    def run_scenario(self, device_manager, scenario):
+        """对分片内每台对应类型的设备依次执行场景中的指令"""
+        for step in scenario:
+            for device_type, index, _ in device_manager.fleet_devices:
+                if device_type != step["device_type"]:
+                    continue
+                try:
+                    device_manager.execute_fleet_command(device_type, index, step["command"], step.get("params"))
+                except Exception as e:
+                    logger.error(f"代理{self.agent_id}对{device_type}第{index}台执行场景指令{step['command']}失败: {e}")
+            logger.info(f"代理{self.agent_id}已执行场景指令{step['command']}")
+
+    def report_stats(self, device_manager, stats_interval):
+        """
+        定期上报计数表，首次上报整张表，之后只上报有变化的设备槽
+        变化的设备超过一半时整张表更小，直接上报整张表；没有变化时也上报空的变化，协调器据此判断上报是否及时
+        """
+        previous = b""
+        while not self.stopped.wait(stats_interval):
+            metrics = device_manager.fleet_metrics
+            if metrics is None:
+                continue
+            snapshot = metrics.snapshot()
+            delta = changed_slots(previous, snapshot)
+            if delta is None or len(delta[0]) * 2 > len(snapshot) // (SLOT_WIDTH * 8):
+                message = ("stats", snapshot)
+            else:
+                message = ("stats_delta", *delta)
+            try:
+                self.send(message)
+            except (OSError, ValueError):
+                break
+            previous = snapshot
+
+
+if __name__ == "__main__":
+    cluster_config = config.get("cluster") or {}
+    parser = argparse.ArgumentParser(description="以集群代理模式运行引擎，只运行协调器分配的批量设备，不提供接口")
+    parser.add_argument("--agent-id", required=True, help="代理编号，集群内唯一")
+    parser.add_argument("--coordinator", default=f"{cluster_config.get('coordinator_host', '127.0.0.1')}:"
+                                                 f"{cluster_config.get('control_port', 9099)}",
+                        help="协调器的控制地址，如 127.0.0.1:9099")
+    args = parser.parse_args()
+    coordinator_host, coordinator_port = args.coordinator.rsplit(":", 1)
+    agent_config = dict(cluster_config, coordinator_host=coordinator_host, control_port=int(coordinator_port))
+    ClusterAgent.from_config(args.agent_id, agent_config).run()
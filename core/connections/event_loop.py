@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/17 09:40
+# @Author  : Heshouyi
+# @File    : event_loop.py
+# @Software: PyCharm
+# @description: 异步设备连接共用的事件循环，在独立线程中运行，业务层的同步接口通过线程安全的方式提交任务
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from core.configer import config
+from core.logger import logger
+
+SEND_THREADS = (config.get("transport") or {}).get("send_threads", 8)     # 执行阻塞发送的线程数
+
+
+class SharedEventLoop:
+    """
+    所有异步设备连接共用一个事件循环线程
+    连接、收发和定时心跳都在这个线程上执行，设备数量增加时不再增加线程
+    TCP设备的套接字发送是阻塞的，在固定线程数的发送线程池中执行，不占用事件循环
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.executor = None            # 发送线程池，首次使用时创建
+        self.lock = threading.Lock()
+        self.background_tasks = set()   # 回调产生的协程任务，持有引用避免执行中被回收
+        self.app_loop = None            # 接口所在的事件循环，主进程的Tortoise连接在这个循环上建立
+
+    def get_loop(self):
+        """获取事件循环，首次调用时启动事件循环线程"""
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, name="device-event-loop", daemon=True)
+                self.thread.start()
+        return self.loop
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=SEND_THREADS, thread_name_prefix="device-send")
+        return self.executor
+
+    def run_blocking(self, func, *args):
+        """在发送线程池中执行阻塞调用，返回可在事件循环中await的Future，需在事件循环线程中调用"""
+        executor = self.get_executor()
+        return self.get_loop().run_in_executor(executor, func, *args)
+
+    def in_loop_thread(self):
+        return self.thread is threading.current_thread()
+
+    def run(self, coro, timeout=None):
+        """在事件循环中执行协程，阻塞等待结果，供同步代码调用"""
+        if self.in_loop_thread():
+            raise RuntimeError("不能在事件循环线程中同步等待协程执行结果")
+        return asyncio.run_coroutine_threadsafe(coro, self.get_loop()).result(timeout)
+
+    def call_soon(self, callback, *args):
+        """在事件循环线程中执行回调，当前已在事件循环线程时直接执行"""
+        if self.in_loop_thread():
+            callback(*args)
+        else:
+            self.get_loop().call_soon_threadsafe(callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        """延迟delay秒后在事件循环线程中执行回调，可在任意线程调用"""
+        if self.in_loop_thread():
+            self.loop.call_later(delay, callback, *args)
+        else:
+            self.get_loop().call_soon_threadsafe(self.loop.call_later, delay, callback, *args)
+
+    def spawn(self, coro):
+        """在事件循环中启动协程任务，不等待结果，需在事件循环线程中调用"""
+        task = self.get_loop().create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.on_task_done)
+        return task
+
+    def set_app_loop(self, loop):
+        """设置接口所在的事件循环，设置后业务层回调产生的协程交给这个循环执行，传None时恢复在共用事件循环中执行"""
+        self.app_loop = loop
+
+    def spawn_callback(self, coro):
+        """
+        执行业务层回调产生的协程（如LED网络屏写数据库），可在任意线程调用
+        主进程中交回接口所在的事件循环，与register_tortoise建立的数据库连接在同一个循环，避免跨循环使用连接；
+        工作进程没有接口事件循环，在共用事件循环中执行，数据库由工作进程在这个循环上单独初始化
+        """
+        app_loop = self.app_loop
+        if app_loop is not None and not app_loop.is_closed():
+            future = asyncio.run_coroutine_threadsafe(coro, app_loop)
+            future.add_done_callback(self.on_task_done)
+        else:
+            self.call_soon(self.spawn, coro)
+
+    def on_task_done(self, task):
+        self.background_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"事件循环中的任务执行失败: {task.exception()}")
+
+
+class PeriodicTask:
+    """
+    事件循环上的周期任务，如心跳，每个任务只占用一个定时句柄，不单独占用线程
+    start和cancel可在任意线程调用，回调在事件循环线程中执行；
+    blocking为True时回调在发送线程池中执行，执行完成后才开始计算下一次的间隔
+    """
+
+    def __init__(self, interval, callback, blocking=False):
+        """:param blocking: 回调中是否有阻塞操作，如TCP套接字发送、限速等待"""
+        self.interval = interval    # 执行间隔，单位为秒
+        self.callback = callback
+        self.blocking = blocking
+        self.handle = None          # 下一次执行的定时句柄
+        self.active = False
+        self.generation = 0         # 每次start/cancel加1，线程池中的回调完成时任务已重启或取消则不再续期
+
+    def start(self, first_delay=0):
+        """开始周期执行，first_delay为首次执行前的等待时间"""
+        self.active = True
+        shared_event_loop.call_soon(self.restart, first_delay)
+
+    def cancel(self):
+        self.active = False
+        shared_event_loop.call_soon(self.restart, None)
+
+    def restart(self, delay):
+        self.generation += 1
+        if delay is None:
+            self.disarm()
+        else:
+            self.arm(delay)
+
+    def arm(self, delay):
+        self.disarm()
+        if self.active:
+            self.handle = shared_event_loop.get_loop().call_later(delay, self.fire)
+
+    def disarm(self):
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
+
+    def fire(self):
+        self.handle = None
+        if not self.active:
+            return
+        if not self.blocking:
+            self.run_callback()
+            self.arm(self.interval)
+            return
+        generation = self.generation
+        future = shared_event_loop.run_blocking(self.run_callback)
+        future.add_done_callback(lambda _: self.generation == generation and self.arm(self.interval))
+
+    def run_callback(self):
+        try:
+            self.callback()
+        except Exception as e:
+            logger.exception(f"周期任务执行失败: {e}")
+
+
+shared_event_loop = SharedEventLoop()
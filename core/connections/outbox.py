@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/19 10:30
+# @Author  : Heshouyi
+# @File    : outbox.py
+# @Software: PyCharm
+# @description: 设备断线期间的事件缓冲区，恢复会话后按限定速率补发，模拟真实设备的存储转发
+
+import asyncio
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from core.logger import logger
+from core.rate_limiter import TokenBucket
+
+
+class Outbox:
+    """
+    单台设备的事件缓冲区，按条数和存放时长限制容量
+    drop_policy 决定缓冲区满时的处理方式：
+        oldest：丢弃最早的事件，保留最新的
+        newest：丢弃新到的事件，保留最早的
+        coalesce：带key的事件只保留同一key的最新一条（如每个车位的最新状态），满时再丢弃最早的事件
+    """
+
+    DROP_POLICIES = ("oldest", "newest", "coalesce")
+
+    def __init__(self, max_size=1000, max_age=3600, drop_policy="coalesce", flush_rate=20):
+        """
+        :param max_size: 最多缓存的事件条数
+        :param max_age: 事件最长存放时间，单位为秒，超过后丢弃，0表示不限
+        :param drop_policy: 缓冲区满时的丢弃策略
+        :param flush_rate: 恢复会话后补发的速率，单位为包/秒，0表示不限速
+        """
+        if drop_policy not in self.DROP_POLICIES:
+            raise ValueError(f"缓冲区丢弃策略只支持{self.DROP_POLICIES}，实际为: {drop_policy}")
+        self.max_size = max_size
+        self.max_age = max_age
+        self.drop_policy = drop_policy
+        self.flush_rate = flush_rate
+        self.entries = OrderedDict()    # key -> (数据, 入队时间)，不合并的事件用自增序号作为key
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.flushing = False           # 是否正在补发
+        self.stats = {"buffered": 0, "flushed": 0, "droppedOldest": 0, "droppedNewest": 0, "coalesced": 0,
+                      "expired": 0}
+
+    @classmethod
+    def from_config(cls, outbox_config):
+        """从配置文件的outbox节点创建，缺省项使用默认值"""
+        outbox_config = outbox_config or {}
+        return cls(
+            max_size=outbox_config.get("max_size", 1000),
+            max_age=outbox_config.get("max_age", 3600),
+            drop_policy=outbox_config.get("drop_policy", "coalesce"),
+            flush_rate=outbox_config.get("flush_rate", 20),
+        )
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, data, key=None):
+        """缓存一个事件，返回是否被缓存"""
+        with self.lock:
+            self.expire()
+            if key is not None and self.drop_policy == "coalesce" and ("key", key) in self.entries:
+                del self.entries[("key", key)]  # 同一key只保留最新一条，新事件排到队尾
+                self.stats["coalesced"] += 1
+            elif len(self.entries) >= self.max_size:
+                if self.drop_policy == "newest":
+                    self.stats["droppedNewest"] += 1
+                    return False
+                self.entries.popitem(last=False)
+                self.stats["droppedOldest"] += 1
+            entry_key = ("key", key) if key is not None and self.drop_policy == "coalesce" else next(self.counter)
+            self.entries[entry_key] = (data, time.monotonic())
+            self.stats["buffered"] += 1
+            return True
+
+    def expire(self):
+        """丢弃超过存放时长的事件，调用方需持有锁"""
+        if not self.max_age:
+            return
+        deadline = time.monotonic() - self.max_age
+        while self.entries:
+            _, (_, enqueue_time) = next(iter(self.entries.items()))
+            if enqueue_time >= deadline:
+                break
+            self.entries.popitem(last=False)
+            self.stats["expired"] += 1
+
+    def begin_flush(self):
+        """标记开始补发，已在补发或没有事件时返回False，保证同一时间只有一个补发任务"""
+        with self.lock:
+            if self.flushing or not self.entries:
+                return False
+            self.flushing = True
+            return True
+
+    def pop(self):
+        """取出最早的事件，没有时在锁内结束补发状态并返回None，避免与新事件入队交错导致事件滞留"""
+        with self.lock:
+            self.expire()
+            if not self.entries:
+                self.flushing = False
+                return None
+            return self.entries.popitem(last=False)
+
+    def push_back_front(self, entry_key, entry):
+        """补发失败时把事件放回队首并结束补发，同一key在此期间已有更新的事件时不再放回"""
+        with self.lock:
+            self.flushing = False
+            if entry_key in self.entries:
+                self.stats["coalesced"] += 1
+                return
+            self.entries[entry_key] = entry
+            self.entries.move_to_end(entry_key, last=False)
+
+    async def flush(self, send):
+        """
+        按flush_rate补发缓存的事件，在共用事件循环中执行
+        :param send: 发送协程函数，返回False表示连接已断开，此时停止补发，未发出的事件留待下次恢复
+        """
+        limiter = TokenBucket(self.flush_rate, capacity=1)
+        flushed = 0
+        while True:
+            item = self.pop()
+            if item is None:
+                break
+            entry_key, entry = item
+            try:
+                wait = limiter.reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                sent = await send(entry[0])
+            except BaseException:
+                self.push_back_front(entry_key, entry)
+                raise
+            if not sent:
+                self.push_back_front(entry_key, entry)
+                break
+            flushed += 1
+            self.stats["flushed"] += 1
+        if flushed:
+            logger.info(f"断线期间缓存的事件补发{flushed}条，剩余{len(self.entries)}条")
+
+    def get_stats(self):
+        return {**self.stats, "pending": len(self.entries), "dropPolicy": self.drop_policy}
+
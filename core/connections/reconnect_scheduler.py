@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/14 10:20
+# @Author  : Heshouyi
+# @File    : reconnect_scheduler.py
+# @Software: PyCharm
+# @description: 断线重连调度器，所有设备共用一个调度线程，按指数退避加随机抖动重连，并限制全局每秒建连次数
+
+import heapq
+import itertools
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from core.configer import config
+from core.logger import logger
+from core.metrics_table import RECONNECTS
+from core.rate_limiter import TokenBucket
+from core.telemetry import RECONNECTS_TOTAL
+
+
+class ReconnectState:
+    """单个客户端的重连状态"""
+
+    def __init__(self, client):
+        self.client = client
+        self.attempts = 0                       # 本次断线后已尝试的次数
+        self.lost_time = time.monotonic()       # 检测到断线的时间，用于统计恢复耗时
+        self.token_reserved = False             # 是否已预扣建连令牌，被限速推迟的尝试到期后不再重复扣
+        self.cancelled = False                  # 手动断开或手动重连后取消
+
+
+class ReconnectScheduler:
+    """
+    断线重连调度器
+    服务器重启时所有设备几乎同时断线，固定间隔重连会让所有设备在同一秒内同时建连，
+    这里第n次重连的等待时间取 [0, min(max_delay, base_delay * 2^n)] 内的随机值（full jitter），
+    到期后还需从全局令牌桶取得建连令牌，令牌不足时顺延，保证整体建连速率不超过connects_per_second
+    建连和恢复会话（重新注册、识别包、心跳和上报定时任务）在线程池中执行，会话恢复失败按下一次退避重试
+    """
+
+    def __init__(self, base_delay=1, max_delay=60, connects_per_second=20, max_workers=8, history_size=1000):
+        """
+        :param base_delay: 退避基准时间，单位为秒
+        :param max_delay: 退避上限，单位为秒
+        :param connects_per_second: 全局每秒最多发起的建连次数，0表示不限制
+        :param max_workers: 执行建连和会话恢复的线程数
+        :param history_size: 保留的最近恢复耗时记录数
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.connect_limiter = TokenBucket(connects_per_second, capacity=1)  # 不允许突发，建连在每秒内均匀分布
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="reconnect")
+        self.heap = []                          # 待执行的重连 (到期时间, 序号, 重连状态)
+        self.counter = itertools.count()        # 到期时间相同时按加入顺序执行
+        self.states = {}                        # 客户端 -> 重连状态，同一客户端同时只有一个重连
+        self.condition = threading.Condition()
+        self.worker = None                      # 调度线程
+        self.history = deque(maxlen=history_size)   # 最近的恢复耗时，单位为毫秒
+        self.recovered_count = 0                # 恢复成功次数
+        self.attempt_count = 0                  # 建连尝试总次数
+        self.failed_attempt_count = 0           # 建连或会话恢复失败次数
+
+    @classmethod
+    def from_config(cls, reconnect_config):
+        """从配置文件的reconnect节点创建，缺省项使用默认值"""
+        reconnect_config = reconnect_config or {}
+        return cls(
+            base_delay=reconnect_config.get("base_delay", 1),
+            max_delay=reconnect_config.get("max_delay", 60),
+            connects_per_second=reconnect_config.get("connects_per_second", 20),
+            max_workers=reconnect_config.get("max_workers", 8),
+        )
+
+    def backoff_delay(self, attempts):
+        """第attempts次失败后的等待时间，指数退避封顶后在[0, 上限]内均匀随机"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempts))
+
+    def schedule(self, client):
+        """客户端断线后加入重连调度，已在重连中的客户端不重复加入"""
+        with self.condition:
+            if client in self.states:
+                return
+            state = ReconnectState(client)
+            self.states[client] = state
+            self.push(state, self.backoff_delay(0))
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, name="reconnect-scheduler", daemon=True)
+                self.worker.start()
+
+    def cancel(self, client):
+        """取消客户端的重连，手动断开或手动连接成功时调用"""
+        with self.condition:
+            state = self.states.pop(client, None)
+            if state:
+                state.cancelled = True
+
+    def push(self, state: ReconnectState, delay):
+        """按延迟加入调度堆，调用方需持有condition"""
+        heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), state))
+        self.condition.notify()
+
+    def run(self):
+        """调度线程，取出到期的重连，取得建连令牌后交给线程池执行"""
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                _, _, state = heapq.heappop(self.heap)
+                if state.cancelled:
+                    continue
+                if not state.token_reserved:
+                    state.token_reserved = True
+                    wait = self.connect_limiter.reserve()
+                    if wait > 0:
+                        self.push(state, wait)  # 令牌已预扣，到期后直接建连
+                        continue
+                state.token_reserved = False
+            self.executor.submit(self.attempt, state)
+
+    def attempt(self, state: ReconnectState):
+        """执行一次建连，连接成功后调用业务层回调恢复会话"""
+        client = state.client
+        state.attempts += 1
+        with self.condition:
+            self.attempt_count += 1
+        logger.info(f"{client.local_ip} 正在尝试第{state.attempts}次重连...")
+        try:
+            recovered = client.open_connection()
+            if recovered and client.reconnect_callback and not state.cancelled:
+                client.reconnect_callback()     # 重连后由业务层恢复会话
+        except Exception as e:
+            logger.error(f"{client.local_ip} 重连后恢复会话失败: {e}")
+            recovered = False
+        if not recovered and not state.cancelled:
+            client.close_socket()   # 建连成功但会话恢复失败时关闭连接，下次重新建连
+
+        with self.condition:
+            if state.cancelled:
+                return
+            if recovered:
+                self.states.pop(client, None)
+                recovery_ms = round((time.monotonic() - state.lost_time) * 1000, 3)
+                self.history.append(recovery_ms)
+                self.recovered_count += 1
+                client.metrics.add(RECONNECTS)
+                client.telemetry.count(RECONNECTS_TOTAL)
+                logger.info(f"{client.local_ip} 重连成功，第{state.attempts}次尝试恢复，断线到恢复耗时{recovery_ms}毫秒")
+                return
+            self.failed_attempt_count += 1
+            delay = self.backoff_delay(state.attempts)
+            self.push(state, delay)
+        logger.info(f"{client.local_ip} 重连失败，{round(delay, 3)} 秒后重试")
+
+    def get_stats(self):
+        """重连统计，恢复耗时单位为毫秒"""
+        with self.condition:
+            history = sorted(self.history)
+            pending = len(self.states)
+        return {
+            "pending": pending,
+            "recoveredCount": self.recovered_count,
+            "attemptCount": self.attempt_count,
+            "failedAttemptCount": self.failed_attempt_count,
+            "recoveryMs": {
+                "avg": round(sum(history) / len(history), 3) if history else None,
+                "p50": history[len(history) // 2] if history else None,
+                "p99": history[min(len(history) - 1, len(history) * 99 // 100)] if history else None,
+                "max": history[-1] if history else None,
+            },
+        }
+
+
+reconnect_scheduler = ReconnectScheduler.from_config(config.get("reconnect"))
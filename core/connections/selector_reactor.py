@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/18 14:05
+# @Author  : Heshouyi
+# @File    : selector_reactor.py
+# @Software: PyCharm
+# @description: 基于selectors的共用接收线程，少量线程等待所有设备套接字的可读事件并分发给对应的客户端
+
+import selectors
+import socket
+import threading
+from collections import deque
+from core.configer import config
+from core.logger import logger
+
+
+class SelectorReactor:
+    """
+    单个reactor线程，用selectors（Linux下为epoll）等待注册在其上的所有套接字
+    套接字可读时在本线程中调用注册时传入的回调，回调需尽快返回，不能阻塞等待网络数据
+    注册和注销可在任意线程调用，通过命令队列交给reactor线程执行，再用socketpair唤醒select
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.selector = selectors.DefaultSelector()
+        self.commands = deque()         # 待reactor线程执行的注册/注销命令
+        self.waker_r, self.waker_w = socket.socketpair()    # 写入一个字节即可唤醒阻塞中的select
+        self.waker_r.setblocking(False)
+        self.waker_w.setblocking(False)
+        self.selector.register(self.waker_r, selectors.EVENT_READ, None)
+        self.socket_count = 0           # 当前注册的套接字数量，用于分配reactor
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def register(self, sock, callback):
+        """注册套接字，可读时在reactor线程中调用 callback(sock)"""
+        self.socket_count += 1
+        self.submit(self.do_register, sock, callback)
+
+    def unregister(self, sock, timeout=1):
+        """注销套接字，非reactor线程调用时等待注销完成，调用方随后即可安全关闭套接字"""
+        self.socket_count -= 1
+        if threading.current_thread() is self.thread:
+            self.do_unregister(sock)
+            return
+        done = threading.Event()
+        self.submit(self.do_unregister, sock, done)
+        done.wait(timeout)
+
+    def submit(self, *command):
+        self.commands.append(command)
+        try:
+            self.waker_w.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass    # 缓冲区已满说明reactor尚未处理之前的唤醒，不影响本次命令的执行
+
+    def do_register(self, sock, callback):
+        try:
+            self.selector.register(sock, selectors.EVENT_READ, callback)
+        except (KeyError, ValueError, OSError) as e:
+            logger.error(f"{self.name}注册套接字失败: {e}")
+
+    def do_unregister(self, sock, done=None):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError, OSError):
+            pass    # 已注销或套接字已关闭
+        if done:
+            done.set()
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.data is None:    # 唤醒用的socketpair
+                    try:
+                        while self.waker_r.recv(4096):
+                            pass
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    continue
+                try:
+                    key.data(key.fileobj)
+                except Exception as e:
+                    logger.exception(f"{self.name}分发可读事件时出现未知错误: {e}")
+            while self.commands:
+                command, *args = self.commands.popleft()
+                command(*args)
+
+
+class ReactorPool:
+    """
+    reactor线程池，线程数由配置决定，不随设备数量增加
+    新套接字分配给当前注册数量最少的reactor
+    """
+
+    def __init__(self, thread_count=1):
+        self.thread_count = max(1, thread_count)
+        self.reactors = []
+        self.lock = threading.Lock()
+
+    def get_reactor(self) -> SelectorReactor:
+        with self.lock:
+            if not self.reactors:
+                self.reactors = [SelectorReactor(f"selector-reactor-{i}") for i in range(self.thread_count)]
+            return min(self.reactors, key=lambda reactor: reactor.socket_count)
+
+    def in_reactor_thread(self):
+        """当前是否为reactor线程，reactor线程同时为多个套接字服务，不能休眠"""
+        current = threading.current_thread()
+        return any(reactor.thread is current for reactor in self.reactors)
+
+
+transport_config = config.get("transport") or {}
+TRANSPORT_BACKEND = transport_config.get("backend", "thread")   # thread：每个连接一个接收线程 selector：共用reactor线程
+reactor_pool = ReactorPool(transport_config.get("reactor_threads", 1))
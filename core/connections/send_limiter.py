@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/19 16:20
+# @Author  : Heshouyi
+# @File    : send_limiter.py
+# @Software: PyCharm
+# @description: 设备发送限速，按 全局 → 服务器端口 → 单台设备 三级限制包速率和字节速率，运行时可通过接口调整
+
+import threading
+import time
+from core.configer import config
+from core.rate_limiter import TokenBucket
+
+
+class RateLimitNode:
+    """
+    限速树上的一个节点，同时限制包速率和字节速率，并统计实际发送量
+    速率为0表示该项不限速
+    """
+
+    def __init__(self, packets_per_second=0, bytes_per_second=0, burst=0.1):
+        self.lock = threading.Lock()
+        self.packet_bucket = TokenBucket(0)
+        self.byte_bucket = TokenBucket(0)
+        self.packets_per_second = 0
+        self.bytes_per_second = 0
+        self.sent_packets = 0       # 本次设定速率以来的发送包数
+        self.sent_bytes = 0         # 本次设定速率以来的发送字节数
+        self.since = time.monotonic()
+        self.set_rate(packets_per_second, bytes_per_second, burst)
+
+    def set_rate(self, packets_per_second, bytes_per_second, burst=0.1):
+        """
+        调整速率并重新开始统计实测速率，便于按阶梯逐级加压时观察每一级的实际吞吐
+        :param burst: 允许的突发量，单位为秒，桶容量为速率乘以该值，包速率的容量至少为1个包
+        """
+        with self.lock:
+            self.packets_per_second = packets_per_second
+            self.bytes_per_second = bytes_per_second
+            self.packet_bucket.set_rate(packets_per_second, max(1, packets_per_second * burst))
+            self.byte_bucket.set_rate(bytes_per_second, bytes_per_second * burst)
+            self.sent_packets = 0
+            self.sent_bytes = 0
+            self.since = time.monotonic()
+
+    def is_limited(self):
+        return self.packets_per_second > 0 or self.bytes_per_second > 0
+
+    def reserve(self, size):
+        """预扣一个包和size字节的令牌，返回需要等待的秒数"""
+        with self.lock:
+            self.sent_packets += 1
+            self.sent_bytes += size
+        return max(self.packet_bucket.reserve(1), self.byte_bucket.reserve(size))
+
+    def get_stats(self):
+        elapsed = max(time.monotonic() - self.since, 1e-6)
+        return {
+            "packetsPerSecond": self.packets_per_second,
+            "bytesPerSecond": self.bytes_per_second,
+            "sentPackets": self.sent_packets,
+            "sentBytes": self.sent_bytes,
+            "measuredPacketsPerSecond": round(self.sent_packets / elapsed, 3),
+            "measuredBytesPerSecond": round(self.sent_bytes / elapsed, 3),
+        }
+
+
+class SendRateLimiter:
+    """
+    所有设备连接共用的分级发送限速器
+    每次发送同时在全局、所在服务器端口、所在设备三个节点上预扣令牌，按等待时间最长的一级等待，
+    任何一级的实际发送速率都不会超过其设定值；令牌桶允许欠账，长时间运行的吞吐与设定速率一致
+    端口和设备节点在首次发送时按默认速率创建
+    """
+
+    SCOPES = ("global", "port", "device")
+
+    def __init__(self, global_rate=None, port_rates=None, device_default=None, device_rates=None, burst=0.1):
+        """
+        :param global_rate: 全局速率 {"packets_per_second": x, "bytes_per_second": y}
+        :param port_rates: 按服务器端口的速率 {端口: 速率}
+        :param device_default: 未单独配置的设备使用的速率
+        :param device_rates: 按设备IP单独配置的速率 {设备IP: 速率}
+        :param burst: 允许的突发量，单位为秒
+        """
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.device_default = dict(device_default or {})
+        self.global_node = self.create_node(global_rate)
+        self.port_nodes = {int(port): self.create_node(rate) for port, rate in (port_rates or {}).items()}
+        self.device_nodes = {str(ip): self.create_node(rate) for ip, rate in (device_rates or {}).items()}
+
+    @classmethod
+    def from_config(cls, limit_config):
+        """从配置文件的rate_limit节点创建，缺省时不限速"""
+        limit_config = limit_config or {}
+        return cls(
+            global_rate=limit_config.get("global"),
+            port_rates=limit_config.get("ports"),
+            device_default=limit_config.get("device_default"),
+            device_rates=limit_config.get("devices"),
+            burst=limit_config.get("burst", 0.1),
+        )
+
+    def create_node(self, rate):
+        rate = rate or {}
+        return RateLimitNode(rate.get("packets_per_second", 0), rate.get("bytes_per_second", 0), self.burst)
+
+    def get_node(self, nodes, key, default_rate=None):
+        node = nodes.get(key)
+        if node is None:
+            with self.lock:
+                node = nodes.get(key)
+                if node is None:
+                    node = nodes[key] = self.create_node(default_rate)
+        return node
+
+    def reserve(self, port, device, size):
+        """
+        为一次发送预扣令牌，不阻塞
+        :param port: 服务器端口
+        :param device: 设备IP
+        :param size: 发送的字节数
+        :return: 需要等待的秒数，0表示可立即发送
+        """
+        wait = self.global_node.reserve(size)
+        wait = max(wait, self.get_node(self.port_nodes, port).reserve(size))
+        wait = max(wait, self.get_node(self.device_nodes, device, self.device_default).reserve(size))
+        return wait
+
+    def is_limited(self, port, device):
+        """该设备的发送是否受任何一级限速"""
+        return (self.global_node.is_limited() or self.get_node(self.port_nodes, port).is_limited()
+                or self.get_node(self.device_nodes, device, self.device_default).is_limited())
+
+    def set_rate(self, scope, target=None, packets_per_second=0, bytes_per_second=0):
+        """
+        运行时调整某一级的速率，速率为0表示不限速
+        :param scope: global、port或device
+        :param target: scope为port时为服务器端口，为device时为设备IP
+        """
+        if scope == "global":
+            node = self.global_node
+        elif scope == "port":
+            node = self.get_node(self.port_nodes, int(target))
+        elif scope == "device":
+            node = self.get_node(self.device_nodes, str(target), self.device_default)
+        else:
+            raise ValueError(f"限速级别只支持{self.SCOPES}，实际为: {scope}")
+        node.set_rate(packets_per_second, bytes_per_second, self.burst)
+
+    def get_stats(self):
+        """返回各级的设定速率和实测速率，设备只列出单独限速的，避免设备数量多时返回过大"""
+        return {
+            "burst": self.burst,
+            "global": self.global_node.get_stats(),
+            "ports": {port: node.get_stats() for port, node in list(self.port_nodes.items())},
+            "deviceDefault": self.device_default,
+            "devices": {ip: node.get_stats() for ip, node in list(self.device_nodes.items()) if node.is_limited()},
+        }
+
+
+send_rate_limiter = SendRateLimiter.from_config(config.get("rate_limit"))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/20 15:10
+# @Author  : Heshouyi
+# @File    : target_pool.py
+# @Software: PyCharm
+# @description: 多目标服务器，按一致性哈希把设备分配到同一协议端口的多个服务器上，目标不可用时只迁移该目标上的设备
+
+import bisect
+import hashlib
+import threading
+import time
+import weakref
+from core.configer import config
+from core.logger import logger
+
+
+def hash_key(key):
+    """把字符串映射到哈希环上的位置，md5分布均匀且跨进程稳定"""
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    一致性哈希环，每个目标在环上放置replicas个虚拟节点，使设备分布均匀
+    设备沿环顺时针找到的第一个可用目标即为其目标，某个目标不可用时只有原属于它的设备顺延到下一个目标
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(dict.fromkeys(nodes))
+        ring = sorted((hash_key(f"{node}#{index}"), node) for node in self.nodes for index in range(replicas))
+        self.positions = [position for position, _ in ring]
+        self.ring_nodes = [node for _, node in ring]
+
+    def iterate(self, key):
+        """按顺时针顺序依次返回key对应的各个目标，不重复"""
+        if not self.ring_nodes:
+            return
+        start = bisect.bisect(self.positions, hash_key(key))
+        seen = set()
+        for offset in range(len(self.ring_nodes)):
+            node = self.ring_nodes[(start + offset) % len(self.ring_nodes)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
+
+
+class TargetState:
+    """单个目标服务器的健康状态和发送统计"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0   # 连续建连失败次数
+        self.down_until = 0             # 标记为不可用的截止时间，到期后允许设备再次尝试
+        self.connect_failures = 0
+        self.sent_packets = 0
+        self.sent_bytes = 0
+
+    def is_available(self, now):
+        return now >= self.down_until
+
+
+class TargetPool:
+    """
+    按协议端口配置的目标服务器池，所有设备连接共用
+    没有为某个端口配置多个目标时，设备直接使用传入的服务器地址，行为与单服务器一致
+    同一目标连续建连失败达到阈值后标记为不可用，retry_interval秒内不再分配设备，到期后由下一次建连验证是否恢复
+    """
+
+    def __init__(self, targets=None, replicas=100, failure_threshold=3, retry_interval=30):
+        """
+        :param targets: {协议端口: [目标服务器IP, ...]}
+        :param replicas: 每个目标在哈希环上的虚拟节点数
+        :param failure_threshold: 连续建连失败多少次后标记目标不可用
+        :param retry_interval: 目标不可用后多久允许再次尝试，单位为秒
+        """
+        self.rings = {int(port): HashRing(hosts, replicas) for port, hosts in (targets or {}).items() if hosts}
+        self.failure_threshold = failure_threshold
+        self.retry_interval = retry_interval
+        self.states = {}                    # (端口, 目标IP) -> TargetState，首次使用时创建
+        self.lock = threading.Lock()
+        self.clients = weakref.WeakSet()    # 建立过连接的客户端，统计各目标的连接数
+
+    @classmethod
+    def from_config(cls, server_config):
+        """从配置文件的server节点创建"""
+        server_config = server_config or {}
+        return cls(
+            targets=server_config.get("targets"),
+            replicas=server_config.get("target_replicas", 100),
+            failure_threshold=server_config.get("target_failure_threshold", 3),
+            retry_interval=server_config.get("target_retry_interval", 30),
+        )
+
+    def get_state(self, port, host) -> TargetState:
+        state = self.states.get((port, host))
+        if state is None:
+            with self.lock:
+                state = self.states.setdefault((port, host), TargetState(host, port))
+        return state
+
+    def select(self, port, key, default_host):
+        """
+        选择设备要连接的目标服务器
+        :param port: 协议端口
+        :param key: 设备的放置key，同一设备每次选择的结果相同
+        :param default_host: 端口未配置多个目标时使用的服务器地址
+        :return: 目标服务器IP，所有目标都不可用时返回哈希环上的首选目标
+        """
+        ring = self.rings.get(port)
+        if ring is None:
+            return default_host
+        now = time.monotonic()
+        preferred = None
+        for host in ring.iterate(key):
+            preferred = preferred or host
+            if self.get_state(port, host).is_available(now):
+                return host
+        return preferred
+
+    def report_success(self, client, port, host):
+        """建连成功，清除该目标的失败计数"""
+        self.clients.add(client)
+        state = self.get_state(port, host)
+        with state.lock:
+            recovered = state.down_until > 0
+            state.consecutive_failures = 0
+            state.down_until = 0
+        if recovered:
+            logger.info(f"目标服务器{host}:{port}已恢复，重新参与设备分配")
+
+    def report_failure(self, port, host):
+        """建连失败，连续失败达到阈值时标记目标不可用，其上的设备重连时顺延到哈希环上的下一个目标"""
+        state = self.get_state(port, host)
+        with state.lock:
+            state.connect_failures += 1
+            state.consecutive_failures += 1
+            if state.consecutive_failures < self.failure_threshold:
+                return
+            now = time.monotonic()
+            newly_down = state.is_available(now) and state.down_until == 0
+            state.down_until = now + self.retry_interval
+        if newly_down and port in self.rings:
+            logger.warning(f"目标服务器{host}:{port}连续{state.consecutive_failures}次建连失败，"
+                           f"{self.retry_interval}秒内不再分配设备，其上的设备迁移到其他目标")
+
+    def record_sent(self, port, host, size):
+        state = self.get_state(port, host)
+        with state.lock:
+            state.sent_packets += 1
+            state.sent_bytes += size
+
+    def get_stats(self):
+        """返回各目标的可用状态、当前连接数和累计发送量"""
+        connections = {}
+        for client in list(self.clients):
+            if client.is_connected():
+                target = (client.server_port, client.server_ip)
+                connections[target] = connections.get(target, 0) + 1
+        now = time.monotonic()
+        for port, ring in self.rings.items():
+            for host in ring.nodes:
+                self.get_state(port, host)
+        return [
+            {
+                "host": state.host,
+                "port": state.port,
+                "available": state.is_available(now),
+                "consecutiveFailures": state.consecutive_failures,
+                "connectFailures": state.connect_failures,
+                "connections": connections.get((state.port, state.host), 0),
+                "sentPackets": state.sent_packets,
+                "sentBytes": state.sent_bytes,
+            }
+            for state in sorted(list(self.states.values()), key=lambda state: (state.port, state.host))
+        ]
+
+
+target_pool = TargetPool.from_config(config.get("server"))
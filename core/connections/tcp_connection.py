@@ -7,116 +7,384 @@
 # @description:
 import asyncio
 import socket
+import struct
 import threading
 import time
-from core.logger import logger
+try:
+    import fcntl
+    import termios
+except ImportError:     # Windows下没有fcntl/termios，无法查询发送队列
+    fcntl = termios = None
+from core.configer import config
+from core.connections.event_loop import shared_event_loop
+from core.connections.outbox import Outbox
+from core.connections.reconnect_scheduler import reconnect_scheduler
+from core.connections.selector_reactor import TRANSPORT_BACKEND, reactor_pool
+from core.connections.send_limiter import send_rate_limiter
+from core.connections.target_pool import target_pool
+from core.logger import logger, packet_log
+from core.packet_capture import RECEIVED, SENT, packet_capture
+from core.metrics_table import CONNECTED, CONNECTION_STATE, DISCONNECTED, ERRORS, QUEUE_DEPTH, REGISTERED, \
+    local_slot
+from core.telemetry import CONNECTS_TOTAL, SEND_ERRORS_TOTAL, telemetry
+from core.tracing import tracer
 from core.util import is_valid_ip
 
 
+class FrameSplitter:
+    """
+    按协议头尾字节从字节流中切分完整的包
+    一次recv可能包含多个包，也可能只有半个包，不完整的部分缓存到下次数据到达后再拼接
+    协议对包内的头尾字节做了转义，包内不会出现未转义的头尾字节
+    """
+
+    def __init__(self, head=0xfb, tail=0xfe):
+        self.head = bytes([head])
+        self.tail = bytes([tail])
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes):
+        """写入新收到的数据，返回其中所有完整的包"""
+        self.buffer += data
+        frames = []
+        while True:
+            start = self.buffer.find(self.head)
+            if start < 0:
+                self.buffer.clear()     # 没有包头，之前的数据都无法组成完整的包
+                break
+            end = self.buffer.find(self.tail, start + 1)
+            if end < 0:
+                del self.buffer[:start]
+                break
+            frames.append(bytes(self.buffer[start:end + 1]))
+            del self.buffer[:end + 1]
+        return frames
+
+    def reset(self):
+        self.buffer.clear()
+
+
+def peek_command_code(packet: bytes) -> str:
+    """
+    取已转义上行包的命令码，用于按命令码统计，不做完整解包，车位相机、通道相机和LED网络屏的协议格式相同
+    协议把包内的头尾字节和0xff转义为0xff加1字节，命令码前的4字节时间戳可能被转义为2字节，命令码本身为ASCII字母，不会被转义
+    """
+    if packet[1] != 0xff and packet[2] != 0xff and packet[3] != 0xff and packet[4] != 0xff:
+        return chr(packet[5])
+    position = 1
+    for _ in range(4):
+        position += 2 if packet[position] == 0xff else 1
+    return chr(packet[position])
+
+
 class TCPClient:
     def __init__(self):
         self.local_ip = None  # 用来连接服务器的设备IP
         self.server_ip = None  # 服务器IP
         self.server_port = None  # 服务器端口
         self.server_socket = None
+        self.send_lock = threading.Lock()   # 一个包的sendall全程持有，多个线程同时发送时包不会交错
         self.receive_callback = None  # 处理监控服务器下发数据的回调函数
         self.disconnect_callback = None  # 处理connection层主动断开时后续逻辑的回调函数
-        self.reconnect_thread = None    # 断线重连线程
-        self.stop_reconnect_flag = threading.Event()    # 停止重连线程的标志
-        self.reconnect_interval = 10    # 重连间隔时间，默认为10秒
+        self.reconnect_callback = None  # 断线自动重连成功后恢复业务会话的回调函数
         self.manual_disconnect = None   # 手动断开连接的标志
+        self.frame_splitter = None      # 包切分器，设置后按包回调业务层，否则按每次recv的原始数据回调
+        self.reactor = None             # selector模式下当前套接字所在的reactor
+        self.metrics = local_slot()     # 收发计数槽，批量设备由所在进程替换为共享计数表中的槽
+        self.telemetry = telemetry.device("tcp")    # 指标记录入口，业务层设置设备类型和设备标签
+        self.command_code_reader = None     # 从上行包中取命令码的函数，用于按命令码统计，未设置时命令码为空
+        self.placement_key = None       # 多目标服务器时的放置key，默认使用本地IP，多台设备共用源IP时由业务层设置为设备编号
+        self.outbox = Outbox.from_config(config.get("outbox"))  # 断线期间的事件缓冲区
+        self.session_ready = False      # 业务会话是否已就绪（已注册），就绪前的事件先进入缓冲区
 
     def connect(self, server_ip, server_port, local_ip):
-        """连接到服务器"""
+        """连接到服务器，连接失败时交给重连调度器自动重连"""
         self.local_ip = local_ip
         self.server_ip = server_ip
         self.server_port = server_port
+        self.manual_disconnect = False  # 手动连接后恢复断线自动重连
+        if self.open_connection():
+            reconnect_scheduler.cancel(self)    # 手动连接成功，取消尚未执行的重连
+            return True
+        self.start_reconnect(server_ip, server_port, local_ip)  # 启动断线重连
+        return False
+
+    def open_connection(self):
+        """建立TCP连接并启动接收线程，不触发重连，供手动连接和重连调度器使用"""
         try:
             # 检查本地IP是否合法
-            if not is_valid_ip(local_ip):
-                logger.error(f"无效的本地IP地址: {local_ip}")
+            if not is_valid_ip(self.local_ip):
+                logger.error(f"无效的本地IP地址: {self.local_ip}")
                 return False
+            # 同一端口配置了多个目标服务器时按一致性哈希选择，每次建连重新选择，避开不可用的目标
+            self.server_ip = target_pool.select(self.server_port, self.placement_key or self.local_ip, self.server_ip)
             # 创建TCP套接字
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # 绑定用于连接的本地IP和端口，端口0表示系统自动分配
-            self.server_socket.bind((local_ip, 0))
-            # 连接服务器
-            self.server_socket.connect((server_ip, server_port))
-            self.server_socket.settimeout(5)    # 设置超时时间为5秒
-            logger.debug(f"成功使用本地IP：{local_ip}，连接到服务器：{server_ip}:{server_port} ")
-            # 连接后启动监听线程，接收服务器返回的数据
-            threading.Thread(target=self.receive_data, daemon=True).start()
-            self.stop_reconnect_flag.set()  # 停止断线重连线程
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                # 绑定用于连接的本地IP和端口，端口0表示系统自动分配
+                sock.bind((self.local_ip, 0))
+            except Exception:
+                sock.close()
+                raise
+            try:
+                # 连接服务器
+                sock.connect((self.server_ip, self.server_port))
+            except Exception:
+                sock.close()
+                target_pool.report_failure(self.server_port, self.server_ip)
+                raise
+            target_pool.report_success(self, self.server_port, self.server_ip)
+            self.telemetry.count(CONNECTS_TOTAL)
+            sock.settimeout(5)    # 设置超时时间为5秒
+            self.server_socket = sock
+            self.metrics.set(CONNECTION_STATE, CONNECTED)
+            logger.debug(f"成功使用本地IP：{self.local_ip}，连接到服务器：{self.server_ip}:{self.server_port} ")
+            if self.frame_splitter:
+                self.frame_splitter.reset()     # 旧连接中残留的半个包不能拼到新连接的数据上
+            if TRANSPORT_BACKEND == "selector":
+                # 注册到共用的reactor线程，可读时回调，不单独启动接收线程
+                self.reactor = reactor_pool.get_reactor()
+                self.reactor.register(sock, self.handle_readable)
+            else:
+                # 连接后启动监听线程，接收服务器返回的数据
+                threading.Thread(target=self.receive_data, name=f"tcp-receive-{self.local_ip}", daemon=True).start()
             return True
         except Exception as e:
             logger.error(f"连接失败，错误信息: {e}")
-            self.start_reconnect(server_ip, server_port, local_ip)  # 启动断线重连
             return False
 
     def send_data(self, data, need_log=True):
-        """发送数据到服务器"""
+        """
+        发送数据到服务器，发送前经过全局、服务器端口、设备三级限速
+        事件循环线程和reactor线程中不能休眠等待令牌，限速生效时数据存入缓冲区，由补发任务按顺序等待令牌后发送
+        :return: 数据是否完整写入套接字，发送失败时返回False并启动断线重连，存入缓冲区时返回False
+        """
+        # 如果data是字符串，则先encode成bytes，否则直接发送
+        if isinstance(data, str):
+            data = data.encode()
+        if self.is_connected():     # 未连接时不占用令牌
+            if self.must_defer():
+                self.defer(data)
+                return False
+            wait = send_rate_limiter.reserve(self.server_port, self.local_ip, len(data))
+            if wait > 0:
+                with tracer.span("tcp.rate_limit", "transport", waitMs=round(wait * 1000, 3)):
+                    time.sleep(wait)
+        return self.write_data(data, need_log)
+
+    def must_defer(self):
+        """
+        当前线程不能休眠等待令牌且本设备受限速时需要推迟发送
+        共用事件循环线程和reactor线程同时为所有设备服务，休眠会拖慢其他设备
+        """
+        return ((shared_event_loop.in_loop_thread() or reactor_pool.in_reactor_thread())
+                and send_rate_limiter.is_limited(self.server_port, self.local_ip))
+
+    def defer(self, data):
+        """把需要等待令牌的数据排到缓冲区末尾，之前缓存的事件先发出，之后的发送也排在它后面"""
+        if not self.outbox.put(data):
+            logger.warning(f"{self.local_ip} 缓冲区已满，丢弃限速推迟的数据: {data}")
+        self.metrics.set(QUEUE_DEPTH, len(self.outbox))
+        self.flush_outbox()
+
+    def write_data(self, data: bytes, need_log=True):
+        """把数据写入当前套接字，不经过限速"""
         if not self.is_connected():
+            self.count_error(SEND_ERRORS_TOTAL)
             logger.error("发送数据失败：未与服务器建立连接，开始尝试重连")
             self.start_reconnect(self.server_ip, self.server_port, self.local_ip)
-            return
+            return False
 
+        sock = self.server_socket
         try:
-            # 如果data是字符串，则先encode成bytes，否则直接发送
-            if isinstance(data, str):
-                data = data.encode()
-            self.server_socket.sendall(data)
-            if need_log:  # 根据参数选择是否打印info日志，为False打debug
-                logger.info(f"发送数据：{data}")
-            else:
-                logger.debug(f"发送数据: {data}")
+            with tracer.span("tcp.send", "transport", bytes=len(data)), self.send_lock:
+                sock.sendall(data)
+            target_pool.record_sent(self.server_port, self.server_ip, len(data))
+            self.metrics.record_sent(len(data))
+            self.telemetry.frame_sent(self.command_code_reader(data) if self.command_code_reader else "", len(data))
+            if packet_capture.enabled:
+                packet_capture.record(self.local_ip, SENT, data)
+            if packet_log.sample(self.local_ip):
+                if need_log:  # 根据参数选择是否打印info日志，为False打debug
+                    logger.info("发送数据：{}", data)
+                else:
+                    logger.debug("发送数据: {}", data)
+            return True
         except (socket.error, ConnectionResetError) as e:
+            self.count_error(SEND_ERRORS_TOTAL)
             logger.error(f"发送数据失败: {e}")
-            self.server_socket = None  # 关闭当前套接字
-            self.start_reconnect(self.server_ip, self.server_port, self.local_ip)  # 启动断线重连
+            self.handle_connection_lost(sock, e)    # 与接收时检测到断线的处理相同
+            return False
         except Exception as e:
             logger.error(f"发送数据时出现未知错误: {e}")
             raise e
 
+    def send_event(self, data, key=None, need_log=True):
+        """
+        发送业务事件（状态上报等），断线或会话未就绪时存入缓冲区，恢复会话后按限定速率补发
+        缓冲区中还有未补发的事件时，新事件也排在后面，保证服务器收到的顺序与事件发生顺序一致
+        :param key: 合并用的key，drop_policy为coalesce时同一key只保留最新一条，如车位号
+        :return: 是否已直接发送，False表示已存入缓冲区或被丢弃
+        """
+        if self.session_ready and self.is_connected() and not len(self.outbox) and not self.outbox.flushing \
+                and not self.must_defer():
+            if self.send_data(data, need_log=need_log):
+                return True
+        elif not self.is_connected():
+            self.start_reconnect(self.server_ip, self.server_port, self.local_ip)
+        if self.outbox.put(data, key):
+            logger.debug(f"{self.local_ip} 事件已存入缓冲区，当前缓存{len(self.outbox)}条")
+        else:
+            logger.warning(f"{self.local_ip} 缓冲区已满，丢弃新事件: {data}")
+        self.metrics.set(QUEUE_DEPTH, len(self.outbox))
+        self.flush_outbox()
+        return False
+
+    def resume_outbox(self):
+        """业务层注册完成、会话就绪后调用，开始补发断线期间缓存的事件"""
+        self.session_ready = True
+        self.metrics.set(CONNECTION_STATE, REGISTERED)
+        self.flush_outbox()
+
+    def flush_outbox(self):
+        """会话就绪且缓冲区中有事件时，在共用事件循环中启动补发"""
+        if not self.session_ready or not self.is_connected() or not self.outbox.begin_flush():
+            return
+        asyncio.run_coroutine_threadsafe(self.outbox.flush(self.send_buffered), shared_event_loop.get_loop())
+
+    async def send_buffered(self, data):
+        """补发一条缓存的事件，同时更新缓冲区深度，在共用事件循环中等待限速令牌，在发送线程池中写入套接字"""
+        self.metrics.set(QUEUE_DEPTH, len(self.outbox))
+        if self.is_connected():     # 未连接时直接由write_data记录发送失败并启动重连
+            wait = send_rate_limiter.reserve(self.server_port, self.local_ip, len(data))
+            if wait > 0:
+                with tracer.span("tcp.rate_limit", "transport", waitMs=round(wait * 1000, 3)):
+                    await asyncio.sleep(wait)
+        return await shared_event_loop.run_blocking(self.write_data, data, False)
+
     def receive_data(self):
         """监听来自服务器的数据并调用回调处理"""
-        while self.is_connected():
+        sock = self.server_socket   # 本线程只负责启动时的套接字，重连后由新线程接收
+        while self.server_socket is sock and sock is not None:
             try:
-                if not self.server_socket:
-                    logger.error("套接字未连接，停止接收数据")
-                    break
-                data = self.server_socket.recv(2048)    # 一旦缓冲区有数据可读，则接收数据并处理
-                if data:
-                    logger.debug(f"接收到原始数据: {data}")
-                    if self.receive_callback:
-                        self.receive_callback(data)     # 调用回调函数，将数据传回业务层处理
+                data = sock.recv(2048)    # 一旦缓冲区有数据可读，则接收数据并处理
+                if not data:
+                    raise ConnectionResetError("服务器关闭了连接")   # 对端关闭时recv返回空数据
+                self.dispatch_data(data)
             except socket.timeout:
                 continue  # 忽略超时异常
             except (socket.error, ConnectionResetError) as e:
-                logger.warning(f"连接断开: {e}")
-                self.server_socket = None
-                self.start_reconnect(self.server_ip, self.server_port, self.local_ip)  # 断开后开始重连
+                self.handle_connection_lost(sock, e)
                 break
             except Exception as e:
                 logger.error(f"接收服务器数据时出现未知错误: {e}")
 
+    def handle_readable(self, sock):
+        """selector模式下套接字可读时由reactor线程调用，每次只读取当前已到达的数据，不阻塞"""
+        try:
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionResetError("服务器关闭了连接")   # 对端关闭时recv返回空数据
+            self.dispatch_data(data)
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            return
+        except (socket.error, ConnectionResetError) as e:
+            self.handle_connection_lost(sock, e)
+        except Exception as e:
+            logger.error(f"接收服务器数据时出现未知错误: {e}")
+
+    def dispatch_data(self, data):
+        """把收到的数据交给业务层，设置了包切分器时逐包回调"""
+        if packet_capture.enabled:
+            packet_capture.record(self.local_ip, RECEIVED, data)
+        if packet_log.sample(self.local_ip):
+            logger.debug("接收到原始数据: {}", data)
+        if self.frame_splitter is None:
+            self.metrics.record_received(len(data))
+            if self.receive_callback:
+                self.deliver(data)     # 调用回调函数，将数据传回业务层处理
+            return
+        frames = self.frame_splitter.feed(data)
+        self.metrics.record_received(len(data), len(frames))
+        if not self.receive_callback:
+            return
+        for frame in frames:
+            self.deliver(frame)
+
+    def deliver(self, data):
+        """调用业务层回调，回调为协程函数（如需要写数据库的LED网络屏）时交给事件循环创建任务执行"""
+        result = self.receive_callback(data)
+        if asyncio.iscoroutine(result):
+            shared_event_loop.spawn_callback(result)
+
+    def handle_connection_lost(self, sock, error):
+        """
+        收发时检测到断线，关闭套接字、结束会话并开始重连
+        只有断开的仍是当前套接字时才处理，避免旧连接的断线影响重连后的新连接
+        """
+        logger.warning(f"连接断开: {error}")
+        if self.server_socket is not sock:
+            return
+        self.close_socket()
+        self.start_reconnect(self.server_ip, self.server_port, self.local_ip)  # 断开后开始重连
+
     def disconnect(self):
         """断开连接"""
         self.manual_disconnect = True  # 设置手动断开标记，防止触发自动断线重连
-        self.stop_reconnect_flag.set()  # 停止重连
+        reconnect_scheduler.cancel(self)  # 停止重连
         if self.server_socket:
+            self.close_socket()
+            self.receive_callback = None
+            logger.info("TCP连接已断开")
+
+    def close_socket(self):
+        """关闭当前套接字，不改变重连状态"""
+        sock = self.server_socket   # 接收线程可能同时检测到断线并置空套接字，这里先取出
+        self.server_socket = None
+        self.session_ready = False
+        self.metrics.set(CONNECTION_STATE, DISCONNECTED)
+        reactor, self.reactor = self.reactor, None
+        if reactor and sock:
+            reactor.unregister(sock)    # 先从reactor注销再关闭，避免selector中残留已关闭的套接字
+        if sock:
             try:
-                self.server_socket.shutdown(socket.SHUT_RDWR)
+                sock.shutdown(socket.SHUT_RDWR)
             except Exception as e:
                 logger.warning(f"关闭套接字时发生异常: {e}")
             finally:
-                self.server_socket.close()
-                self.server_socket = None
-                self.receive_callback = None
-                logger.info("TCP连接已断开")
+                sock.close()
 
     def is_connected(self):
         return self.server_socket is not None
 
+    def get_unacked_bytes(self):
+        """
+        查询当前套接字发送队列中尚未被服务器TCP确认的字节数（Linux的TIOCOUTQ/SIOCOUTQ）
+        :return: 字节数，平台不支持或未连接时返回None
+        """
+        sock = self.server_socket
+        if sock is None or fcntl is None or not hasattr(termios, "TIOCOUTQ"):
+            return None
+        try:
+            return struct.unpack("I", fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, struct.pack("I", 0)))[0]
+        except OSError:
+            return None
+
+    def get_send_queue_bytes(self):
+        """发送队列深度，供指标输出使用"""
+        return self.get_unacked_bytes()
+
+    def count_error(self, name):
+        """记录一次发送失败或解包失败，同时计入指标和计数槽"""
+        self.telemetry.count(name)
+        self.metrics.add(ERRORS)
+
+    def set_telemetry(self, device_telemetry, command_code_reader=None):
+        """设置指标记录入口和上行包的命令码读取函数，并登记到注册表，输出时读取缓冲区和发送队列深度"""
+        self.telemetry = device_telemetry
+        self.command_code_reader = command_code_reader
+        telemetry.track(self)
+
     def set_receive_callback(self, callback):
         """设置接收数据的回调函数"""
         self.receive_callback = callback
@@ -125,29 +393,18 @@ class TCPClient:
         """设置connection层主动断开时的回调函数"""
         self.disconnect_callback = callback
 
+    def set_frame_splitter(self, frame_splitter):
+        """设置包切分器，服务器连续下发的多个包合并在一次recv中到达时逐包回调"""
+        self.frame_splitter = frame_splitter
+
+    def set_reconnect_callback(self, callback):
+        """设置断线自动重连成功后的回调函数，用于业务层重新注册等恢复会话的操作"""
+        self.reconnect_callback = callback
+
     def start_reconnect(self, server_ip, server_port, local_ip):
-        """启动断线重连线程"""
+        """断线后交给重连调度器，按指数退避重连并在成功后恢复会话"""
         if self.manual_disconnect:  # 手动断开，不启动重连
             return
-
-        if self.reconnect_thread and self.reconnect_thread.is_alive():
-            return  # 防止重复启动重连线程
-
-        self.stop_reconnect_flag.clear()  # 清除停止标志
-
-        def reconnect():
-            while not self.stop_reconnect_flag.is_set():
-                logger.info(f"{local_ip} 正在尝试重连...")
-                try:
-                    if self.connect(server_ip, server_port, local_ip):
-                        logger.info(f"{local_ip} 重连成功")
-                        break
-                    else:
-                        logger.info(f"{local_ip} 重连失败，{self.reconnect_interval} 秒后重试")
-
-                except Exception as e:
-                    logger.error(f"{local_ip} 重连失败: {e}，{self.reconnect_interval}秒后重试")
-                time.sleep(self.reconnect_interval)  # 每次重连间隔时间
-
-        self.reconnect_thread = threading.Thread(target=reconnect, daemon=True)
-        self.reconnect_thread.start()
+        if server_ip is None:   # 从未发起过连接
+            return
+        reconnect_scheduler.schedule(self)
@@ -4,114 +4,399 @@
 # @Author  : Heshouyi
 # @File    : websocket_connection.py
 # @Software: PyCharm
-# @description:
+# @description: 基于asyncio的WebSocket客户端，所有连接共用一个事件循环线程
 
-import websocket
-import threading
-import socket
-from core.logger import logger
+import asyncio
+import base64
+import hashlib
+import os
+import struct
 from typing import Union
+from urllib.parse import urlsplit
+from core.connections.event_loop import shared_event_loop
+from core.connections.reconnect_scheduler import reconnect_scheduler
+from core.connections.send_limiter import send_rate_limiter
+from core.connections.target_pool import target_pool
+from core.logger import logger, packet_log
+from core.packet_capture import RECEIVED, SENT, packet_capture
+from core.metrics_table import CONNECTED, CONNECTION_STATE, DISCONNECTED, ERRORS, local_slot
+from core.telemetry import CONNECTS_TOTAL, SEND_ERRORS_TOTAL, telemetry
+from core.tracing import tracer
+from core.util import is_valid_ip
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"   # RFC 6455 握手校验用的固定GUID
+MAX_MESSAGE_SIZE = 1024 * 1024      # 单条消息长度上限，超过时按1009关闭连接
+MAX_HANDSHAKE_SIZE = 16 * 1024      # 握手响应头长度上限
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+
+def apply_mask(payload: bytes, mask: bytes) -> bytes:
+    """按4字节掩码对数据做异或，整段转为大整数一次异或，避免逐字节循环"""
+    length = len(payload)
+    if not length:
+        return b""
+    mask_bytes = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(mask_bytes, "big")).to_bytes(length, "big")
+
+
+def encode_frame(opcode, payload: bytes) -> bytes:
+    """构造客户端发往服务器的单帧数据，协议要求客户端帧必须带掩码"""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack(">BB", 0x80 | opcode, 0x80 | length)
+    elif length < 65536:
+        header = struct.pack(">BBH", 0x80 | opcode, 0x80 | 126, length)
+    else:
+        header = struct.pack(">BBQ", 0x80 | opcode, 0x80 | 127, length)
+    mask = os.urandom(4)
+    return header + mask + apply_mask(payload, mask)
+
+
+class WebSocketProtocol(asyncio.Protocol):
+    """
+    单条WebSocket连接的协议处理，负责握手和帧的编解码，收到的消息和连接状态交给所属的WebSocketClient
+    每条连接只保存未解析完的数据和分片消息，空闲时占用内存在几KB以内
+    """
+    __slots__ = ("client", "transport", "buffer", "handshake_key", "handshake_request", "handshake_waiter",
+                 "fragments", "fragment_opcode", "closing")
+
+    def __init__(self, client, host_header, path, handshake_waiter):
+        self.client = client
+        self.transport = None
+        self.buffer = bytearray()       # 尚未解析完整的数据
+        self.handshake_key = base64.b64encode(os.urandom(16))
+        self.handshake_request = (
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {host_header}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {self.handshake_key.decode()}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n"
+        ).encode()
+        self.handshake_waiter = handshake_waiter    # 握手完成的future，握手完成后置为None
+        self.fragments = None           # 分片消息已收到的部分
+        self.fragment_opcode = None     # 分片消息的类型
+        self.closing = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(self.handshake_request)
+        self.handshake_request = None   # 握手请求只发送一次，发送后释放
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.handshake_waiter and not self.handshake_waiter.done():
+            self.handshake_waiter.set_exception(ConnectionError(f"WebSocket握手时连接断开: {exc}"))
+        self.client.on_connection_lost(self, exc)
+
+    def data_received(self, data):
+        self.buffer += data
+        if self.handshake_waiter:
+            if not self.parse_handshake():
+                return
+        self.parse_frames()
+
+    def parse_handshake(self):
+        """解析握手响应，校验通过后返回True，响应头未收全时返回False"""
+        end = self.buffer.find(b"\r\n\r\n")
+        if end < 0:
+            if len(self.buffer) > MAX_HANDSHAKE_SIZE:
+                self.fail_handshake("WebSocket握手响应头过长")
+            return False
+        lines = bytes(self.buffer[:end]).decode("latin-1").split("\r\n")
+        del self.buffer[:end + 4]
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        expected_accept = base64.b64encode(hashlib.sha1(self.handshake_key + WEBSOCKET_GUID).digest()).decode()
+        if len(lines[0].split(" ")) < 2 or lines[0].split(" ")[1] != "101":
+            self.fail_handshake(f"WebSocket握手失败，服务器返回: {lines[0]}")
+            return False
+        if headers.get("sec-websocket-accept") != expected_accept:
+            self.fail_handshake("WebSocket握手失败，Sec-WebSocket-Accept校验不通过")
+            return False
+        self.handshake_waiter.set_result(True)
+        self.handshake_waiter = None
+        return True
+
+    def fail_handshake(self, message):
+        if not self.handshake_waiter.done():
+            self.handshake_waiter.set_exception(ConnectionError(message))
+        self.transport.close()
+
+    def parse_frames(self):
+        """从缓冲区中解析所有完整的帧，服务器发来的帧一般不带掩码"""
+        buffer = self.buffer
+        while len(buffer) >= 2 and self.transport:
+            first, second = buffer[0], buffer[1]
+            length = second & 0x7F
+            offset = 2
+            if length == 126:
+                if len(buffer) < 4:
+                    return
+                length = struct.unpack_from(">H", buffer, 2)[0]
+                offset = 4
+            elif length == 127:
+                if len(buffer) < 10:
+                    return
+                length = struct.unpack_from(">Q", buffer, 2)[0]
+                offset = 10
+            if length > MAX_MESSAGE_SIZE:
+                logger.error(f"WebSocket收到的帧长度{length}超过上限，关闭连接")
+                self.close(1009)
+                return
+            mask = None
+            if second & 0x80:
+                mask = bytes(buffer[offset:offset + 4])
+                offset += 4
+            if len(buffer) < offset + length:
+                return
+            payload = bytes(buffer[offset:offset + length])
+            del buffer[:offset + length]
+            if mask:
+                payload = apply_mask(payload, mask)
+            self.handle_frame(first & 0x80, first & 0x0F, payload)
+
+    def handle_frame(self, fin, opcode, payload):
+        if opcode == OPCODE_PING:
+            self.write_frame(OPCODE_PONG, payload)
+        elif opcode == OPCODE_PONG:
+            return
+        elif opcode == OPCODE_CLOSE:
+            code = struct.unpack(">H", payload[:2])[0] if len(payload) >= 2 else 1005
+            logger.info(f"WebSocket服务器关闭连接，关闭码: {code}")
+            self.close(1000)
+        elif opcode in (OPCODE_TEXT, OPCODE_BINARY):
+            if fin:
+                self.deliver(opcode, payload)
+            else:
+                self.fragments = bytearray(payload)
+                self.fragment_opcode = opcode
+        elif opcode == OPCODE_CONTINUATION and self.fragments is not None:
+            self.fragments += payload
+            if len(self.fragments) > MAX_MESSAGE_SIZE:
+                logger.error("WebSocket分片消息长度超过上限，关闭连接")
+                self.close(1009)
+            elif fin:
+                message, self.fragments = bytes(self.fragments), None
+                self.deliver(self.fragment_opcode, message)
+        else:
+            logger.warning(f"WebSocket收到未知类型的帧，opcode: {opcode}")
+
+    def deliver(self, opcode, payload):
+        self.client.metrics.record_received(len(payload))
+        if opcode == OPCODE_TEXT:
+            payload = payload.decode("utf-8", errors="replace")
+        self.client.on_message(payload)
+
+    def write_frame(self, opcode, payload: bytes):
+        if self.transport and not self.closing:
+            self.transport.write(encode_frame(opcode, payload))
+
+    def close(self, code=1000):
+        """发送关闭帧后关闭连接，缓冲区中的数据写完后才会真正关闭"""
+        if self.transport and not self.closing:
+            self.transport.write(encode_frame(OPCODE_CLOSE, struct.pack(">H", code)))
+            self.closing = True
+            self.transport.close()
 
 
 class WebSocketClient:
+    """
+    WebSocket客户端，对外保持同步接口，内部在共用的事件循环上收发
+    绑定本地IP建连，效果与 socket.create_connection(source_address=(local_ip, 0)) 相同，
+    断线后交给重连调度器按指数退避重连，重连成功后调用业务层回调恢复会话
+    """
+
     def __init__(self):
-        self.ws: Union[websocket.WebSocket, None] = None
+        self.protocol: Union[WebSocketProtocol, None] = None    # 当前连接的协议实例
         self.local_ip = None  # 用来连接服务器的设备IP
+        self.server_ip = None   # 服务器IP
+        self.server_port = None     # 服务器端口
         self.server_url = ""    # 服务器地址，需要以ws://或wss://开头
-        self.receive_callback = None  # 处理服务器下发数据的回调函数
+        self.receive_callback = None  # 处理服务器下发数据的回调函数，支持协程函数
         self.disconnect_callback = None  # 处理主动断开连接时的回调函数
-        self.connected = False
+        self.reconnect_callback = None  # 断线自动重连成功后恢复业务会话的回调函数
+        self.manual_disconnect = None   # 手动断开连接的标志
+        self.connect_timeout = 5    # 建连和握手的超时时间，单位为秒
+        self.metrics = local_slot()     # 收发计数槽，批量设备由所在进程替换为共享计数表中的槽
+        self.telemetry = telemetry.device("websocket")  # 指标记录入口，业务层设置设备类型和设备标签
+        self.command_code_reader = None     # 从上行消息中取命令码的函数，用于按命令码统计，未设置时命令码为空
 
     def connect(self, server_url, server_ip, server_port, local_ip):
         """
-        连接到服务器
-        由于websocket协议抽象掉了底层的TCP套接字操作，不支持自定义绑定本地IP来连接
-        因此先通过基础socket创建一个绑定了本地IP地址的套接字，然后将其传递给websocket来实现指定本地地址的websocket
-
-        :param local_ip: 本地IP地址
+        连接到服务器，阻塞等待握手完成，失败时抛出异常
         :param server_url: websocket地址，要求格式 ws://{server_ip}:8080/device-access/lcd/{network_lcd_ip}&0
-        :param server_ip: 服务器端口号
-        :param server_port: 服务器IP
-        :return:
+        :param server_ip: 服务器IP
+        :param server_port: 服务器端口号
+        :param local_ip: 本地IP地址
         """
-        self.local_ip = local_ip
-        # 创建底层socket
-        sock = socket.create_connection(
-            (server_ip, server_port),
-            timeout=5,
-            source_address=(self.local_ip, 0)
-        )
-
         self.server_url = server_url
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self.local_ip = local_ip
+        self.manual_disconnect = False
         try:
-            self.ws = websocket.WebSocket()
-            self.ws.connect(server_url, socket=sock, timeout=5)     # 通过自定义的套接字sock连接
-            self.connected = True
+            shared_event_loop.run(self.open(), timeout=self.connect_timeout * 2)
+            reconnect_scheduler.cancel(self)    # 手动连接成功，取消尚未执行的重连
             logger.debug(f"成功连接到WebSocket服务器：{server_url}")
-            # 启动线程接收数据
-            threading.Thread(target=self.receive_data, daemon=True).start()
         except Exception as e:
             logger.error(f"WebSocket连接失败，错误信息: {e}")
-            self.connected = False
+            reconnect_scheduler.schedule(self)  # 启动断线重连
             raise e
 
+    async def open(self):
+        """在事件循环中建立TCP连接并完成WebSocket握手"""
+        if not is_valid_ip(self.local_ip):
+            raise ValueError(f"无效的本地IP地址: {self.local_ip}")
+        url = urlsplit(self.server_url)
+        if url.scheme not in ("ws", "wss"):
+            raise ValueError(f"WebSocket地址需要以ws://或wss://开头: {self.server_url}")
+        path = url.path or "/"
+        if url.query:
+            path = f"{path}?{url.query}"
+        # 同一端口配置了多个目标服务器时按一致性哈希选择，握手的Host随实际连接的目标变化
+        self.server_ip = target_pool.select(self.server_port, self.local_ip, self.server_ip)
+        netloc = url.netloc if url.hostname == self.server_ip else f"{self.server_ip}:{self.server_port}"
+        loop = asyncio.get_running_loop()
+        handshake_waiter = loop.create_future()
+        try:
+            _, protocol = await asyncio.wait_for(
+                loop.create_connection(
+                    lambda: WebSocketProtocol(self, netloc, path, handshake_waiter),
+                    self.server_ip, self.server_port,
+                    local_addr=(self.local_ip, 0),
+                    ssl=url.scheme == "wss" or None,
+                    server_hostname=url.hostname if url.scheme == "wss" else None,
+                ),
+                timeout=self.connect_timeout,
+            )
+        except Exception:
+            target_pool.report_failure(self.server_port, self.server_ip)
+            raise
+        self.protocol = protocol
+        try:
+            await asyncio.wait_for(handshake_waiter, timeout=self.connect_timeout)
+        except Exception:
+            self.protocol = None
+            if protocol.transport:
+                protocol.transport.abort()
+            target_pool.report_failure(self.server_port, self.server_ip)
+            raise
+        target_pool.report_success(self, self.server_port, self.server_ip)
+        self.telemetry.count(CONNECTS_TOTAL)
+        self.metrics.set(CONNECTION_STATE, CONNECTED)   # 没有注册流程，握手完成即可收发
+
+    def open_connection(self):
+        """供重连调度器调用的建连方法，成功返回True"""
+        try:
+            shared_event_loop.run(self.open(), timeout=self.connect_timeout * 2)
+            return True
+        except Exception as e:
+            logger.error(f"WebSocket重连失败，错误信息: {e}")
+            return False
+
     def send_data(self, data: Union[str, bytes], need_log=True):
-        """发送数据到服务器"""
-        if self.ws and self.connected:
-            try:
-                if isinstance(data, str):
-                    self.ws.send(data)
-                elif isinstance(data, bytes):
-                    self.ws.send(data, opcode=websocket.ABNF.OPCODE_BINARY)  # 发送二进制帧
-                else:
-                    logger.error("发送的数据必须是字符串或二进制数据")
-
-                if need_log:
-                    logger.info(f"websocket发送数据：{data}")
-                else:
-                    logger.debug(f"websocket发送数据: {data}")
-            except Exception as e:
-                logger.error(f"websocket发送数据失败: {e}")
-                raise e
-        else:
+        """发送数据到服务器，可在任意线程调用，实际写入在事件循环线程中执行"""
+        protocol = self.protocol
+        if not self.is_connected():
+            self.count_error(SEND_ERRORS_TOTAL)
             logger.error("websocket尝试发送数据，但是还未与服务器建立连接")
             raise Exception("websocket尝试发送数据，但是还未与服务器建立连接")
+        if isinstance(data, str):
+            opcode, payload = OPCODE_TEXT, data.encode("utf-8")
+        elif isinstance(data, bytes):
+            opcode, payload = OPCODE_BINARY, data   # 发送二进制帧
+        else:
+            logger.error("发送的数据必须是字符串或二进制数据")
+            return
+        # 经过全局、服务器端口、设备三级限速，令牌不足时推迟写入，不阻塞调用方
+        wait = send_rate_limiter.reserve(self.server_port, self.local_ip, len(payload))
+        # 实际写入在事件循环线程中执行，跨度只记录提交写入的时间和限速推迟的时间
+        with tracer.span("ws.send", "transport", bytes=len(payload), deferMs=round(max(wait, 0) * 1000, 3)):
+            if wait > 0:
+                shared_event_loop.call_later(wait, protocol.write_frame, opcode, payload)
+            else:
+                shared_event_loop.call_soon(protocol.write_frame, opcode, payload)
+        target_pool.record_sent(self.server_port, self.server_ip, len(payload))
+        self.metrics.record_sent(len(payload))
+        self.telemetry.frame_sent(self.command_code_reader(data) if self.command_code_reader else "", len(payload))
+        if packet_capture.enabled:
+            packet_capture.record(self.local_ip, SENT, payload)
+        if packet_log.sample(self.local_ip):
+            if need_log:
+                logger.info("websocket发送数据：{}", data)
+            else:
+                logger.debug("websocket发送数据: {}", data)
+
+    def on_message(self, data):
+        """收到完整消息，交给业务层回调处理，回调为协程函数时在事件循环中创建任务执行"""
+        if packet_capture.enabled:
+            packet_capture.record(self.local_ip, RECEIVED, data)
+        if packet_log.sample(self.local_ip):
+            logger.debug("websocket接收到原始数据: {}", data)
+        if not self.receive_callback:
+            return
+        try:
+            result = self.receive_callback(data)
+            if asyncio.iscoroutine(result):
+                shared_event_loop.spawn_callback(result)
+        except Exception as e:
+            logger.error(f"websocket处理服务器数据时出现未知错误: {e}")
 
-    def receive_data(self):
-        """监听来自服务器的数据并调用回调处理"""
-        while self.connected:
-            try:
-                if not self.ws:
-                    logger.error("WebSocket未连接，停止接收数据")
-                    break
-
-                data = self.ws.recv()  # 阻塞等待接收数据
-                if data:
-                    logger.debug(f"websocket接收到原始数据: {data}")
-                    if self.receive_callback:
-                        self.receive_callback(data)  # 调用回调函数处理数据
-            except websocket.WebSocketTimeoutException:
-                continue  # 超时大概率是服务器一段时间内没有返回数据，可忽略
-            except websocket.WebSocketConnectionClosedException:
-                logger.warning("WebSocket连接已关闭")
-                self.disconnect()
-                break
-            except Exception as e:
-                logger.error(f"websocket接收服务器数据时出现未知错误: {e}")
+    def on_connection_lost(self, protocol, exc):
+        """连接断开，只有断开的仍是当前连接时才触发重连，避免手动重连后旧连接的关闭影响新连接"""
+        if self.protocol is not protocol:
+            return
+        self.protocol = None
+        self.metrics.set(CONNECTION_STATE, DISCONNECTED)
+        logger.warning(f"WebSocket连接已关闭: {exc}")
+        if not self.manual_disconnect and self.server_ip is not None:
+            reconnect_scheduler.schedule(self)
+
+    def close_socket(self):
+        """关闭当前连接，不改变重连状态"""
+        protocol, self.protocol = self.protocol, None
+        self.metrics.set(CONNECTION_STATE, DISCONNECTED)
+        if protocol:
+            shared_event_loop.call_soon(protocol.close, 1000)
 
     def disconnect(self):
         """断开连接"""
-        if self.ws:
-            try:
-                self.ws.close()
-                self.ws = None
-                self.connected = False
-                logger.info("WebSocket连接已断开")
-            except Exception as e:
-                logger.error(f"断开WebSocket连接失败: {e}")
+        self.manual_disconnect = True
+        reconnect_scheduler.cancel(self)
+        if self.protocol:
+            self.close_socket()
+            logger.info("WebSocket连接已断开")
 
     def is_connected(self):
-        return self.connected
+        protocol = self.protocol
+        return protocol is not None and protocol.transport is not None and not protocol.closing
+
+    def get_send_queue_bytes(self):
+        """事件循环中尚未写入套接字的字节数，供指标输出使用"""
+        protocol = self.protocol
+        if protocol is None or protocol.transport is None:
+            return None
+        return protocol.transport.get_write_buffer_size()
+
+    def count_error(self, name):
+        """记录一次发送失败或解包失败，同时计入指标和计数槽"""
+        self.telemetry.count(name)
+        self.metrics.add(ERRORS)
+
+    def set_telemetry(self, device_telemetry, command_code_reader=None):
+        """设置指标记录入口和上行消息的命令码读取函数，并登记到注册表"""
+        self.telemetry = device_telemetry
+        self.command_code_reader = command_code_reader
+        telemetry.track(self)
 
     def set_receive_callback(self, callback):
         """设置接收数据的回调函数"""
@@ -120,3 +405,7 @@ class WebSocketClient:
     def set_disconnect_callback(self, callback):
         """设置主动断开连接时的回调函数"""
         self.disconnect_callback = callback
+
+    def set_reconnect_callback(self, callback):
+        """设置断线自动重连成功后的回调函数"""
+        self.reconnect_callback = callback
@@ -6,8 +6,20 @@
 # @Software: PyCharm
 # @description:
 
-from typing import Union
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Union
+from core.cluster import ClusterCoordinator
 from core.configer import config
+from core.device_timeseries import device_timeseries
+from core.fleet_status import FleetStatusTable, compress
+from core.fleet_workers import FLEET_COMMANDS, SNAPSHOT_SOURCES, FleetSupervisor, RemoteServiceProxy
+from core.heartbeat_monitor import HeartbeatMonitor, heartbeat_monitor
+from core.ip_pool import SourceIPPool
+from core.metrics_table import MetricsTable
+from core.resource_monitor import ResourceMonitor, resource_monitor
+from core.telemetry import Telemetry, telemetry
+from core.link_profile import LinkProfile
 from core.logger import logger
 from apps.channel_camera.services import ChannelCameraService
 from apps.parking_camera.services import ParkingCameraService
@@ -24,6 +36,14 @@ class DeviceManager:
     network_led_service: Union[NetworkLedService, None] = None      # 网络led屏服务实例
     network_lcd_service: Union[NetworkLcdService, None] = None      # lcd一体屏服务实例
     parking_camera_service: Union[ParkingCameraService, None] = None   # 车位相机服务实例
+    fleet_services: Dict[str, dict] = {}    # 批量设备服务实例，按设备类型分组，组内以设备序号为key
+    fleet_supervisor: Union[FleetSupervisor, None] = None   # 批量设备分片到多个工作进程时的进程管理器
+    fleet_devices: List[tuple] = []     # 所有批量设备的 (设备类型, 设备序号, 源IP)，顺序与计数表的槽一致
+    fleet_metrics: Union[MetricsTable, None] = None     # 批量设备的共享内存计数表
+    fleet_status: Union[FleetStatusTable, None] = None  # 批量设备的列式状态表，与计数表的槽顺序一致
+    cluster_coordinator: Union[ClusterCoordinator, None] = None     # 本机作为集群协调器时，批量设备全部由代理运行
+    fleet_connect_stop: Union[threading.Event, None] = None     # 注销设备时通知后台连接线程不再连接剩余的批量设备
+    IP_MULTIPLEXABLE_DEVICES = ("channel_camera",)     # 服务器按注册包中的设备编号区分设备，允许多台共用一个源IP
 
     @classmethod
     def initialize_all_devices(cls):
@@ -41,6 +61,8 @@ class DeviceManager:
             parking_camera_ip = config['devices_addr']['parking_camera_ip']
             parking_camera_device_type = config["devices_info"]["parking_camera"]["device_type"]
             parking_camera_device_version = config["devices_info"]["parking_camera"]["device_version"]
+            parking_camera_link_profile = LinkProfile.from_config(config["devices_info"]["parking_camera"].get("link_profile"))
+            parking_camera_upload_resume = dict(config["devices_info"]["parking_camera"].get("upload_resume") or {})
             # lora节点配置参数
             lora_node_ip = config['devices_addr']['lora_node_ip']
             # 四字节网络节点配置参数
@@ -70,7 +92,8 @@ class DeviceManager:
         try:
             # 初始化设备实例
             cls.parking_camera_service = ParkingCameraService(server_ip, 7799, parking_camera_ip,
-                                                              parking_camera_device_type, parking_camera_device_version)
+                                                              parking_camera_device_type, parking_camera_device_version,
+                                                              parking_camera_link_profile, parking_camera_upload_resume)
             # 连接服务器后自动注册并开始心跳
             cls.parking_camera_service.connect()
             logger.info("车位相机设备初始化成功")
@@ -119,10 +142,274 @@ class DeviceManager:
         except Exception as e:
             raise Exception(f"网络lcd一体屏初始化失败: {e}")
 
+        # 单台设备各自使用进程内的计数槽，时间序列以设备名称标识
+        for name, service in (("channel_camera", cls.channel_camera_service),
+                              ("parking_camera", cls.parking_camera_service),
+                              ("lora_node", cls.lora_node_service),
+                              ("four_bytes_node", cls.four_bytes_node_service),
+                              ("network_led", cls.network_led_service),
+                              ("network_lcd", cls.network_lcd_service)):
+            device_timeseries.add_table(service.client.metrics.table, [name])
+
+    @classmethod
+    def plan_fleet(cls, ip_pool: SourceIPPool, fleet_configs=None):
+        """
+        按fleet配置为批量设备分配源IP，只分配不连接
+        :param fleet_configs: 各设备类型的网段和数量，默认为配置文件的fleet节点，集群代理传入协调器分配的分片
+        :return: ({设备类型: 每台设备的源IP列表}, 各设备类型的分配汇总)
+        """
+        plan = {}
+        summaries = []
+        fleet_configs = config.get("fleet") if fleet_configs is None else fleet_configs
+        for device_type, fleet_config in (fleet_configs or {}).items():
+            count = fleet_config.get("count", 0)
+            if not count:
+                continue
+            ips, summary = ip_pool.allocate(device_type, fleet_config["cidr"], count,
+                                            multiplexable=device_type in cls.IP_MULTIPLEXABLE_DEVICES,
+                                            max_devices_per_ip=fleet_config.get("max_devices_per_ip", 0))
+            plan[device_type] = ips
+            summaries.append(summary)
+        return plan, summaries
+
+    @classmethod
+    def initialize_fleet(cls, plan: Dict[str, List[str]], first_indices: Dict[str, int] = None):
+        """
+        按分配结果初始化批量设备，单台设备初始化失败不影响其他设备
+        设备在后台线程中并发连接服务器，不等待连接完成，连接进度见状态表的connectPending和各设备的连接状态
+        fleet_workers.processes大于0时设备分片到多个工作进程，本进程只负责转发指令
+        :param first_indices: 各设备类型第一台设备的序号，默认为1，集群代理按协调器分配的分片传入，保证序号全局唯一
+        """
+        server_ip = config['server']['host']
+        workers_config = config.get("fleet_workers") or {}
+        first_indices = first_indices or {}
+        # 每台批量设备在共享内存计数表中占一个槽，槽的顺序即fleet_devices的顺序
+        cls.fleet_devices = [(device_type, index, local_ip) for device_type, ips in plan.items()
+                             for index, local_ip in enumerate(ips, start=first_indices.get(device_type, 1))]
+        cls.fleet_metrics = MetricsTable.create(len(cls.fleet_devices))
+        cls.fleet_status = FleetStatusTable(cls.fleet_devices)
+        device_timeseries.add_table(cls.fleet_metrics, [cls.fleet_device_id(device_type, index)
+                                                        for device_type, index, _ in cls.fleet_devices], fleet=True)
+        if cls.fleet_devices and workers_config.get("processes", 0) > 0:
+            cls.fleet_supervisor = FleetSupervisor.from_config(workers_config)
+            cls.fleet_supervisor.start(cls.fleet_devices, server_ip, cls.fleet_metrics.name)
+            return
+        failed = 0
+        services = []
+        for slot, (device_type, index, local_ip) in enumerate(cls.fleet_devices):
+            try:
+                service = cls.create_service(device_type, server_ip, local_ip, index)
+                service.client.metrics = cls.fleet_metrics.slot(slot)
+                cls.fleet_services.setdefault(device_type, {})[index] = service
+                resource_monitor.track(device_type, service)
+                services.append((device_type, index, service))
+            except Exception as e:
+                failed += 1
+                logger.error(f"批量设备{device_type}第{index}台（{local_ip}）初始化失败: {e}")
+        if not services:
+            return
+        status, progress_lock = cls.fleet_status, threading.Lock()
+        status.connect_pending = len(services)
+
+        def on_connected():
+            with progress_lock:
+                status.connect_pending -= 1
+
+        def connect_all():
+            connect_failed = cls.connect_fleet_services(services, workers_config.get("connect_threads", 32),
+                                                        on_connected, stop)
+            logger.info(f"批量设备连接完成，共{len(cls.fleet_devices)}台，失败{failed + connect_failed}台")
+
+        stop = cls.fleet_connect_stop = threading.Event()
+        threading.Thread(target=connect_all, name="fleet-connect", daemon=True).start()
+        logger.info(f"批量设备初始化完成，共{len(cls.fleet_devices)}台，失败{failed}台，开始在后台连接服务器")
+
+    @staticmethod
+    def connect_fleet_services(services, connect_threads, on_connected=None, stop=None):
+        """
+        并发连接批量设备，不可达的设备各自占用一个线程等待连接超时，总耗时不随设备数累加
+        :param services: [(设备类型, 设备序号, 服务实例), ...]
+        :param on_connected: 每台设备连接结束（无论成功与否）后调用
+        :param stop: 设置后不再连接尚未开始的设备
+        :return: 连接失败的设备数
+        """
+        def connect(device_type, index, service):
+            if stop is not None and stop.is_set():
+                return True
+            try:
+                service.connect()
+                return True
+            except Exception as e:
+                logger.error(f"批量设备{device_type}第{index}台（{service.local_ip}）连接失败: {e}")
+                return False
+            finally:
+                if on_connected:
+                    on_connected()
+
+        with ThreadPoolExecutor(max_workers=connect_threads, thread_name_prefix="fleet-connect") as executor:
+            results = list(executor.map(lambda entry: connect(*entry), services))
+        return results.count(False)
+
+    @classmethod
+    def initialize_cluster_coordinator(cls):
+        """本机作为集群协调器，不在本机创建批量设备，把fleet配置拆成分片等待代理领取"""
+        cls.cluster_coordinator = ClusterCoordinator.from_config(config.get("cluster"), config.get("fleet"))
+        cls.cluster_coordinator.start()
+
+    @classmethod
+    def get_fleet_metrics(cls):
+        """
+        从共享内存计数表汇总批量设备的收发、重连、确认时延和队列深度，按设备和设备类型返回
+        本机作为集群协调器时汇总各代理最近一次上报的计数表
+        """
+        if cls.cluster_coordinator:
+            return cls.cluster_coordinator.aggregate()
+        if cls.fleet_metrics is None:
+            return {"devices": [], "types": {}}
+        return cls.fleet_metrics.aggregate(cls.fleet_devices)
+
+    @classmethod
+    def get_fleet_status(cls, device_types=None, state=None, ip_range=None, output_format="json", use_gzip=False):
+        """
+        每台批量设备的连接、注册、心跳状态、最近收发时间和错误数，按列序列化
+        直接读取共享内存计数表；作为集群协调器时读取各代理最近一次上报的计数表，设备随代理上下线变化，每次重建状态表
+        :param output_format: json 或 binary，binary的格式见FleetStatusTable.to_binary
+        :return: 序列化后的字节，use_gzip为True时为gzip压缩后的字节
+        """
+        if cls.cluster_coordinator:
+            devices, snapshot = cls.cluster_coordinator.snapshot()
+            status = FleetStatusTable(devices)
+        elif cls.fleet_metrics is not None:
+            status, snapshot = cls.fleet_status, cls.fleet_metrics.snapshot()
+            if cls.fleet_supervisor:
+                status.connect_pending = cls.fleet_supervisor.connect_pending()
+        else:
+            status, snapshot = FleetStatusTable([]), b""
+        columns = status.read(snapshot)
+        selected = status.select(columns, device_types, state, ip_range)
+        if output_format == "binary":
+            body = status.to_binary(columns, selected)
+        elif output_format == "json":
+            body = status.to_json(columns, selected)
+        else:
+            raise ValueError(f"不支持的输出格式: {output_format}")
+        return compress(body) if use_gzip else body
+
+    @classmethod
+    def render_telemetry(cls):
+        """按Prometheus文本格式输出本进程和所有工作进程的设备指标，以及各进程的资源占用"""
+        snapshots = [telemetry.snapshot()]
+        resources = [resource_monitor.snapshot()]
+        if cls.fleet_supervisor:
+            futures = cls.fleet_supervisor.request_snapshots("resources")
+            snapshots.extend(cls.fleet_supervisor.collect_snapshots("telemetry"))
+            resources.extend(cls.fleet_supervisor.gather_snapshots(futures).values())
+        return Telemetry.render(Telemetry.merge(snapshots)) + ResourceMonitor.render(resources)
+
+    @classmethod
+    def run_diagnostic(cls, source, extra_timeout=0, **kwargs):
+        """
+        在本进程和所有工作进程中执行同一项诊断，工作进程与本进程同时执行
+        :param source: SNAPSHOT_SOURCES中的名称，如profile、threads、tracemalloc、loop_lag
+        :param extra_timeout: 诊断本身持续的时间，等待工作进程返回时在指令超时之外多等待
+        :return: {"main": 本进程结果, "worker<编号>": 工作进程结果, ...}
+        """
+        futures = cls.fleet_supervisor.request_snapshots(source, **kwargs) if cls.fleet_supervisor else []
+        results = {"main": SNAPSHOT_SOURCES[source](**kwargs)}
+        if futures:
+            for worker_id, value in cls.fleet_supervisor.gather_snapshots(futures, extra_timeout).items():
+                results[f"worker{worker_id}"] = value
+        return results
+
+    @classmethod
+    def collect_trace(cls, trace_id=None, min_duration_ms=None, limit=None):
+        """汇总本进程和所有工作进程记录的追踪事件，各进程的事件按进程号区分，返回Chrome Trace Event格式的事件列表"""
+        results = cls.run_diagnostic("trace_events", trace_id=trace_id, min_duration_ms=min_duration_ms, limit=limit)
+        return [event for events in results.values() for event in events]
+
+    @classmethod
+    def get_device_labels(cls):
+        """源IP -> 使用该IP的设备名称列表，用于把按源IP命名的线程对应到设备"""
+        labels = {}
+        for name, address in (config.get("devices_addr") or {}).items():
+            labels.setdefault(address, []).append(name[:-len("_ip")] if name.endswith("_ip") else name)
+        for device_type, index, local_ip in cls.fleet_devices:
+            labels.setdefault(local_ip, []).append(f"{device_type}#{index}")
+        return labels
+
+    @classmethod
+    def get_heartbeat_stats(cls):
+        """汇总本进程和所有工作进程的心跳往返时延，按设备类型返回发送、返回、丢失次数和各窗口的分位数"""
+        snapshots = [heartbeat_monitor.snapshot()]
+        if cls.fleet_supervisor:
+            snapshots.extend(cls.fleet_supervisor.collect_snapshots("heartbeat"))
+        return heartbeat_monitor.summarize(HeartbeatMonitor.merge(snapshots))
+
+    @classmethod
+    def create_service(cls, device_type, server_ip, local_ip, index):
+        """创建一台批量设备的服务实例，设备参数与devices_info中的单台设备相同，通道相机的设备编号按序号递增"""
+        devices_info = config["devices_info"]
+        if device_type == "channel_camera":
+            device_id = cls.derive_device_id(devices_info["channel_camera"]["device_id"], index)
+            return ChannelCameraService(server_ip, 7799, local_ip, device_id,
+                                        devices_info["channel_camera"]["device_version"])
+        if device_type == "parking_camera":
+            parking_camera_info = devices_info["parking_camera"]
+            return ParkingCameraService(server_ip, 7799, local_ip,
+                                        parking_camera_info["device_type"], parking_camera_info["device_version"],
+                                        LinkProfile.from_config(parking_camera_info.get("link_profile")),
+                                        dict(parking_camera_info.get("upload_resume") or {}))
+        if device_type == "lora_node":
+            return LoraNodeService(server_ip, 7777, local_ip)
+        if device_type == "four_bytes_node":
+            return FourBytesNodeService(server_ip, 7777, local_ip)
+        if device_type == "network_led":
+            return NetworkLedService(server_ip, 7799, local_ip, devices_info["network_led"]["device_type"],
+                                     devices_info["network_led"]["device_version"])
+        if device_type == "network_lcd":
+            server_url = f"ws://{server_ip}:8080/device-access/lcd/{local_ip}&0"  # url固定格式，"&0"标识为LCD一体屏
+            return NetworkLcdService(server_ip, 8080, local_ip, server_url)
+        raise ValueError(f"不支持的批量设备类型: {device_type}")
+
+    @staticmethod
+    def fleet_device_id(device_type, index):
+        """批量设备在时间序列等按设备查询的接口中的标识，如 parking_camera-3"""
+        return f"{device_type}-{index}"
+
+    @staticmethod
+    def derive_device_id(base_device_id, index):
+        """在设备编号末尾的数字上加序号，保持原有位数，如 SY17711123 的第2台为 SY17711125"""
+        prefix = base_device_id.rstrip("0123456789")
+        digits = base_device_id[len(prefix):]
+        if not digits:
+            return f"{base_device_id}{index}"
+        return f"{prefix}{int(digits) + index:0{len(digits)}d}"
+
     @classmethod
     def shutdown_all_devices(cls):
         """注销所有设备"""
         logger.info("开始注销所有设备......")
+        if cls.cluster_coordinator:
+            cls.cluster_coordinator.stop()
+            cls.cluster_coordinator = None
+        if cls.fleet_supervisor:
+            cls.fleet_supervisor.stop()
+            cls.fleet_supervisor = None
+        if cls.fleet_connect_stop:
+            cls.fleet_connect_stop.set()
+            cls.fleet_connect_stop = None
+        for device_type, services in cls.fleet_services.items():
+            for service in services.values():
+                try:
+                    service.disconnect()
+                except Exception as e:
+                    logger.error(f"注销批量设备{device_type}（{service.local_ip}）失败: {e}")
+        cls.fleet_services = {}
+        if cls.fleet_metrics:
+            cls.fleet_metrics.close()
+            cls.fleet_metrics = None
+            cls.fleet_status = None
+            cls.fleet_devices = []
         if cls.channel_camera_service:
             cls.channel_camera_service.disconnect()
         if cls.parking_camera_service:
@@ -137,6 +424,32 @@ class DeviceManager:
             cls.network_lcd_service.disconnect()
         logger.info("所有设备注销成功")
 
+    @classmethod
+    def get_fleet_service(cls, device_type, index):
+        """
+        获取一台批量设备，设备在工作进程或集群代理中时返回转发指令的代理
+        :param index: 设备序号，从1开始
+        """
+        if cls.cluster_coordinator:
+            if not cls.cluster_coordinator.has_device(device_type, index):
+                raise Exception(f"没有批量设备{device_type}第{index}台，或其所在的集群代理不在线")
+            return RemoteServiceProxy(cls.cluster_coordinator, device_type, index)
+        if cls.fleet_supervisor:
+            if not cls.fleet_supervisor.has_device(device_type, index):
+                raise Exception(f"没有批量设备{device_type}第{index}台")
+            return RemoteServiceProxy(cls.fleet_supervisor, device_type, index)
+        service = cls.fleet_services.get(device_type, {}).get(index)
+        if service is None:
+            raise Exception(f"没有批量设备{device_type}第{index}台")
+        return service
+
+    @classmethod
+    def execute_fleet_command(cls, device_type, index, command, kwargs=None):
+        """对一台批量设备执行指令，设备在本进程或工作进程中的调用方式相同"""
+        if command not in FLEET_COMMANDS:
+            raise Exception(f"不支持转发给批量设备的指令: {command}")
+        return getattr(cls.get_fleet_service(device_type, index), command)(**(kwargs or {}))
+
     @classmethod
     def get_channel_camera_service(cls):
         """获取通道相机服务实例"""
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/27 10:00
+# @Author  : Heshouyi
+# @File    : device_timeseries.py
+# @Software: PyCharm
+# @description: 每台设备收发帧数、字节数、错误数和连接状态的时间序列，最近一段按秒保存，更早的按分钟保存，内存固定
+
+import threading
+import time
+from array import array
+from itertools import repeat
+from operator import add, sub
+from core.configer import config
+from core.logger import logger
+from core.metrics_table import CONNECTION_STATE, ERRORS, RECEIVED_BYTES, RECEIVED_PACKETS, SENT_BYTES, \
+    SENT_PACKETS, SLOT_WIDTH
+
+# 按秒保存的计数字段：(输出字段名, 计数槽字段, 数组类型)，每秒的增量超出类型范围时按上限保存
+SECOND_FIELDS = (
+    ("sentFrames", SENT_PACKETS, "H"),
+    ("receivedFrames", RECEIVED_PACKETS, "H"),
+    ("sentBytes", SENT_BYTES, "I"),
+    ("receivedBytes", RECEIVED_BYTES, "I"),
+    ("errors", ERRORS, "H"),
+)
+MINUTE_TYPECODE = "I"       # 按分钟保存的计数字段的数组类型
+TYPE_LIMITS = {"B": 0xFF, "H": 0xFFFF, "I": 0xFFFFFFFF}
+
+
+def zeros(typecode, length):
+    return array(typecode, [0]) * length
+
+
+def clamp(values, limit):
+    """把增量限制在[0, limit]内，计数表被替换或关闭后计数归零时增量为负；通常都在范围内，先整体检查再逐个处理"""
+    values = list(values)
+    if not values or (min(values) >= 0 and max(values) <= limit):
+        return values
+    return list(map(min, map(max, values, repeat(0)), repeat(limit)))
+
+
+class DeviceTimeSeries:
+    """
+    设备时间序列，定时读取计数表中各设备的累计计数，按每秒的增量写入环形缓冲区
+    缓冲区按列保存，每个字段一个array，按时间位置 × 设备排列，一秒的所有设备连续存放，写入是一次切片赋值
+    最近second_buckets秒按秒保存，每分钟把该分钟的增量之和写入按分钟保存的环形缓冲区，保留minute_buckets分钟
+    所有缓冲区在启动时按设备数一次分配，之后不再增长，总占用超过memory_budget_mb时不启动
+    批量设备默认不记录，fleet为True时才登记；批量设备分片到工作进程时，工作进程直接写入共享内存计数表，由主进程统一采样；
+    作为集群协调器时只记录本机的单台设备
+    """
+
+    def __init__(self, enabled=True, fleet=False, second_buckets=3600, minute_buckets=1440, memory_budget_mb=256):
+        self.enabled = enabled
+        self.fleet = fleet                      # 是否记录批量设备
+        self.second_buckets = second_buckets    # 按秒保存的秒数
+        self.minute_buckets = minute_buckets    # 按分钟保存的分钟数
+        self.memory_budget = memory_budget_mb * 1024 * 1024     # 缓冲区总占用上限，单位为字节，0表示不限
+        self.sources = []       # [(计数表, 设备数)]，按登记顺序排列，各表的设备依次编号
+        self.device_ids = []    # 设备标识，顺序即缓冲区中的设备列
+        self.columns = {}       # 设备标识 -> 设备列
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.seconds = {}       # 字段名 -> array，下标为 时间位置 * 设备数 + 设备列
+        self.minutes = {}
+        self.second_times = None    # 每个时间位置当前保存的是哪一秒，没有数据时为-1
+        self.minute_times = None    # 每个时间位置当前保存的是哪一分钟的起始秒
+        self.previous = None        # 上一次采样的累计计数，字段 -> 各设备的值
+        self.accumulated = None     # 当前分钟内已采样的增量之和
+        self.minute = None          # 当前累计的分钟
+
+    @classmethod
+    def from_config(cls, timeseries_config):
+        """从配置文件的device_timeseries节点创建"""
+        timeseries_config = timeseries_config or {}
+        return cls(
+            enabled=timeseries_config.get("enabled", True),
+            fleet=timeseries_config.get("fleet", False),
+            second_buckets=timeseries_config.get("second_buckets", 3600),
+            minute_buckets=timeseries_config.get("minute_buckets", 1440),
+            memory_budget_mb=timeseries_config.get("memory_budget_mb", 256),
+        )
+
+    def add_table(self, table, device_ids, fleet=False):
+        """
+        登记一张计数表中的设备，需在start之前调用
+        :param table: MetricsTable，批量设备的共享计数表或单台设备的进程内计数表
+        :param device_ids: 与计数槽顺序一致的设备标识
+        :param fleet: 是否为批量设备，未开启fleet时不登记
+        """
+        if fleet and not self.fleet:
+            return
+        for device_id in device_ids:
+            self.columns[device_id] = len(self.device_ids)
+            self.device_ids.append(device_id)
+        self.sources.append((table, len(device_ids)))
+
+    def bytes_per_device(self):
+        second_size = sum(array(typecode).itemsize for _, _, typecode in SECOND_FIELDS) + 1   # 连接状态为1字节
+        minute_size = len(SECOND_FIELDS) * array(MINUTE_TYPECODE).itemsize + 1     # 连接秒数为1字节
+        return second_size * self.second_buckets + minute_size * self.minute_buckets
+
+    def memory_bytes(self):
+        """按当前登记的设备数计算的缓冲区总占用"""
+        return self.bytes_per_device() * len(self.device_ids)
+
+    def start(self):
+        """按设备数分配缓冲区并启动采样线程，总占用超过上限时不启动"""
+        if not self.enabled or not self.device_ids:
+            return
+        count = len(self.device_ids)
+        if self.memory_budget and self.memory_bytes() > self.memory_budget:
+            logger.error(f"设备时间序列共{count}台设备需占用{self.memory_bytes() // 1024 // 1024}MB，"
+                         f"超过上限{self.memory_budget // 1024 // 1024}MB，不启动，请调小second_buckets/minute_buckets"
+                         f"或调大memory_budget_mb")
+            return
+        self.seconds = {name: zeros(typecode, count * self.second_buckets) for name, _, typecode in SECOND_FIELDS}
+        self.seconds["connectionState"] = zeros("B", count * self.second_buckets)
+        self.minutes = {name: zeros(MINUTE_TYPECODE, count * self.minute_buckets) for name, _, _ in SECOND_FIELDS}
+        self.minutes["connectedSeconds"] = zeros("B", count * self.minute_buckets)
+        self.second_times = array("q", [-1]) * self.second_buckets
+        self.minute_times = array("q", [-1]) * self.minute_buckets
+        self.previous = self.read_counters()
+        self.reset_accumulated()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="device-timeseries", daemon=True)
+        self.thread.start()
+        logger.info(f"设备时间序列已启动，共{count}台设备，每台设备占用{self.bytes_per_device() // 1024}KB")
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=2)
+            self.thread = None
+
+    def run(self):
+        """在每秒开始时采样上一秒的增量，采样线程被推迟超过一秒时跳过的秒没有数据"""
+        next_second = int(time.time()) + 1
+        while not self.stop_event.wait(max(0.0, next_second - time.time())):
+            try:
+                self.sample(next_second - 1)
+            except Exception as e:
+                logger.error(f"设备时间序列采样失败: {e}")
+            next_second = max(next_second + 1, int(time.time()) + 1)
+
+    def read_counters(self):
+        """读取所有计数表，返回 字段 -> 按设备列排列的值"""
+        fields = [field for _, field, _ in SECOND_FIELDS] + [CONNECTION_STATE]
+        counters = {field: [] for field in fields}
+        for table, count in self.sources:
+            values = table.view.tolist()
+            for field in fields:
+                counters[field].extend(values[field:count * SLOT_WIDTH:SLOT_WIDTH])
+        return counters
+
+    def reset_accumulated(self):
+        count = len(self.device_ids)
+        self.accumulated = {name: [0] * count for name in self.minutes}
+
+    def sample(self, second):
+        """把从上一次采样到现在的增量记为second这一秒"""
+        current = self.read_counters()
+        count = len(self.device_ids)
+        with self.lock:
+            minute = second - second % 60
+            if self.minute is not None and minute != self.minute:
+                self.roll_up()
+            self.minute = minute
+            start = (second % self.second_buckets) * count
+            for name, field, typecode in SECOND_FIELDS:
+                deltas = clamp(map(sub, current[field], self.previous[field]), TYPE_LIMITS[typecode])
+                self.seconds[name][start:start + count] = array(typecode, deltas)
+                self.accumulated[name] = list(map(add, self.accumulated[name], deltas))
+            states = current[CONNECTION_STATE]
+            self.seconds["connectionState"][start:start + count] = array("B", states)
+            self.accumulated["connectedSeconds"] = list(map(add, self.accumulated["connectedSeconds"], map(bool, states)))
+            self.second_times[second % self.second_buckets] = second
+            self.previous = current
+
+    def roll_up(self):
+        """把当前分钟的增量之和写入按分钟保存的缓冲区，调用方持有锁"""
+        count = len(self.device_ids)
+        start = (self.minute // 60 % self.minute_buckets) * count
+        for name, values in self.accumulated.items():
+            typecode = self.minutes[name].typecode
+            self.minutes[name][start:start + count] = array(typecode, clamp(values, TYPE_LIMITS[typecode]))
+        self.minute_times[self.minute // 60 % self.minute_buckets] = self.minute
+        self.reset_accumulated()
+
+    def query(self, device_id, since=None):
+        """
+        一台设备的时间序列，按秒的部分从按秒缓冲区中第一个完整的分钟开始，更早的部分按分钟返回，两部分在时间上首尾相接
+        :param since: 只返回该时间（秒级时间戳）之后的数据
+        :return: {"seconds": {...}, "minutes": {...}}，各部分包含起始时间、间隔和按字段排列的值，缺少数据的时间为None
+        """
+        column = self.columns.get(device_id)
+        if column is None:
+            raise Exception(f"设备{device_id}不存在或未记录时间序列")
+        if self.second_times is None:
+            raise Exception("设备时间序列未开启")
+        count = len(self.device_ids)
+        with self.lock:
+            last_second = max(self.second_times)
+            if last_second < 0:
+                return {"deviceId": device_id, "seconds": None, "minutes": None}
+            first_second = last_second - self.second_buckets + 1
+            first_second += -first_second % 60     # 对齐到分钟，之前的秒由按分钟的部分覆盖
+            last_minute = first_second - 60
+            latest_minute = max(self.minute_times)
+            # 更早的分钟已被覆盖；还没有完整的分钟时按分钟的部分为空
+            first_minute = latest_minute - (self.minute_buckets - 1) * 60 if latest_minute >= 0 else last_minute + 60
+            if since is not None:
+                first_second = max(first_second, int(since))
+                first_minute = max(first_minute, int(since) - int(since) % 60)
+            seconds = self.extract(self.seconds, self.second_times, column, count, first_second, last_second, 1)
+            minutes = self.extract(self.minutes, self.minute_times, column, count, first_minute, last_minute, 60)
+        return {"deviceId": device_id, "seconds": seconds, "minutes": minutes}
+
+    @staticmethod
+    def extract(buffers, times, column, count, first, last, step):
+        """按时间顺序取出一台设备在[first, last]内的数据，调用方持有锁"""
+        buckets = len(times)
+        timestamps = range(first, last + 1, step)
+        positions = [timestamp // step % buckets for timestamp in timestamps]
+        present = [times[position] == timestamp for timestamp, position in zip(timestamps, positions)]
+        series = {"start": first, "step": step, "count": len(timestamps)}
+        for name, buffer in buffers.items():
+            values = buffer[column::count]     # 该设备在各时间位置的值
+            series[name] = [values[position] if valid else None for position, valid in zip(positions, present)]
+        return series
+
+    def get_status(self):
+        return {"enabled": self.enabled, "fleet": self.fleet, "running": self.thread is not None,
+                "deviceCount": len(self.device_ids), "secondBuckets": self.second_buckets,
+                "minuteBuckets": self.minute_buckets, "bytesPerDevice": self.bytes_per_device(),
+                "memoryBytes": self.memory_bytes(), "memoryBudget": self.memory_budget, "devices": self.device_ids}
+
+
+device_timeseries = DeviceTimeSeries.from_config(config.get("device_timeseries"))
@@ -6,24 +6,30 @@
 # @Software: PyCharm
 # @description:
 
+import asyncio
 import psutil
 import socket
 from fastapi import FastAPI
+from core.connections.event_loop import shared_event_loop
 from core.device_manager import DeviceManager
+from core.device_timeseries import device_timeseries
+from core.ip_pool import SourceIPPool
 from core.logger import logger
+from core.packet_capture import packet_capture
+from core.resource_monitor import resource_monitor
 from core.configer import config
 
 
 def get_all_local_ips():
-    """获取本机所有网卡的IP地址"""
-    ips = []
+    """获取本机所有网卡的IP地址，以集合返回，便于O(1)校验"""
+    ips = set()
     try:
         # 获取所有网络接口
         for iface, addrs in psutil.net_if_addrs().items():
             for addr in addrs:
                 # 过滤出IPv4地址，用socket.AF_INET来过滤是因为psutil没有提供AF_INET常量
                 if addr.family == socket.AF_INET:
-                    ips.append(addr.address)
+                    ips.add(addr.address)
     except Exception as e:
         logger.error(f"获取本机所有IP地址失败: {e}")
     return ips
@@ -37,9 +43,10 @@ def register_startup_and_shutdown_events(app: FastAPI):
         """
         try:
             logger.info("开始检查当前环境是否满足配置文件中设备所需全部IP")
-            # 获取当前环境中的所有IP地址
+            # 获取当前环境中的所有IP地址，建立源IP池
             local_ips = get_all_local_ips()
-            logger.debug(f"当前环境的所有IP地址: {local_ips}")
+            logger.debug(f"当前环境共有{len(local_ips)}个IP地址")
+            ip_pool = SourceIPPool(local_ips)
 
             # 加载配置中的设备IP
             try:
@@ -52,16 +59,38 @@ def register_startup_and_shutdown_events(app: FastAPI):
                 raise Exception(f"获取配置文件所需的IP失败: {e}")
 
             # 检查配置的IP是否存在当前环境中
-            missing_ips = [ip for ip in required_ips if ip not in local_ips]
+            missing_ips = ip_pool.get_missing(required_ips)
             if missing_ips:
                 logger.error(f"环境缺少设备所需IP地址: {missing_ips}")
                 raise Exception(f"环境缺少设备所需IP地址：{missing_ips}")
+            ip_pool.reserve(required_ips)
+
+            # 按网段为批量设备分配源IP，有缺口时汇总后终止启动；作为集群协调器时批量设备由各代理在其主机上分配
+            is_coordinator = (config.get("cluster") or {}).get("role", "standalone") == "coordinator"
+            fleet_plan = {}
+            if not is_coordinator:
+                fleet_plan, fleet_summaries = DeviceManager.plan_fleet(ip_pool)
+                SourceIPPool.log_summary(fleet_summaries)
+                shortfalls = {summary["deviceType"]: summary["shortfall"]
+                              for summary in fleet_summaries if summary["shortfall"]}
+                if shortfalls:
+                    raise Exception(f"环境中批量设备的源IP不足，各设备类型缺少的数量: {shortfalls}")
 
             # 如果检测通过，初始化所有设备
             logger.info("环境满足，开始初始化设备")
+            # 设备回调中的数据库写入交回当前事件循环执行，与register_tortoise建立的连接在同一个循环
+            shared_event_loop.set_app_loop(asyncio.get_running_loop())
+            if packet_capture.enabled:
+                packet_capture.clear()
             try:
                 DeviceManager.initialize_all_devices()
                 logger.info("所有设备初始化成功")
+                if is_coordinator:
+                    DeviceManager.initialize_cluster_coordinator()
+                else:
+                    DeviceManager.initialize_fleet(fleet_plan)
+                resource_monitor.start()
+                device_timeseries.start()
             except Exception as e:
                 raise Exception(f"设备初始化失败: {e}")
 
@@ -77,7 +106,10 @@ def register_startup_and_shutdown_events(app: FastAPI):
         """
         try:
             logger.info("关闭引擎，注销所有设备中...")
+            device_timeseries.stop()
             DeviceManager.shutdown_all_devices()
+            shared_event_loop.set_app_loop(None)
+            resource_monitor.stop()
             logger.info("所有设备已成功注销")
         except Exception as e:
             logger.exception(f"注销设备时发生异常: {e}")
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/27 15:00
+# @Author  : Heshouyi
+# @File    : fleet_status.py
+# @Software: PyCharm
+# @description: 批量设备的状态表，按列保存设备类型、源IP、连接/注册/心跳状态、最近收发时间和错误数，支持过滤和紧凑序列化
+
+import gzip
+import ipaddress
+import json
+import socket
+import struct
+import sys
+import time
+from array import array
+from core.heartbeat_monitor import heartbeat_monitor
+from core.metrics_table import CONNECTED, CONNECTION_STATE, DISCONNECTED, ERRORS, HEARTBEAT_INTERVAL_MS, \
+    LAST_HEARTBEAT_MS, LAST_RECEIVED_MS, LAST_SENT_MS, REGISTERED, SLOT_WIDTH, STATE_NAMES
+from core.util import return_success_response
+
+# 从计数表中取出的列：(输出字段名, 计数槽字段)，均为int64，连接状态另外转为单字节的列
+METRIC_COLUMNS = (
+    ("lastReceivedMs", LAST_RECEIVED_MS),
+    ("lastSentMs", LAST_SENT_MS),
+    ("lastHeartbeatMs", LAST_HEARTBEAT_MS),
+    ("errors", ERRORS),
+)
+# 按状态过滤：已连接包含已注册的设备，心跳中指最近一次心跳在两个心跳间隔加返回超时内
+STATES = ("disconnected", "connected", "registered", "heartbeating")
+# 二进制格式：魔数, 版本, 列描述JSON的长度；之后是列描述JSON和按列连续存放的小端序数组
+BINARY_HEADER = struct.Struct("<4sHI")
+BINARY_MAGIC = b"FSTS"
+BINARY_VERSION = 1
+SMALL_INTS = [str(value) for value in range(256)]   # 单字节列按查表转为文本，比逐个格式化整数快数倍
+
+
+def ip_to_int(ip):
+    return int.from_bytes(socket.inet_aton(ip), "big")
+
+
+def encode_column(column):
+    """把一列编码为JSON数组"""
+    if column.typecode == "B":
+        return f"[{','.join(map(SMALL_INTS.__getitem__, column))}]"
+    return json.dumps(column.tolist(), separators=(",", ":"))
+
+
+def parse_ip_range(ip_range):
+    """
+    解析IP范围，支持网段（192.168.30.0/24）、起止地址（192.168.30.10-192.168.30.99）和单个地址
+    :return: (起始地址, 结束地址)，均为整数
+    :raises ValueError: 格式错误（ipaddress的AddressValueError）
+    """
+    if "/" in ip_range:
+        network = ipaddress.IPv4Network(ip_range.strip(), strict=False)
+        return int(network.network_address), int(network.broadcast_address)
+    first, _, last = ip_range.partition("-")
+    return int(ipaddress.IPv4Address(first.strip())), int(ipaddress.IPv4Address((last or first).strip()))
+
+
+class FleetStatusTable:
+    """
+    批量设备的列式状态表，每个字段一个array，下标即设备在计数表中的槽
+    设备类型、序号和源IP在创建时一次生成；状态列每次查询时从计数表的快照中按步长切出，不为每台设备创建对象
+    过滤只生成选中设备的下标，序列化时JSON按列输出，二进制直接输出各列的原始字节
+    """
+
+    def __init__(self, devices):
+        """:param devices: 与计数槽顺序一致的 [(设备类型, 设备序号, 源IP), ...]"""
+        self.device_types = sorted({device_type for device_type, _, _ in devices})
+        type_codes = {device_type: code for code, device_type in enumerate(self.device_types)}
+        self.count = len(devices)
+        self.type_codes = array("B", [type_codes[device_type] for device_type, _, _ in devices])
+        self.indices = array("I", [index for _, index, _ in devices])
+        self.ip_texts = [local_ip for _, _, local_ip in devices]
+        self.ips = array("I", [ip_to_int(local_ip) for local_ip in self.ip_texts])
+        self.static_json = None     # 不过滤时设备类型、序号和源IP列的JSON，首次输出时生成，之后不再变化
+        self.connect_pending = 0    # 本进程中启动后尚未完成首次连接的设备数，后台并发连接期间据此查看进度
+
+    def read(self, snapshot: bytes, now_ms=None):
+        """
+        从计数表快照中切出状态列，并按心跳间隔计算是否仍在心跳
+        :param snapshot: MetricsTable.snapshot()的结果，不足设备数的部分（如代理尚未上报）按0处理
+        :return: 字段名 -> array
+        """
+        values = array("q")
+        values.frombytes(snapshot[:self.count * SLOT_WIDTH * 8])
+        if len(values) < self.count * SLOT_WIDTH:
+            values.extend(array("q", [0]) * (self.count * SLOT_WIDTH - len(values)))
+        columns = {"connectionState": array("B", values[CONNECTION_STATE::SLOT_WIDTH])}
+        columns.update((name, values[field::SLOT_WIDTH]) for name, field in METRIC_COLUMNS)
+        now_ms = now_ms or int(time.time() * 1000)
+        reply_timeout_ms = int(heartbeat_monitor.reply_timeout * 1000)
+        columns["heartbeating"] = array("B", [
+            interval > 0 and now_ms - last <= 2 * interval + reply_timeout_ms
+            for interval, last in zip(values[HEARTBEAT_INTERVAL_MS::SLOT_WIDTH], columns["lastHeartbeatMs"])
+        ])
+        return columns
+
+    def select(self, columns, device_types=None, state=None, ip_range=None):
+        """
+        按设备类型、状态和IP范围过滤
+        :return: 选中设备的下标，没有过滤条件时返回None表示全部
+        """
+        if not device_types and not state and not ip_range:
+            return None
+        selected = range(self.count)
+        if device_types:
+            unknown = set(device_types) - set(self.device_types)
+            if unknown:
+                raise ValueError(f"不存在的批量设备类型: {sorted(unknown)}")
+            codes = {self.device_types.index(device_type) for device_type in device_types}
+            type_codes = self.type_codes
+            selected = [position for position in selected if type_codes[position] in codes]
+        if ip_range:
+            first, last = parse_ip_range(ip_range)
+            ips = self.ips
+            selected = [position for position in selected if first <= ips[position] <= last]
+        if state:
+            if state not in STATES:
+                raise ValueError(f"不支持的状态: {state}，可选 {STATES}")
+            if state == "heartbeating":
+                heartbeating = columns["heartbeating"]
+                selected = [position for position in selected if heartbeating[position]]
+            else:
+                states = columns["connectionState"]
+                if state == "disconnected":
+                    selected = [position for position in selected if states[position] == DISCONNECTED]
+                elif state == "connected":
+                    selected = [position for position in selected if states[position] >= CONNECTED]
+                else:
+                    selected = [position for position in selected if states[position] == REGISTERED]
+        return selected
+
+    def project(self, columns, selected):
+        """按选中的下标取出各列，包括设备类型、序号和源IP"""
+        columns = dict(columns, deviceType=self.type_codes, index=self.indices, ip=self.ips)
+        if selected is None:
+            return columns
+        return {name: array(column.typecode, map(column.__getitem__, selected)) for name, column in columns.items()}
+
+    def to_json(self, columns, selected):
+        """
+        按列输出的JSON，设备类型按deviceTypes字典编码，源IP输出为点分十进制
+        各列分别编码后拼接，外层与return_success_response的结构一致
+        """
+        if selected is None:
+            if self.static_json is None:
+                self.static_json = self.encode_static(range(self.count))
+            static_json = self.static_json
+        else:
+            static_json = self.encode_static(selected)
+            columns = {name: array(column.typecode, map(column.__getitem__, selected))
+                       for name, column in columns.items()}
+        header = {"count": self.count if selected is None else len(selected), "deviceTypes": self.device_types,
+                  "stateNames": STATE_NAMES, "connectPending": self.connect_pending}
+        fields = [json.dumps(header, separators=(",", ":"))[1:-1], static_json]
+        fields.extend(f'"{name}":{encode_column(column)}' for name, column in columns.items())
+        # 外层的其他字段逐个编码，data字段的值直接使用拼接好的各列
+        envelope = [f"{json.dumps(key)}:{json.dumps(value, ensure_ascii=False)}"
+                    for key, value in return_success_response(data=None).items() if key != "data"]
+        envelope.append(f'"data":{{{",".join(fields)}}}')
+        return f"{{{','.join(envelope)}}}".encode()
+
+    def encode_static(self, selected):
+        type_codes, indices, ip_texts = self.type_codes, self.indices, self.ip_texts
+        return (f'"deviceType":{encode_column(array("B", map(type_codes.__getitem__, selected)))},'
+                f'"index":{json.dumps(list(map(indices.__getitem__, selected)), separators=(",", ":"))},'
+                f'"ip":{json.dumps(list(map(ip_texts.__getitem__, selected)), separators=(",", ":"))}')
+
+    def to_binary(self, columns, selected):
+        """
+        二进制格式：文件头 + 列描述JSON + 各列的原始字节，列按描述中的顺序连续存放
+        列描述包含设备数、设备类型字典、尚未完成首次连接的设备数和每列的名称、数组类型（array/struct的类型码）和字节偏移
+        """
+        columns = self.project(columns, selected)
+        layout = []
+        offset = 0
+        for name, column in columns.items():
+            layout.append({"name": name, "type": column.typecode, "offset": offset, "itemSize": column.itemsize})
+            offset += len(column) * column.itemsize
+        header = json.dumps({"count": len(columns["index"]), "deviceTypes": self.device_types,
+                             "stateNames": STATE_NAMES, "connectPending": self.connect_pending, "byteOrder": "little",
+                             "columns": layout},
+                            separators=(",", ":")).encode()
+        body = [BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(header)), header]
+        for column in columns.values():
+            if column.itemsize > 1 and sys.byteorder == "big":
+                column = array(column.typecode, column)
+                column.byteswap()
+            body.append(column.tobytes())
+        return b"".join(body)
+
+
+def compress(body):
+    """gzip压缩，状态表中大量重复的时间和状态值压缩率高，用最快的压缩级别"""
+    return gzip.compress(body, compresslevel=1)
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/21 10:20
+# @Author  : Heshouyi
+# @File    : fleet_workers.py
+# @Software: PyCharm
+# @description: 批量设备的多进程分片，每个工作进程持有一部分设备和自己的事件循环，主进程通过管道转发接口指令
+
+import itertools
+import multiprocessing
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from core.connections.event_loop import shared_event_loop
+from core.logger import configure_worker_logging, logger
+from core.heartbeat_monitor import heartbeat_monitor
+from core.metrics_table import MetricsTable
+from core.packet_capture import packet_capture
+from core.profiler import dump_threads, measure_loop_lag, memory_tracer, sample_stacks
+from core.report_correlation import report_correlation
+from core.resource_monitor import resource_monitor
+from core.telemetry import telemetry
+from core.tracing import tracer
+
+# 允许通过接口转发给批量设备的指令，均为设备服务类上的公开方法
+FLEET_COMMANDS = (
+    "connect", "disconnect", "start_heartbeat", "stop_heartbeat",
+    "send_parking_status", "start_parking_status_report", "stop_reporting_parking_status",
+    "report_status", "start_reporting", "stop_reporting", "send_command",
+)
+# 可由主进程经管道请求的进程内统计快照和诊断，名称 -> 生成结果的函数，参数按关键字传入
+SNAPSHOT_SOURCES = {
+    "telemetry": telemetry.snapshot,
+    "heartbeat": heartbeat_monitor.snapshot,
+    "profile": sample_stacks,
+    "threads": dump_threads,
+    "tracemalloc": memory_tracer.handle,
+    "loop_lag": measure_loop_lag,
+    "resources": resource_monitor.snapshot,
+    "tracing": tracer.configure,
+    "trace_events": tracer.collect,
+}
+
+
+def run_worker(worker_id, shard, server_ip, metrics_name, slot_count, conn, command_threads=8, connect_threads=32):
+    """
+    工作进程入口：创建分片内的设备并连接服务器，之后循环执行主进程转发的指令
+    设备的收发、心跳和重连都在本进程的线程和事件循环中执行，不占用主进程的GIL
+    :param shard: {设备类型: [(设备序号, 源IP, 计数槽), ...]}
+    :param metrics_name: 主进程创建的共享内存计数表名称，设备只写入分配给自己的槽
+    :param conn: 与主进程通信的管道，收到None时退出，收到 ("snapshot", 指令编号, 快照名称, 参数) 时返回本进程的统计快照或诊断结果
+    :param connect_threads: 启动时并发连接设备的线程数
+    """
+    from core.device_manager import DeviceManager   # 工作进程中才导入设备服务，主进程导入本模块时不产生循环依赖
+    configure_worker_logging(worker_id)
+    if "network_led" in shard:
+        init_database()
+    metrics = MetricsTable.attach(metrics_name, slot_count)
+    send_lock = threading.Lock()
+
+    def forward_events(batch):
+        with send_lock:
+            conn.send(("correlation", batch))
+    report_correlation.start_forwarding(forward_events)    # 平台上报由主进程接收，发送的事件转发到主进程登记
+    packet_capture.set_name(f"worker{worker_id}")
+    resource_monitor.set_name(f"worker{worker_id}")
+    tracer.set_name(f"worker{worker_id}")
+    services = {}
+    for device_type, devices in shard.items():
+        for index, local_ip, slot in devices:
+            try:
+                service = DeviceManager.create_service(device_type, server_ip, local_ip, index)
+                service.client.metrics = metrics.slot(slot)
+                services[(device_type, index)] = service
+                resource_monitor.track(device_type, service)
+            except Exception as e:
+                logger.error(f"工作进程{worker_id}初始化批量设备{device_type}第{index}台（{local_ip}）失败: {e}")
+    failed = DeviceManager.connect_fleet_services([(device_type, index, service) for (device_type, index), service
+                                                   in services.items()], connect_threads)
+    logger.info(f"工作进程{worker_id}初始化完成，共{len(services)}台设备，连接失败{failed}台")
+    resource_monitor.start()
+    conn.send(("ready", len(services)))
+
+    def execute(request_id, device_type, index, command, kwargs):
+        try:
+            service = services.get((device_type, index))
+            if service is None:
+                raise Exception(f"工作进程{worker_id}中没有批量设备{device_type}第{index}台")
+            # 转发的指令在本进程中作为一次调用按采样比例追踪
+            with tracer.start_trace(f"fleet.{command}", "fleet", deviceType=device_type, index=index):
+                reply = (request_id, True, getattr(service, command)(**kwargs))
+        except Exception as e:
+            reply = (request_id, False, str(e))
+        with send_lock:
+            try:
+                conn.send(reply)
+            except Exception as e:  # 返回值无法序列化等
+                conn.send((request_id, False, f"指令执行结果无法返回主进程: {e}"))
+
+    def take_snapshot(request_id, source, kwargs):
+        try:
+            reply = (request_id, True, SNAPSHOT_SOURCES[source](**kwargs))
+        except Exception as e:
+            reply = (request_id, False, str(e))
+        with send_lock:
+            conn.send(reply)
+
+    executor = ThreadPoolExecutor(max_workers=command_threads, thread_name_prefix=f"fleet-worker-{worker_id}")
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break   # 主进程已退出
+        if message is None:
+            break
+        if message[0] == "snapshot":    # 采样剖析等诊断会持续数秒，同样在线程池中执行，不阻塞指令的接收
+            executor.submit(take_snapshot, *message[1:])
+            continue
+        executor.submit(execute, *message)
+    for service in services.values():
+        try:
+            service.disconnect()
+        except Exception as e:
+            logger.error(f"工作进程{worker_id}注销设备{service.local_ip}失败: {e}")
+    executor.shutdown(wait=False)
+    try:
+        report_correlation.flush()
+    except (OSError, ValueError):
+        pass    # 主进程已关闭管道
+    metrics.close()
+    packet_capture.close()
+    if "network_led" in shard:
+        close_database()
+
+
+def init_database():
+    """
+    LED网络屏收到的指令需写入数据库，工作进程中没有接口的Tortoise初始化，在共用事件循环中单独初始化
+    设为全局上下文，接收回调在事件循环中创建的任务才能访问
+    """
+    from tortoise import Tortoise
+    from core.settings import TORTOISE_ORM
+    try:
+        shared_event_loop.run(Tortoise.init(config=TORTOISE_ORM, _enable_global_fallback=True), timeout=30)
+    except Exception as e:
+        logger.error(f"工作进程初始化数据库失败，LED网络屏收到的指令不会写入数据库: {e}")
+
+
+def close_database():
+    from tortoise import Tortoise
+    try:
+        shared_event_loop.run(Tortoise.close_connections(), timeout=10)
+    except Exception as e:
+        logger.warning(f"关闭数据库连接失败: {e}")
+
+
+class WorkerHandle:
+    """主进程中一个工作进程的句柄，管理管道和等待返回的指令"""
+
+    def __init__(self, worker_id, process, conn):
+        self.worker_id = worker_id
+        self.process = process
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.pending = {}           # 指令编号 -> Future
+        self.device_count = 0       # 分配给该进程的设备数
+        self.ready_count = None     # 工作进程初始化完成后上报的设备数
+        self.alive = True
+        self.stopping = False       # 主进程已通知退出，进程退出属于正常结束
+
+
+class FleetSupervisor:
+    """
+    批量设备的进程管理器，把设备按序号轮询分配到processes个工作进程
+    每个工作进程有独立的GIL、事件循环和reactor线程，吞吐随进程数（不超过CPU核数）近似线性增长
+    接口层通过RemoteServiceProxy调用设备方法，指令经管道转发到设备所在的工作进程执行
+    """
+
+    def __init__(self, processes=2, command_timeout=30, command_threads=8, connect_threads=32):
+        self.processes = max(1, processes)
+        self.command_timeout = command_timeout  # 等待工作进程返回指令结果的超时，单位为秒
+        self.command_threads = command_threads  # 每个工作进程执行指令的线程数
+        self.connect_threads = connect_threads  # 每个工作进程启动时并发连接设备的线程数
+        self.workers = []
+        self.owners = {}            # (设备类型, 设备序号) -> WorkerHandle
+        self.request_ids = itertools.count(1)
+
+    @classmethod
+    def from_config(cls, workers_config):
+        """从配置文件的fleet_workers节点创建"""
+        workers_config = workers_config or {}
+        return cls(
+            processes=workers_config.get("processes", 2),
+            command_timeout=workers_config.get("command_timeout", 30),
+            command_threads=workers_config.get("command_threads", 8),
+            connect_threads=workers_config.get("connect_threads", 32),
+        )
+
+    def split(self, devices):
+        """
+        把批量设备轮询拆成processes个分片
+        :param devices: [(设备类型, 设备序号, 源IP), ...]，下标即设备在计数表中的槽
+        :return: 每个分片的 {设备类型: [(设备序号, 源IP, 计数槽), ...]}
+        """
+        shards = [{} for _ in range(self.processes)]
+        for slot, (device_type, index, local_ip) in enumerate(devices):
+            shards[slot % self.processes].setdefault(device_type, []).append((index, local_ip, slot))
+        return shards
+
+    def start(self, devices, server_ip, metrics_name):
+        """启动工作进程，不等待设备连接完成"""
+        context = multiprocessing.get_context("spawn")  # 主进程已有多个线程，fork出的子进程可能继承被占用的锁
+        for worker_id, shard in enumerate(self.split(devices)):
+            if not shard:
+                continue
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=run_worker, name=f"fleet-worker-{worker_id}", daemon=True,
+                                      args=(worker_id, shard, server_ip, metrics_name, len(devices), child_conn,
+                                            self.command_threads, self.connect_threads))
+            process.start()
+            child_conn.close()
+            worker = WorkerHandle(worker_id, process, parent_conn)
+            for device_type, shard_devices in shard.items():
+                worker.device_count += len(shard_devices)
+                for index, _, _ in shard_devices:
+                    self.owners[(device_type, index)] = worker
+            self.workers.append(worker)
+            threading.Thread(target=self.read_replies, args=(worker,), name=f"fleet-reply-{worker_id}",
+                             daemon=True).start()
+            logger.info(f"工作进程{worker_id}已启动，pid：{process.pid}，设备数：{worker.device_count}")
+
+    def read_replies(self, worker: WorkerHandle):
+        """接收工作进程返回的指令结果，进程退出后让所有等待中的指令失败"""
+        while True:
+            try:
+                message = worker.conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == "ready":
+                worker.ready_count = message[1]
+                continue
+            if message[0] == "correlation":
+                report_correlation.register_many(message[1])
+                continue
+            request_id, success, value = message
+            future = worker.pending.pop(request_id, None)
+            if future is None:
+                continue    # 已超时放弃等待的指令
+            if success:
+                future.set_result(value)
+            else:
+                future.set_exception(Exception(value))
+        worker.alive = False
+        if worker.stopping:
+            logger.info(f"工作进程{worker.worker_id}已退出")
+        else:
+            logger.error(f"工作进程{worker.worker_id}意外退出")
+        for future in list(worker.pending.values()):
+            future.set_exception(Exception(f"工作进程{worker.worker_id}已退出"))
+        worker.pending.clear()
+
+    def has_device(self, device_type, index):
+        return (device_type, index) in self.owners
+
+    def collect_snapshots(self, source):
+        """
+        向所有存活的工作进程请求统计快照，超时或已退出的进程跳过
+        :param source: SNAPSHOT_SOURCES中的快照名称
+        """
+        return list(self.gather_snapshots(self.request_snapshots(source)).values())
+
+    def request_snapshots(self, source, **kwargs):
+        """向所有存活的工作进程发出快照请求，不等待结果，由gather_snapshots收集"""
+        futures = []
+        for worker in self.workers:
+            if not worker.alive:
+                continue
+            request_id = next(self.request_ids)
+            future = Future()
+            worker.pending[request_id] = future
+            try:
+                with worker.send_lock:
+                    worker.conn.send(("snapshot", request_id, source, kwargs))
+            except (OSError, ValueError):
+                worker.pending.pop(request_id, None)
+                continue
+            futures.append((worker, request_id, future, source))
+        return futures
+
+    def gather_snapshots(self, futures, extra_timeout=0):
+        """
+        等待request_snapshots发出的请求，超时或失败的进程跳过
+        :param extra_timeout: 在command_timeout之外多等待的时间，用于持续数秒的采样剖析
+        :return: {工作进程编号: 结果}
+        """
+        snapshots = {}
+        for worker, request_id, future, source in futures:
+            try:
+                snapshots[worker.worker_id] = future.result(self.command_timeout + extra_timeout)
+            except Exception as e:
+                logger.warning(f"获取工作进程{worker.worker_id}的{source}快照失败: {e}")
+            finally:
+                worker.pending.pop(request_id, None)
+        return snapshots
+
+    def call(self, device_type, index, command, kwargs=None):
+        """在设备所在的工作进程中执行设备方法，阻塞等待结果"""
+        if command not in FLEET_COMMANDS:
+            raise Exception(f"不支持转发给批量设备的指令: {command}")
+        worker = self.owners.get((device_type, index))
+        if worker is None:
+            raise Exception(f"没有批量设备{device_type}第{index}台")
+        if not worker.alive:
+            raise Exception(f"批量设备{device_type}第{index}台所在的工作进程{worker.worker_id}已退出")
+        request_id = next(self.request_ids)
+        future = Future()
+        worker.pending[request_id] = future
+        with worker.send_lock:
+            worker.conn.send((request_id, device_type, index, command, kwargs or {}))
+        try:
+            return future.result(self.command_timeout)
+        finally:
+            worker.pending.pop(request_id, None)
+
+    def stop(self):
+        """通知所有工作进程注销设备并退出，超时未退出的强制结束"""
+        for worker in self.workers:
+            worker.stopping = True
+            if worker.alive:
+                try:
+                    with worker.send_lock:
+                        worker.conn.send(None)
+                except (OSError, ValueError):
+                    pass
+        for worker in self.workers:
+            worker.process.join(10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        self.workers = []
+        self.owners = {}
+
+    def connect_pending(self):
+        """尚未完成初始化的工作进程中的设备数，工作进程连接完分片内的所有设备后才上报ready"""
+        return sum(worker.device_count for worker in self.workers if worker.ready_count is None)
+
+    def get_stats(self):
+        return [
+            {
+                "workerId": worker.worker_id,
+                "pid": worker.process.pid,
+                "alive": worker.alive and worker.process.is_alive(),
+                "deviceCount": worker.device_count,
+                "readyDeviceCount": worker.ready_count,
+                "pendingCommands": len(worker.pending),
+            }
+            for worker in self.workers
+        ]
+
+
+class RemoteServiceProxy:
+    """
+    工作进程或集群代理中设备服务的代理，接口层像调用本地设备服务一样调用其方法
+    只支持FLEET_COMMANDS中的方法，参数需按关键字传入且可被pickle序列化
+    supervisor为FleetSupervisor或ClusterCoordinator，两者都提供call方法
+    """
+
+    def __init__(self, supervisor, device_type, index):
+        self.supervisor = supervisor
+        self.device_type = device_type
+        self.index = index
+
+    def __getattr__(self, command):
+        if command not in FLEET_COMMANDS:
+            raise AttributeError(command)
+
+        def remote_call(**kwargs):
+            return self.supervisor.call(self.device_type, self.index, command, kwargs)
+        return remote_call
+
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/23 10:00
+# @Author  : Heshouyi
+# @File    : heartbeat_monitor.py
+# @Software: PyCharm
+# @description: 心跳往返时延统计，按时间戳匹配心跳和返回，按设备类型记录对数线性直方图，按滑动窗口计算分位数
+#               直方图和滑动窗口（LatencyStats）也用于其他时延统计，如上报端到端时延
+
+import threading
+import time
+import weakref
+from array import array
+from collections import deque
+from core.configer import config
+
+SUB_BUCKET_BITS = 6                         # 每个2的幂区间分为32个子桶，相对误差约3%
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+MAX_LATENCY_US = 600 * 1000000              # 超过600秒的时延记入最后一个桶
+BUCKET_COUNT = SUB_BUCKET_COUNT + (MAX_LATENCY_US.bit_length() - SUB_BUCKET_BITS) * SUB_BUCKET_HALF
+PERCENTILES = (("p50", 0.5), ("p99", 0.99), ("p999", 0.999))
+
+
+def bucket_index(value_us):
+    """
+    对数线性分桶（HDR直方图的简化）：小于64微秒时每微秒一个桶，之后每个2的幂区间分32个桶
+    记录和合并都是O(1)/O(桶数)，分位数的相对误差不超过子桶宽度
+    """
+    if value_us < SUB_BUCKET_COUNT:
+        return max(0, value_us)
+    if value_us > MAX_LATENCY_US:
+        value_us = MAX_LATENCY_US
+    shift = value_us.bit_length() - SUB_BUCKET_BITS
+    return SUB_BUCKET_COUNT + (shift - 1) * SUB_BUCKET_HALF + (value_us >> shift) - SUB_BUCKET_HALF
+
+
+def bucket_value(index):
+    """桶内数值的中点，单位为微秒"""
+    if index < SUB_BUCKET_COUNT:
+        return index
+    shift = (index - SUB_BUCKET_COUNT) // SUB_BUCKET_HALF + 1
+    lower = ((index - SUB_BUCKET_COUNT) % SUB_BUCKET_HALF + SUB_BUCKET_HALF) << shift
+    return lower + ((1 << shift) - 1) / 2
+
+
+def summarize(counts):
+    """按桶计数计算次数、分位数和最大值，时延单位为毫秒"""
+    total = sum(counts)
+    summary = {"count": total}
+    if not total:
+        summary.update({name: None for name, _ in PERCENTILES}, max=None)
+        return summary
+    targets = [(name, max(1, -int(-quantile * total // 1))) for name, quantile in PERCENTILES]
+    cumulative = 0
+    position = 0
+    for index, count in enumerate(counts):
+        if not count:
+            continue
+        cumulative += count
+        while position < len(targets) and cumulative >= targets[position][1]:
+            summary[targets[position][0]] = round(bucket_value(index) / 1000, 3)
+            position += 1
+        last_index = index
+    summary["max"] = round(bucket_value(last_index) / 1000, 3)
+    return summary
+
+
+def add_counts(target, counts):
+    for index, count in enumerate(counts):
+        if count:
+            target[index] += count
+
+
+class HeartbeatTracker:
+    """
+    单台设备的心跳匹配，发送时按时间戳登记，收到返回时按时间戳取出发送时间
+    协议返回中没有时间戳时按发送顺序匹配最早的一个；超过reply_timeout仍未返回的心跳记为丢失
+    """
+
+    __slots__ = ("monitor", "stats", "pending", "lock", "__weakref__")
+
+    def __init__(self, monitor, stats):
+        self.monitor = monitor
+        self.stats = stats          # 所属设备类型的统计
+        self.pending = deque()      # 等待返回的 (时间戳, 发送时间)，按发送顺序排列
+        self.lock = threading.Lock()
+
+    def sent(self, timestamp):
+        now = time.monotonic()
+        with self.lock:
+            self.expire(now)
+            self.pending.append((timestamp, now))
+        self.stats.add_counter("sent")
+
+    def replied(self, timestamp=None):
+        """
+        收到心跳返回
+        :param timestamp: 返回中携带的心跳时间戳，为None或服务器未回显心跳的时间戳时匹配最早发出的心跳
+        :return: 往返时延，单位为秒，没有等待中的心跳时返回None
+        """
+        now = time.monotonic()
+        with self.lock:
+            match = 0 if self.pending else None
+            if timestamp is not None:
+                for position, (pending_timestamp, _) in enumerate(self.pending):
+                    if pending_timestamp == timestamp:
+                        match = position
+                        break
+            if match is None:
+                sent_time = None
+            else:
+                sent_time = self.pending[match][1]
+                del self.pending[match]
+        if sent_time is None:
+            self.stats.add_counter("unmatched")     # 已记为丢失后才到达的返回，或服务器主动下发的心跳返回
+            return None
+        rtt = now - sent_time
+        self.stats.record(rtt, now, "replied")
+        return rtt
+
+    def expire(self, now=None):
+        """把超时未返回的心跳记为丢失，调用方持有锁或在统计时调用"""
+        now = now or time.monotonic()
+        deadline = now - self.monitor.reply_timeout
+        missed = 0
+        while self.pending and self.pending[0][1] < deadline:
+            self.pending.popleft()
+            missed += 1
+        if missed:
+            self.stats.add_counter("missed", missed)
+
+    def reset(self):
+        """断线后清空等待中的心跳，断线期间发出的心跳不会收到返回，不计为丢失"""
+        with self.lock:
+            self.pending.clear()
+
+
+class LatencyStats:
+    """一类时延的统计：累计直方图、按时间片分段的直方图和计数"""
+
+    def __init__(self, counter_names, slice_seconds, retention):
+        self.slice_seconds = slice_seconds
+        self.retention = retention      # 保留的时间片数，覆盖最长的统计窗口
+        self.lock = threading.Lock()
+        self.total = array("q", bytes(8 * BUCKET_COUNT))
+        self.slices = {}                # 时间片编号 -> 该时间片内的直方图，只为有数据的时间片分配
+        self.counters = dict.fromkeys(counter_names, 0)
+
+    def add_counter(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def record(self, latency, now, counter):
+        """
+        记录一次时延
+        :param latency: 时延，单位为秒
+        :param now: 单调时钟的当前时间，决定记入的时间片
+        :param counter: 同时加1的计数项
+        """
+        index = bucket_index(int(latency * 1000000))
+        epoch = int(now // self.slice_seconds)
+        with self.lock:
+            counts = self.slices.get(epoch)
+            if counts is None:
+                counts = self.slices[epoch] = array("q", bytes(8 * BUCKET_COUNT))
+                for old_epoch in [old for old in self.slices if old <= epoch - self.retention]:
+                    del self.slices[old_epoch]
+            counts[index] += 1
+            self.total[index] += 1
+            self.counters[counter] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "total": self.total.tolist(),
+                "slices": {epoch: counts.tolist() for epoch, counts in self.slices.items()},
+            }
+
+
+class HeartbeatMonitor:
+    """
+    所有设备共用的心跳往返时延统计，按设备类型汇总
+    时延按slice_seconds秒一个时间片记录，查询时合并窗口内的时间片计算分位数，窗口外的时间片随新数据写入时淘汰
+    """
+
+    def __init__(self, reply_timeout=10, slice_seconds=10, windows=(60, 300, 3600)):
+        self.reply_timeout = reply_timeout      # 心跳发出后多久未收到返回记为丢失，单位为秒
+        self.slice_seconds = slice_seconds
+        self.windows = tuple(sorted(windows))   # 统计窗口，单位为秒
+        self.lock = threading.Lock()
+        self.stats = {}                         # 设备类型 -> LatencyStats
+        self.trackers = weakref.WeakSet()
+
+    @classmethod
+    def from_config(cls, monitor_config):
+        """从配置文件的heartbeat_monitor节点创建"""
+        monitor_config = monitor_config or {}
+        return cls(
+            reply_timeout=monitor_config.get("reply_timeout", 10),
+            slice_seconds=monitor_config.get("slice_seconds", 10),
+            windows=monitor_config.get("windows") or (60, 300, 3600),
+        )
+
+    def tracker(self, device_type) -> HeartbeatTracker:
+        """创建一台设备的心跳匹配器"""
+        with self.lock:
+            stats = self.stats.get(device_type)
+            if stats is None:
+                stats = self.stats[device_type] = LatencyStats(
+                    ("sent", "replied", "missed", "unmatched"), self.slice_seconds,
+                    retention_slices(self.windows, self.slice_seconds))
+        tracker = HeartbeatTracker(self, stats)
+        self.trackers.add(tracker)
+        return tracker
+
+    def snapshot(self):
+        """拷贝各设备类型的计数和直方图，可被pickle序列化，用于工作进程上报"""
+        now = time.monotonic()
+        pending = {}
+        for tracker in list(self.trackers):
+            with tracker.lock:
+                tracker.expire(now)
+                pending[tracker.stats] = pending.get(tracker.stats, 0) + len(tracker.pending)
+        snapshot = snapshot_stats(self.stats, now, self.slice_seconds)
+        for device_type, type_snapshot in snapshot["types"].items():
+            type_snapshot["counters"]["pending"] = pending.get(self.stats[device_type], 0)
+        return snapshot
+
+    @staticmethod
+    def merge(snapshots):
+        """合并多个进程的快照"""
+        return merge_snapshots(snapshots)
+
+    def summarize(self, merged):
+        """计算各设备类型的累计分位数和各窗口的分位数"""
+        return summarize_snapshot(merged, self.windows, self.slice_seconds)
+
+
+def retention_slices(windows, slice_seconds):
+    """覆盖最长统计窗口所需保留的时间片数"""
+    return -(-max(windows) // slice_seconds) + 1
+
+
+def snapshot_stats(stats_by_name, now, slice_seconds):
+    """拷贝一组LatencyStats，可被pickle序列化，时间片编号以now所在的时间片为参照"""
+    return {"epoch": int(now // slice_seconds),
+            "types": {name: stats.snapshot() for name, stats in list(stats_by_name.items())}}
+
+
+def merge_snapshots(snapshots):
+    """合并多个进程的快照，各进程的单调时钟起点不同，时间片按相对于各自当前时间片的偏移对齐"""
+    merged = {}
+    for snapshot in snapshots:
+        for name, type_snapshot in snapshot["types"].items():
+            target = merged.get(name)
+            if target is None:
+                target = merged[name] = {"counters": {}, "total": [0] * BUCKET_COUNT, "slices": {}}
+            for counter, value in type_snapshot["counters"].items():
+                target["counters"][counter] = target["counters"].get(counter, 0) + value
+            add_counts(target["total"], type_snapshot["total"])
+            for epoch, counts in type_snapshot["slices"].items():
+                age = snapshot["epoch"] - epoch     # 距当前时间片的片数
+                add_counts(target["slices"].setdefault(age, [0] * BUCKET_COUNT), counts)
+    return merged
+
+
+def summarize_snapshot(merged, windows, slice_seconds):
+    """按merge_snapshots的结果计算每类时延的计数、累计分位数和各窗口的分位数"""
+    result = {}
+    for name, type_snapshot in sorted(merged.items()):
+        window_summaries = {}
+        for window in windows:
+            slice_count = -(-window // slice_seconds)
+            counts = [0] * BUCKET_COUNT
+            for age, slice_counts in type_snapshot["slices"].items():
+                if age < slice_count:
+                    add_counts(counts, slice_counts)
+            window_summaries[f"{window}s"] = summarize(counts)
+        result[name] = {**type_snapshot["counters"], "total": summarize(type_snapshot["total"]),
+                        "windows": window_summaries}
+    return result
+
+
+heartbeat_monitor = HeartbeatMonitor.from_config(config.get("heartbeat_monitor"))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/20 10:15
+# @Author  : Heshouyi
+# @File    : ip_pool.py
+# @Software: PyCharm
+# @description: 批量设备的源IP池，按设备类型声明的网段从本机网卡地址中分配源IP
+
+import ipaddress
+from core.logger import logger
+
+
+class SourceIPPool:
+    """
+    本机源IP池，以集合保存本机所有网卡的IPv4地址，校验某个IP是否可用为O(1)
+    按网段分配时只遍历本机地址，不遍历整个网段，大网段（如/8）也不会变慢
+    同一个IP只分配给一台设备，协议允许时源IP不足的部分由多台设备复用同一IP、使用不同的临时端口补足
+    """
+
+    def __init__(self, local_ips):
+        self.local_ips = set(local_ips)     # 本机所有网卡的IPv4地址
+        self.used_ips = set()               # 已分配的IP，不同设备类型之间不重复分配
+
+    def is_local(self, ip):
+        return ip in self.local_ips
+
+    def get_missing(self, ips):
+        """返回不在本机网卡上的IP"""
+        return [ip for ip in ips if ip not in self.local_ips]
+
+    def reserve(self, ips):
+        """标记IP已被占用，如devices_addr中单台设备使用的IP"""
+        self.used_ips.update(ips)
+
+    def allocate(self, device_type, cidr, count, multiplexable=False, max_devices_per_ip=0):
+        """
+        为一类设备分配源IP
+        :param device_type: 设备类型，用于日志和汇总
+        :param cidr: 源IP网段，如 192.168.30.0/24
+        :param count: 设备数量
+        :param multiplexable: 协议是否允许多台设备共用一个源IP，服务器按注册包中的设备编号而不是源IP区分设备时才允许
+        :param max_devices_per_ip: 复用时单个IP最多承载的设备数，0表示不限
+        :return: (每台设备的源IP列表, 分配汇总)，源IP列表可能少于count，差额见汇总中的shortfall
+        """
+        network = ipaddress.ip_network(cidr, strict=False)
+        available = sorted(
+            (ip for ip in self.local_ips if ip not in self.used_ips and ipaddress.ip_address(ip) in network),
+            key=lambda ip: int(ipaddress.ip_address(ip))
+        )
+        ips = available[:count]
+        multiplexed = 0
+        if len(ips) < count and multiplexable and available:
+            # 源IP不足，按轮询把剩余设备分摊到已分配的IP上，每台设备由系统分配不同的临时端口
+            capacity = count if not max_devices_per_ip else len(available) * max_devices_per_ip
+            target = min(count, capacity)
+            multiplexed = target - len(ips)
+            ips = [available[index % len(available)] for index in range(target)]
+        self.used_ips.update(ips)
+        summary = {
+            "deviceType": device_type,
+            "cidr": str(network),
+            "requested": count,
+            "localAvailable": len(available),
+            "assigned": len(ips),
+            "uniqueIps": len(set(ips)),
+            "multiplexed": multiplexed,
+            "shortfall": count - len(ips),
+        }
+        return ips, summary
+
+    @staticmethod
+    def log_summary(summaries):
+        """输出各设备类型的分配汇总，有缺口时以错误级别列出"""
+        for summary in summaries:
+            message = (f"{summary['deviceType']} 网段{summary['cidr']}：需要{summary['requested']}台，"
+                       f"本机可用IP{summary['localAvailable']}个，已分配{summary['assigned']}台"
+                       f"（独立IP{summary['uniqueIps']}个，复用IP{summary['multiplexed']}台）")
+            if summary["shortfall"]:
+                logger.error(f"{message}，缺少{summary['shortfall']}台")
+            else:
+                logger.info(message)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/12 16:10
+# @Author  : Heshouyi
+# @File    : link_profile.py
+# @Software: PyCharm
+# @description: 设备链路参数，模拟4G/Lora回传等真实链路的分包大小、包间隔和带宽
+
+from core.rate_limiter import TokenBucket
+
+
+class LinkProfile:
+    """设备链路参数，用于控制图片等大数据分包发送的节奏"""
+
+    MIN_CHUNK_SIZE = 64         # 分包大小下限
+    MAX_CHUNK_SIZE = 65535      # 协议数据长度字段为2字节
+
+    def __init__(self, chunk_size=1024, chunk_gap_ms=0, bandwidth=0):
+        """
+        :param chunk_size: 每个数据包携带的数据字节数
+        :param chunk_gap_ms: 两个数据包之间的固定间隔，单位为毫秒
+        :param bandwidth: 带宽上限，单位为字节/秒，按实际写入套接字的字节数计算，0表示不限速
+        """
+        if not self.MIN_CHUNK_SIZE <= chunk_size <= self.MAX_CHUNK_SIZE:
+            raise ValueError(f"分包大小需在{self.MIN_CHUNK_SIZE}到{self.MAX_CHUNK_SIZE}字节之间，实际为: {chunk_size}")
+        if chunk_gap_ms < 0 or bandwidth < 0:
+            raise ValueError("包间隔和带宽不能为负数")
+        self.chunk_size = chunk_size
+        self.chunk_gap_ms = chunk_gap_ms
+        self.bandwidth = bandwidth
+
+    @classmethod
+    def from_config(cls, profile_config):
+        """从配置文件的link_profile节点创建，缺省项使用默认值"""
+        profile_config = profile_config or {}
+        return cls(
+            chunk_size=profile_config.get("chunk_size", 1024),
+            chunk_gap_ms=profile_config.get("chunk_gap_ms", 0),
+            bandwidth=profile_config.get("bandwidth", 0),
+        )
+
+    def merge(self, chunk_size=None, chunk_gap_ms=None, bandwidth=None):
+        """用单次请求中传入的参数覆盖设备默认参数，返回新的链路参数"""
+        return LinkProfile(
+            chunk_size=self.chunk_size if chunk_size is None else chunk_size,
+            chunk_gap_ms=self.chunk_gap_ms if chunk_gap_ms is None else chunk_gap_ms,
+            bandwidth=self.bandwidth if bandwidth is None else bandwidth,
+        )
+
+    def create_shaper(self):
+        """
+        创建带宽整形用的令牌桶，不限速时返回None
+        桶容量取两个满包转义后的最大长度，突发不超过两个包，同时组包耗时较长时积累的令牌不会被容量截断
+        初始为空桶，从第一个包开始就按设定速率发送
+        """
+        if not self.bandwidth:
+            return None
+        return TokenBucket(self.bandwidth, capacity=2 * (self.chunk_size * 2 + 16), initial_tokens=0)
+
+    def to_dict(self):
+        return {"chunkSize": self.chunk_size, "chunkGapMs": self.chunk_gap_ms, "bandwidth": self.bandwidth}
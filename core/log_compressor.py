@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/24 10:00
+# @Author  : Heshouyi
+# @File    : log_compressor.py
+# @Software: PyCharm
+# @description: 日志轮转后的压缩，由core.logger在独立进程中以脚本方式启动，不导入项目的其他模块
+
+import os
+import sys
+import zipfile
+
+
+def compress(path):
+    """把日志文件压缩为同名的.zip文件后删除原文件"""
+    archive = f"{path}.zip"
+    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.write(path, os.path.basename(path))
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    compress(sys.argv[1])
@@ -6,10 +6,14 @@
 # @Software: PyCharm
 # @description:
 
+import itertools
+import os
+import subprocess
 import sys
 import threading
 from datetime import datetime
 from loguru import logger
+from core.configer import config
 from core.file_path import log_path
 
 
@@ -25,31 +29,81 @@ logger.level("ERROR", color="<red>")
 logger.level("CRITICAL", color="<bold><red>")
 
 
+logging_config = config.get("logging") or {}
+
+
+def compress_in_process(path):
+    """轮转后的日志文件交给独立进程压缩为zip并删除原文件，写日志的线程不等待压缩完成"""
+    subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "log_compressor.py"), path],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# 压缩方式 -> loguru的compression参数
+COMPRESSIONS = {"zip": "zip", "process": compress_in_process, "none": None}
+
+
+class PacketLogSampler:
+    """
+    逐包日志（收发的原始数据、心跳返回等）的采样，设备数量很大时逐包格式化和写文件的开销会超过协议处理本身
+    rate为N时每N个包记录1个，0为不记录；devices不为空时只记录这些设备（源IP）的包
+    告警和错误日志不经过采样
+    """
+
+    def __init__(self, rate=1, devices=()):
+        self.rate = rate
+        self.devices = frozenset(devices or ())
+        self.counter = itertools.count()
+
+    @classmethod
+    def from_config(cls, logging_config):
+        return cls(
+            rate=logging_config.get("packet_sample_rate", 1),
+            devices=logging_config.get("packet_log_devices"),
+        )
+
+    def sample(self, device=None):
+        """本包是否记录日志"""
+        if self.rate <= 0:
+            return False
+        if self.devices and device not in self.devices:
+            return False
+        return self.rate == 1 or next(self.counter) % self.rate == 0
+
+
 # 配置自定义 logger handler，输出日志到：1、标准输出 2、日志输出文件 3、Allure报告
-logger.configure(
-    handlers=[
-        {
-            "sink": sys.stdout,  # 日志输出到标准输出
-            "level": "DEBUG",  # 日志级别
-            "format": "<green>{time:YYYY-MM-DD HH:mm:ss.SSSS} | {module}:{line}</green> | <level>{level}</level> | {message}",
-            "colorize": True,  # 启用颜色
-            "backtrace": False,   # 控制是否追溯详细的回溯信息（即代码调用链和变量状态等详细信息）
-            "diagnose": False,    # 控制不会包含详细的诊断信息
-            "enqueue": False,  # 关闭多线程安全队列
-        },
-        {
-            "sink": f"{log_path}/{current_date}/findcar_automation_engine_{current_hour}.log",  # 指定日志输出到文件
-            "level": "INFO",  # 日志级别
-            "format": "{time:YYYY-MM-DD HH:mm:ss.SSSS} | {module}:{line} | {level} | {message}",  # 日志格式
-            "rotation": "1 hour",  # 每小时自动分割日志
-            "retention": "1 week",  # 保留最近 7 天的日志文件
-            "compression": "zip",  # 压缩日志文件
-            "backtrace": True,   # 控制是否追溯详细的回溯信息（即代码调用链和变量状态等详细信息）
-            "diagnose": True,  # 控制是否包含详细的诊断信息
-            "enqueue": False,  # 关闭多线程安全队列
-        }
-    ]
-)
+# enqueue开启后日志记录放入队列，由后台线程格式化和写入，调用方不阻塞在终端和文件的写入上
+def console_handler():
+    return {
+        "sink": sys.stdout,  # 日志输出到标准输出
+        "level": logging_config.get("console_level", "DEBUG"),  # 日志级别
+        "format": "<green>{time:YYYY-MM-DD HH:mm:ss.SSSS} | {module}:{line}</green> | <level>{level}</level> | {message}",
+        "colorize": True,  # 启用颜色
+        "backtrace": False,   # 控制是否追溯详细的回溯信息（即代码调用链和变量状态等详细信息）
+        "diagnose": False,    # 控制不会包含详细的诊断信息
+        "enqueue": logging_config.get("enqueue", False),  # 是否经队列由后台线程写入
+    }
+
+
+def file_handler(file_name="findcar_automation_engine"):
+    return {
+        "sink": f"{log_path}/{current_date}/{file_name}_{current_hour}.log",  # 指定日志输出到文件
+        "level": logging_config.get("file_level", "INFO"),  # 日志级别
+        "format": "{time:YYYY-MM-DD HH:mm:ss.SSSS} | {module}:{line} | {level} | {message}",  # 日志格式
+        "rotation": "1 hour",  # 每小时自动分割日志
+        "retention": "1 week",  # 保留最近 7 天的日志文件
+        "compression": COMPRESSIONS[logging_config.get("compression", "zip")],  # 压缩日志文件
+        "backtrace": True,   # 控制是否追溯详细的回溯信息（即代码调用链和变量状态等详细信息）
+        "diagnose": logging_config.get("diagnose", True),  # 控制是否包含详细的诊断信息（异常时各层变量的值）
+        "enqueue": logging_config.get("enqueue", False),  # 是否经队列由后台线程写入
+    }
+
+
+logger.configure(handlers=[console_handler(), file_handler()])
+
+
+def configure_worker_logging(worker_id):
+    """批量设备工作进程写入各自的日志文件，多个进程轮转和压缩同一个文件会互相覆盖"""
+    logger.configure(handlers=[console_handler(), file_handler(f"findcar_automation_engine_worker{worker_id}")])
 
 
 # 定义全局异常捕获函数，处理未捕获的异常
@@ -71,3 +125,5 @@ if hasattr(threading, "excepthook"):
 
 # 供其他模块引用的 logger
 logger = logger
+# 逐包日志的采样，收发路径上先判断再记录，记录时用 logger.debug("...{}", data) 的形式，日志级别未开启时不格式化
+packet_log = PacketLogSampler.from_config(logging_config)
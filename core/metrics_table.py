@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/21 15:30
+# @Author  : Heshouyi
+# @File    : metrics_table.py
+# @Software: PyCharm
+# @description: 批量设备的共享内存计数表，工作进程直接写入各自设备的计数槽，主进程按需汇总，不经过进程间通信
+
+import time
+from multiprocessing import shared_memory
+from typing import Optional
+
+# 每台设备一个计数槽，槽内字段顺序固定，均为int64
+METRIC_FIELDS = (
+    "sentPackets", "sentBytes", "receivedPackets", "receivedBytes", "reconnects",
+    "ackCount", "ackLatencyTotalUs", "ackLatencyMaxUs", "queueDepth", "errors", "connectionState",
+    "lastSentMs", "lastReceivedMs", "lastHeartbeatMs", "heartbeatIntervalMs",
+)
+(SENT_PACKETS, SENT_BYTES, RECEIVED_PACKETS, RECEIVED_BYTES, RECONNECTS,
+ ACK_COUNT, ACK_LATENCY_TOTAL_US, ACK_LATENCY_MAX_US, QUEUE_DEPTH, ERRORS, CONNECTION_STATE,
+ LAST_SENT_MS, LAST_RECEIVED_MS, LAST_HEARTBEAT_MS, HEARTBEAT_INTERVAL_MS) = range(len(METRIC_FIELDS))
+SLOT_WIDTH = len(METRIC_FIELDS)
+# 汇总设备类型时取各设备最大值的字段，时间字段（毫秒级时间戳，0表示从未发生）的最大值即最近一次
+MAX_FIELDS = (ACK_LATENCY_MAX_US, LAST_SENT_MS, LAST_RECEIVED_MS, LAST_HEARTBEAT_MS)
+# 连接状态字段的取值，注册完成指业务会话已就绪，没有注册流程的设备（如LCD一体屏）连接后即为CONNECTED
+DISCONNECTED = 0
+CONNECTED = 1
+REGISTERED = 2
+STATE_NAMES = {DISCONNECTED: "disconnected", CONNECTED: "connected", REGISTERED: "registered"}
+
+
+class MetricsSlot:
+    """
+    一台设备的计数槽，只由设备所在的进程写入，不加锁
+    同一进程内不同线程对同一字段的并发累加在极少数情况下可能丢失一次计数，统计用途可以接受
+    """
+
+    __slots__ = ("table", "base")
+
+    def __init__(self, table, base):
+        self.table = table  # 所在的计数表，每次写入时取其当前的数组视图，计数表关闭后写入不再报错
+        self.base = base    # 本槽在数组中的起始下标
+
+    def add(self, field, value=1):
+        self.table.view[self.base + field] += value
+
+    def set(self, field, value):
+        self.table.view[self.base + field] = value
+
+    def record_sent(self, size, packets=1):
+        view, base = self.table.view, self.base
+        view[base + SENT_PACKETS] += packets
+        view[base + SENT_BYTES] += size
+        view[base + LAST_SENT_MS] = int(time.time() * 1000)
+
+    def record_received(self, size, packets=1):
+        view, base = self.table.view, self.base
+        view[base + RECEIVED_PACKETS] += packets
+        view[base + RECEIVED_BYTES] += size
+        view[base + LAST_RECEIVED_MS] = int(time.time() * 1000)
+
+    def record_heartbeat(self):
+        """记录收到心跳返回的时间，心跳没有返回的设备在发出心跳时记录"""
+        self.table.view[self.base + LAST_HEARTBEAT_MS] = int(time.time() * 1000)
+
+    def set_heartbeat_interval(self, interval):
+        """记录定时心跳的间隔，单位为秒，停止心跳时为0，用于判断设备是否仍在按时心跳"""
+        self.table.view[self.base + HEARTBEAT_INTERVAL_MS] = int(interval * 1000)
+
+    def record_ack(self, latency):
+        """记录一次服务器确认的等待时间，单位为秒"""
+        view, base = self.table.view, self.base
+        latency_us = int(latency * 1000000)
+        view[base + ACK_COUNT] += 1
+        view[base + ACK_LATENCY_TOTAL_US] += latency_us
+        if latency_us > view[base + ACK_LATENCY_MAX_US]:
+            view[base + ACK_LATENCY_MAX_US] = latency_us
+
+
+class MetricsTable:
+    """
+    固定布局的共享内存计数表，slot_count台设备 × SLOT_WIDTH个int64
+    主进程创建，工作进程按名称挂载后只写入分配给自己的槽；读取时一次性拷贝整个数组，汇总为O(设备数)
+    """
+
+    def __init__(self, shm: Optional[shared_memory.SharedMemory], slot_count, owner):
+        self.shm = shm          # 为None时为进程内的计数表
+        self.slot_count = slot_count
+        self.owner = owner      # 创建者负责在关闭时释放共享内存
+        self.detached = None    # 关闭时仍被其他线程引用、未能解除映射的共享内存
+        self.view = shm.buf.cast("q") if shm else memoryview(bytearray(slot_count * SLOT_WIDTH * 8)).cast("q")
+
+    @classmethod
+    def local(cls, slot_count):
+        """进程内的计数表，不在共享内存中"""
+        return cls(None, slot_count, owner=False)
+
+    @classmethod
+    def create(cls, slot_count):
+        shm = shared_memory.SharedMemory(create=True, size=max(1, slot_count) * SLOT_WIDTH * 8)  # 新建的共享内存内容全为0
+        return cls(shm, slot_count, owner=True)
+
+    @classmethod
+    def attach(cls, name, slot_count):
+        """工作进程按名称挂载，spawn启动的工作进程与主进程共用资源跟踪进程，挂载方退出时不会释放共享内存"""
+        return cls(shared_memory.SharedMemory(name=name), slot_count, owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def slot(self, index) -> MetricsSlot:
+        return MetricsSlot(self, index * SLOT_WIDTH)
+
+    def read_rows(self):
+        """拷贝整个计数表，返回每台设备一行的字段值列表"""
+        return split_rows(self.view.tolist(), self.slot_count)
+
+    def snapshot(self) -> bytes:
+        """整个计数表的原始字节，每台设备SLOT_WIDTH*8字节，用于跨主机上报，由rows_from_snapshot还原"""
+        return self.view.tobytes()
+
+    def aggregate(self, devices):
+        """
+        汇总每台设备和每种设备类型的计数
+        :param devices: 与计数槽顺序一致的 [(设备类型, 设备序号, 源IP), ...]
+        """
+        return aggregate_rows(devices, self.read_rows())
+
+    def close(self):
+        """
+        解除共享内存映射，创建者同时删除共享内存，应在设备停止后调用
+        设备的收发线程此时可能仍持有计数槽，先把视图换成进程内的数组，之后的写入不再落到共享内存上；
+        旧视图不主动释放，正在写入的线程可能还持有它，释放后写入会抛出ValueError；
+        仍有线程持有旧视图时映射无法关闭，留到最后一个引用消失时回收，共享内存的名称照常删除
+        """
+        if self.shm is None:
+            return
+        shm, self.shm = self.shm, None
+        self.view = memoryview(bytearray(self.slot_count * SLOT_WIDTH * 8)).cast("q")
+        try:
+            shm.close()
+        except BufferError:
+            self.detached = shm     # 持有引用，避免SharedMemory被回收时再次关闭失败
+        if self.owner:
+            shm.unlink()
+
+
+def split_rows(values, slot_count):
+    """把按槽顺序排列的扁平计数值拆成每台设备一行"""
+    return [values[index * SLOT_WIDTH:(index + 1) * SLOT_WIDTH] for index in range(slot_count)]
+
+
+def rows_from_snapshot(data: bytes):
+    """还原MetricsTable.snapshot的结果为每台设备一行的字段值列表"""
+    values = memoryview(data).cast("q").tolist()
+    return split_rows(values, len(values) // SLOT_WIDTH)
+
+
+def changed_slots(previous: bytes, current: bytes):
+    """
+    比较两次snapshot的结果，返回有变化的槽序号和这些槽依次拼接的原始字节，用于只上报变化的设备
+    两次长度不同（如首次上报）时返回None，调用方应上报完整的计数表
+    """
+    if len(previous) != len(current):
+        return None
+    size = SLOT_WIDTH * 8
+    indices = [index for index, offset in enumerate(range(0, len(current), size))
+               if previous[offset:offset + size] != current[offset:offset + size]]
+    return indices, b"".join(current[index * size:(index + 1) * size] for index in indices)
+
+
+def apply_slots(target: bytearray, indices, data: bytes):
+    """把changed_slots的结果合并到完整计数表的原始字节中"""
+    size = SLOT_WIDTH * 8
+    for position, index in enumerate(indices):
+        target[index * size:(index + 1) * size] = data[position * size:(position + 1) * size]
+
+
+def aggregate_rows(devices, rows):
+    """
+    汇总每台设备和每种设备类型的计数
+    :param devices: [(设备类型, 设备序号, 源IP), ...]
+    :param rows: 与devices顺序一致的每台设备的字段值列表
+    """
+    device_rows = []
+    type_totals = {}
+    for (device_type, index, local_ip), row in zip(devices, rows):
+        device_rows.append({"deviceType": device_type, "index": index, "localIp": local_ip,
+                            **dict(zip(METRIC_FIELDS, row))})
+        totals = type_totals.get(device_type)
+        if totals is None:
+            type_totals[device_type] = totals = [0] * SLOT_WIDTH + [0]
+        for field, value in enumerate(row):
+            if field in MAX_FIELDS:    # 最大值和时间取各设备的最大值，连接状态统计已连接的设备数，其余字段求和
+                totals[field] = max(totals[field], value)
+            elif field == CONNECTION_STATE:
+                totals[field] += value != DISCONNECTED
+            else:
+                totals[field] += value
+        totals[SLOT_WIDTH] += 1     # 设备数
+    types = {}
+    for device_type, totals in type_totals.items():
+        summary = dict(zip(METRIC_FIELDS, totals))
+        summary["connectedCount"] = summary.pop("connectionState")
+        del summary["heartbeatIntervalMs"]
+        summary["deviceCount"] = totals[SLOT_WIDTH]
+        summary["ackLatencyAvgMs"] = round(totals[ACK_LATENCY_TOTAL_US] / totals[ACK_COUNT] / 1000, 3) \
+            if totals[ACK_COUNT] else None
+        types[device_type] = summary
+    return {"devices": device_rows, "types": types}
+
+
+def local_slot():
+    """不在共享计数表中的设备（如devices_addr中的单台设备）使用进程内的独立计数槽"""
+    return MetricsTable.local(1).slot(0)
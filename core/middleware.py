@@ -10,6 +10,7 @@ import json
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
 from core.logger import logger
+from core.tracing import tracer
 
 
 class RequestLoggingMiddleware(BaseHTTPMiddleware):
@@ -54,3 +55,19 @@ class RequestLoggingMiddleware(BaseHTTPMiddleware):
         if request_body:
             # 打印请求体
             logger.info(f"请求体: {json.dumps(request_body, ensure_ascii=False)}")
+
+
+class TracingMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        """
+        按采样比例为接口调用创建根跨度，请求头带有X-Trace: 1时只要开启追踪就记录
+        处理请求期间根跨度为当前跨度，业务层、上传调度和设备连接中的埋点都归入这次调用
+        """
+        span = tracer.start_trace(f"{request.method} {request.url.path}", force=request.headers.get("x-trace") == "1")
+        if not span:
+            return await call_next(request)
+        with span:
+            response = await call_next(request)
+            span.set(status=response.status_code)
+        response.headers["X-Trace-Id"] = span.trace_id
+        return response
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/24 14:00
+# @Author  : Heshouyi
+# @File    : packet_capture.py
+# @Software: PyCharm
+# @description: 收发原始数据的二进制抓包，写入内存映射的环形文件，按设备和时间查询，导出为pcapng
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from core.configer import config
+from core.file_path import log_path
+
+SENT = 0
+RECEIVED = 1
+DIRECTIONS = {SENT: "sent", RECEIVED: "received"}
+
+# 数据文件头：魔数, 版本, 数据区大小, 已写入的逻辑字节数, 已写入的记录数, 索引项数
+HEADER = struct.Struct("<4sHxxQQQQ")
+HEADER_SIZE = 64
+MAGIC = b"FCAP"
+VERSION = 1
+# 索引项：记录在数据区的逻辑位置, 时间戳, 设备编号, 载荷长度, 收发方向
+INDEX_ENTRY = struct.Struct("<QdIIBxxx")
+LINKTYPE_USER0 = 147    # pcapng中的链路类型，载荷为应用层协议的原始数据
+
+
+class CaptureRing:
+    """
+    一个进程的抓包文件：数据文件（文件头 + 环形数据区）、索引文件（环形的定长索引项）和设备表文件
+    数据区只存载荷，时间、设备、方向和长度都在索引项中，查询时只扫描索引
+    写满后从头覆盖，索引项指向的数据已被覆盖或索引项本身已被覆盖的记录视为过期
+    """
+
+    def __init__(self, directory, name, ring_bytes, index_entries):
+        os.makedirs(directory, exist_ok=True)
+        self.capacity = ring_bytes
+        self.index_entries = index_entries
+        self.head = 0           # 已写入的逻辑字节数，取模为写入位置
+        self.count = 0          # 已写入的记录数，取模为索引项位置
+        self.devices = {}       # 设备标签 -> 设备编号
+        self.devices_path = os.path.join(directory, f"{name}.devices")
+        self.data_file = open(os.path.join(directory, f"{name}.ring"), "w+b")
+        self.data_file.truncate(HEADER_SIZE + ring_bytes)
+        self.data = mmap.mmap(self.data_file.fileno(), HEADER_SIZE + ring_bytes)
+        self.index_file = open(os.path.join(directory, f"{name}.idx"), "w+b")
+        self.index_file.truncate(index_entries * INDEX_ENTRY.size)
+        self.index = mmap.mmap(self.index_file.fileno(), index_entries * INDEX_ENTRY.size)
+        self.write_devices()
+        self.write_header()
+
+    def write_header(self):
+        HEADER.pack_into(self.data, 0, MAGIC, VERSION, self.capacity, self.head, self.count, self.index_entries)
+
+    def write_devices(self):
+        """设备表写入单独的文件，只在出现新设备时重写"""
+        names = [None] * len(self.devices)
+        for device, device_id in self.devices.items():
+            names[device_id] = device
+        with open(self.devices_path + ".tmp", "w", encoding="utf-8") as file:
+            json.dump(names, file, ensure_ascii=False)
+        os.replace(self.devices_path + ".tmp", self.devices_path)
+
+    def append(self, device, direction, payload, timestamp):
+        """写入一条记录，调用方持有锁"""
+        device_id = self.devices.get(device)
+        if device_id is None:
+            device_id = self.devices[device] = len(self.devices)
+            self.write_devices()
+        length = len(payload)
+        position = self.head % self.capacity
+        if position + length > self.capacity:   # 数据区尾部放不下时从头写，尾部空出的字节不再使用
+            self.head += self.capacity - position
+            position = 0
+        self.data[HEADER_SIZE + position:HEADER_SIZE + position + length] = payload
+        INDEX_ENTRY.pack_into(self.index, (self.count % self.index_entries) * INDEX_ENTRY.size,
+                              self.head, timestamp, device_id, length, direction)
+        self.head += length
+        self.count += 1
+        self.write_header()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+        self.data_file.close()
+        self.index_file.close()
+
+
+class PacketCapture:
+    """
+    设备连接在收发路径上调用record，开启时把原始数据写入本进程的抓包文件
+    每个进程写自己的文件（主进程为main，工作进程为worker<编号>），查询和导出时直接读取目录下所有进程的文件
+    记录只做一次内存拷贝和几个定长字段的写入，不格式化、不做系统调用
+    """
+
+    def __init__(self, enabled=False, directory=None, ring_bytes=64 * 1024 * 1024, index_entries=1024 * 1024,
+                 snaplen=4096):
+        self.enabled = enabled
+        self.directory = directory or os.path.join(log_path, "capture")
+        self.ring_bytes = ring_bytes            # 每个进程的数据区大小，单位为字节
+        self.index_entries = index_entries      # 每个进程最多保留的记录数
+        self.snaplen = snaplen                  # 每条记录最多保存的载荷字节数，超出部分截断
+        self.name = "main"
+        self.lock = threading.Lock()
+        self.ring = None
+
+    @classmethod
+    def from_config(cls, capture_config):
+        """从配置文件的capture节点创建"""
+        capture_config = capture_config or {}
+        return cls(
+            enabled=capture_config.get("enabled", False),
+            directory=capture_config.get("directory") or None,
+            ring_bytes=capture_config.get("ring_bytes", 64 * 1024 * 1024),
+            index_entries=capture_config.get("index_entries", 1024 * 1024),
+            snaplen=capture_config.get("snaplen", 4096),
+        )
+
+    def set_name(self, name):
+        """工作进程在创建设备前调用，抓包文件按进程区分"""
+        self.name = name
+
+    def record(self, device, direction, data):
+        """
+        记录一次收发，调用方先判断enabled，未开启时不产生任何开销
+        :param device: 设备标签，如源IP
+        :param direction: SENT 或 RECEIVED
+        :param data: 原始数据，str按utf-8编码
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        payload = data[:self.snaplen]
+        timestamp = time.time()
+        with self.lock:
+            if self.ring is None:
+                self.ring = CaptureRing(self.directory, self.name, self.ring_bytes, self.index_entries)
+            self.ring.append(device, direction, payload, timestamp)
+
+    def close(self):
+        with self.lock:
+            if self.ring is not None:
+                self.ring.close()
+                self.ring = None
+
+    def clear(self):
+        """删除目录下上一次运行留下的抓包文件，主进程启动时调用，避免查询到已不存在的工作进程的旧记录"""
+        self.close()
+        if not os.path.isdir(self.directory):
+            return
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith((".ring", ".idx", ".devices")):
+                os.remove(os.path.join(self.directory, file_name))
+
+    def get_status(self):
+        """各进程抓包文件的记录数和保留范围"""
+        return [
+            {"process": name, "recordCount": count, "retainedCount": len(entries), "bytesWritten": head,
+             "deviceCount": len(devices),
+             "firstTime": entries[0][1] if entries else None, "lastTime": entries[-1][1] if entries else None}
+            for name, head, count, devices, entries, _ in self.read_files()
+        ]
+
+    def read_files(self):
+        """
+        读取目录下所有进程的抓包文件
+        :return: [(进程名, 逻辑字节数, 记录数, 设备表, 有效的索引项列表, 数据文件), ...]，索引项按写入顺序排列，
+                 其中的位置为载荷在数据文件中的偏移
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        results = []
+        for file_name in sorted(os.listdir(self.directory)):
+            if not file_name.endswith(".ring"):
+                continue
+            name = file_name[:-len(".ring")]
+            try:
+                with open(os.path.join(self.directory, file_name), "rb") as file:
+                    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)   # 只拷贝查询结果的载荷
+                with open(os.path.join(self.directory, f"{name}.idx"), "rb") as file:
+                    index = file.read()
+                with open(os.path.join(self.directory, f"{name}.devices"), encoding="utf-8") as file:
+                    devices = json.load(file)
+            except (OSError, ValueError):
+                continue    # 写入进程正在创建文件
+            magic, version, capacity, head, count, index_entries = HEADER.unpack_from(data, 0)
+            if magic != MAGIC or version != VERSION:
+                continue
+            if count > index_entries:   # 索引已写满一轮，从最早的索引项开始排列
+                split = (count % index_entries) * INDEX_ENTRY.size
+                index = index[split:] + index[:split]
+            else:
+                index = index[:count * INDEX_ENTRY.size]
+            oldest_position = head - capacity
+            entries = [(HEADER_SIZE + position % capacity, timestamp, device_id, length, direction)
+                       for position, timestamp, device_id, length, direction in INDEX_ENTRY.iter_unpack(index)
+                       if position >= oldest_position]  # 数据未被覆盖
+            results.append((name, head, count, devices, entries, data))
+        return results
+
+    def query(self, device=None, start_time=None, end_time=None, direction=None, limit=None):
+        """
+        按设备、时间范围和方向查询记录，按时间排序，超过limit时只保留最近的limit条
+        :return: [(时间戳, 进程名, 设备标签, 方向, 载荷), ...]
+        """
+        records = []
+        for name, _, _, devices, entries, data in self.read_files():
+            device_id = None
+            if device is not None:
+                if device not in devices:
+                    continue
+                device_id = devices.index(device)
+            for offset, timestamp, entry_device, length, entry_direction in entries:
+                if device_id is not None and entry_device != device_id:
+                    continue
+                if direction is not None and entry_direction != direction:
+                    continue
+                if (start_time is not None and timestamp < start_time) or (end_time is not None and timestamp > end_time):
+                    continue
+                records.append((timestamp, name, devices[entry_device], entry_direction,
+                                data[offset:offset + length]))
+        records.sort(key=lambda record: record[0])
+        if limit is not None:
+            records = records[-limit:]
+        return records
+
+    def export_pcapng(self, records):
+        """把查询结果导出为pcapng，每个设备一个接口，收发方向写入epb_flags，Wireshark中可按接口和方向过滤"""
+        blocks = [pcapng_block(0x0A0D0D0A, struct.pack("<IHHq", 0x1A2B3C4D, 1, 0, -1))]
+        interfaces = {}
+        for timestamp, name, device, direction, payload in records:
+            interface_key = (name, device)
+            interface_id = interfaces.get(interface_key)
+            if interface_id is None:
+                interface_id = interfaces[interface_key] = len(interfaces)
+                blocks.append(pcapng_block(1, struct.pack("<HHI", LINKTYPE_USER0, 0, self.snaplen) +
+                                           pcapng_option(2, f"{device}@{name}".encode())))     # if_name
+            microseconds = int(timestamp * 1000000)
+            flags = 1 if direction == RECEIVED else 2   # epb_flags的低两位：1为入方向，2为出方向
+            blocks.append(pcapng_block(6, struct.pack("<IIIII", interface_id, microseconds >> 32,
+                                                      microseconds & 0xFFFFFFFF, len(payload), len(payload)) +
+                                       pad4(payload) + pcapng_option(2, struct.pack("<I", flags))))
+        return b"".join(blocks)
+
+
+def pad4(data):
+    return data + b"\x00" * (-len(data) % 4)
+
+
+def pcapng_option(code, value):
+    """一个选项加选项结束标记"""
+    return struct.pack("<HH", code, len(value)) + pad4(value) + struct.pack("<HH", 0, 0)
+
+
+def pcapng_block(block_type, body):
+    total_length = 12 + len(body)
+    return struct.pack("<II", block_type, total_length) + body + struct.pack("<I", total_length)
+
+
+packet_capture = PacketCapture.from_config(config.get("capture"))
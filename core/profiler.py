@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/25 10:00
+# @Author  : Heshouyi
+# @File    : profiler.py
+# @Software: PyCharm
+# @description: 运行中引擎的诊断：采样剖析、线程栈、tracemalloc内存快照对比和事件循环延迟，不需要重启进程
+
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from core.connections.event_loop import shared_event_loop
+
+IP_PATTERN = re.compile(r"\d{1,3}(?:\.\d{1,3}){3}")     # 按设备命名的线程（如picture-upload-<源IP>）中的源IP
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def collapse_stack(frame):
+    """把栈帧展开为从外到内、以分号分隔的折叠栈格式，与flamegraph.pl和speedscope的输入一致"""
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return ";".join(labels)
+
+
+def sample_stacks(seconds=10, interval=0.005):
+    """
+    采样剖析：每interval秒读取一次所有线程的当前栈，持续seconds秒，阻塞直到结束
+    只读取解释器中已有的栈帧，不设置跟踪函数，被剖析的线程几乎没有额外开销
+    :return: {"线程名;栈": 采样次数}
+    """
+    own_ident = threading.get_ident()
+    counts = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = f"{names.get(ident, ident)};{collapse_stack(frame)}"
+            counts[stack] = counts.get(stack, 0) + 1
+        time.sleep(interval)
+    return counts
+
+
+def dump_threads():
+    """所有线程的名称、是否守护线程、按名称识别出的设备源IP和当前栈（从外到内）"""
+    frames = sys._current_frames()
+    threads = []
+    for thread in threading.enumerate():
+        frame = frames.get(thread.ident)
+        stack = []
+        while frame is not None:
+            stack.append(frame_label(frame))
+            frame = frame.f_back
+        stack.reverse()
+        device = IP_PATTERN.search(thread.name)
+        threads.append({"name": thread.name, "ident": thread.ident, "daemon": thread.daemon,
+                        "device": device.group() if device else None, "stack": stack})
+    return threads
+
+
+def measure_loop_lag(samples=5, timeout=5):
+    """
+    测量共用事件循环的调度延迟：从其他线程提交一个空回调到它被执行的时间
+    延迟大说明事件循环线程被长时间占用，心跳、重连等定时任务会被推迟
+    :return: 各次测量的最小、平均和最大值，单位为毫秒，事件循环未启动时返回None
+    """
+    if shared_event_loop.loop is None:
+        return None
+    lags = []
+    for _ in range(samples):
+        executed = threading.Event()
+        start = time.perf_counter()
+        shared_event_loop.loop.call_soon_threadsafe(executed.set)
+        if not executed.wait(timeout):
+            lags.append(timeout)
+            break
+        lags.append(time.perf_counter() - start)
+    return {"minMs": round(min(lags) * 1000, 3), "avgMs": round(sum(lags) / len(lags) * 1000, 3),
+            "maxMs": round(max(lags) * 1000, 3), "samples": len(lags)}
+
+
+class MemoryTracer:
+    """
+    tracemalloc的开关和快照对比，baseline保存基准快照，diff返回当前相对基准增长最多的分配位置
+    开启后每次内存分配都要记录调用栈，会明显拖慢进程，排查完应关闭
+    """
+
+    def __init__(self):
+        self.baseline = None
+
+    def handle(self, action, limit=20, frames=1):
+        """
+        :param action: start：开始跟踪 baseline：保存基准快照 diff：与基准对比 stop：停止跟踪并丢弃快照
+        :param limit: diff返回的分配位置数
+        :param frames: start时每次分配记录的栈深度，大于1时diff按完整调用栈分组
+        """
+        if action == "start":
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self.baseline = None
+            return self.get_status()
+        if action == "stop":
+            tracemalloc.stop()
+            self.baseline = None
+            return self.get_status()
+        if not tracemalloc.is_tracing():
+            raise Exception("tracemalloc未开启，需先执行start")
+        if action == "baseline":
+            self.baseline = tracemalloc.take_snapshot()
+            return self.get_status()
+        if action == "diff":
+            snapshot = tracemalloc.take_snapshot()
+            key_type = "traceback" if tracemalloc.get_traceback_limit() > 1 else "lineno"
+            if self.baseline is None:   # 没有基准时返回当前占用最多的位置
+                stats = snapshot.statistics(key_type)[:limit]
+                return [{"location": format_traceback(stat.traceback), "size": stat.size, "count": stat.count}
+                        for stat in stats]
+            stats = snapshot.compare_to(self.baseline, key_type)[:limit]
+            return [{"location": format_traceback(stat.traceback), "size": stat.size, "sizeDiff": stat.size_diff,
+                     "count": stat.count, "countDiff": stat.count_diff} for stat in stats]
+        raise Exception(f"不支持的tracemalloc操作: {action}")
+
+    def get_status(self):
+        current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        return {"tracing": tracemalloc.is_tracing(), "hasBaseline": self.baseline is not None,
+                "tracedBytes": current, "peakBytes": peak}
+
+
+def format_traceback(traceback):
+    return " <- ".join(f"{os.path.basename(frame.filename)}:{frame.lineno}" for frame in reversed(traceback))
+
+
+memory_tracer = MemoryTracer()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/12 15:30
+# @Author  : Heshouyi
+# @File    : rate_limiter.py
+# @Software: PyCharm
+# @description: 令牌桶限速器
+
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    令牌桶限速器，线程安全
+    获取令牌时先预扣，令牌不足时允许欠账，调用方按欠账时长休眠，
+    休眠的误差不会累积到后续请求上，长时间运行的实际速率与设定速率一致
+    """
+
+    def __init__(self, rate, capacity=None, initial_tokens=None):
+        """
+        :param rate: 每秒产生的令牌数，如字节/秒、包/秒，小于等于0表示不限速
+        :param capacity: 桶容量，即允许的突发量，默认为1秒的令牌数
+        :param initial_tokens: 初始令牌数，默认为满桶，整形场景传0可避免开始阶段的突发
+        """
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.capacity = 0
+        self.tokens = 0
+        self.last_time = time.monotonic()
+        self.set_rate(rate, capacity)
+        self.tokens = self.capacity if initial_tokens is None else initial_tokens
+
+    def set_rate(self, rate, capacity=None):
+        """运行时调整速率，已积累的令牌不超过新容量"""
+        with self.lock:
+            self.refill(time.monotonic())
+            self.rate = rate
+            self.capacity = capacity if capacity is not None else rate
+            self.tokens = min(self.tokens, self.capacity)
+
+    def refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+
+    def reserve(self, amount=1):
+        """
+        预扣令牌，不阻塞
+        :return: 需要等待的秒数，0表示可立即发送
+        """
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            self.refill(time.monotonic())
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self, amount=1):
+        """获取令牌，令牌不足时阻塞等待"""
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/23 15:00
+# @Author  : Heshouyi
+# @File    : report_correlation.py
+# @Software: PyCharm
+# @description: 设备事件到平台上报的端到端时延，发送事件时按关联键登记发送时间，收到平台上报时按关联键O(1)匹配
+
+import threading
+import time
+from collections import deque
+from core.configer import config
+from core.connections.event_loop import PeriodicTask
+from core.heartbeat_monitor import LatencyStats, retention_slices, snapshot_stats, merge_snapshots, \
+    summarize_snapshot
+
+# 事件类型，同时作为关联键的第一项
+CHANNEL_EVENT = "channel_event"     # 通道相机事件，按eventId关联
+PLATE = "plate"                     # 车牌，通道相机事件同时按车牌关联
+PARKING_STATUS = "parking_status"   # 车位相机车位状态，按相机IP和车位号关联
+LORA_STATUS = "lora_status"         # Lora节点探测器状态，按探测器地址关联
+# 上报中组成各类关联键的字段名，按顺序尝试，上报中包含某类事件的全部字段时按该类事件匹配
+DEFAULT_REPORT_KEYS = {
+    CHANNEL_EVENT: ["eventId"],
+    PLATE: ["plate"],
+    PARKING_STATUS: ["deviceIp", "parkNum"],
+    LORA_STATUS: ["sensorAddr"],
+}
+
+
+class CorrelationEntry:
+    """一个已发送的事件，可能登记在多个关联键下，任一关联键匹配后其余关联键上的登记随之失效"""
+
+    __slots__ = ("kind", "sent_at", "matched")
+
+    def __init__(self, kind, sent_at):
+        self.kind = kind            # 统计归入的事件类型，即第一个关联键的类型
+        self.sent_at = sent_at      # 发送时间，time.time()，工作进程转发的事件与主进程比较
+        self.matched = False        # 已匹配或已过期
+
+
+class ReportCorrelation:
+    """
+    事件与平台上报的关联索引，关联键 -> 按发送顺序排列的事件，登记和匹配都是O(1)
+    超过ttl仍未收到上报的事件记为缺失，收到的上报找不到对应事件时记为无法匹配
+    平台上报由主进程的接口接收；工作进程中发送的事件按批转发到主进程登记
+    """
+
+    def __init__(self, ttl=300, slice_seconds=10, windows=(60, 300, 3600), report_keys=None, max_pending=1000000):
+        self.ttl = ttl                          # 等待上报的时间，单位为秒
+        self.slice_seconds = slice_seconds
+        self.windows = tuple(sorted(windows))   # 统计窗口，单位为秒
+        self.report_keys = report_keys or DEFAULT_REPORT_KEYS
+        self.max_pending = max_pending          # 等待上报的事件数上限，超过时最早的事件提前记为缺失
+        self.lock = threading.Lock()
+        self.index = {}                 # (事件类型, 关联值...) -> deque[CorrelationEntry]
+        self.timeline = deque()         # 按发送顺序排列的 (关联键列表, CorrelationEntry)，用于过期
+        self.stats = {}                 # 事件类型 -> LatencyStats
+        self.pending = {}               # 事件类型 -> 等待上报的事件数，登记时加1，匹配或过期时减1
+        self.unrecognized = 0           # 不含任何关联字段的上报数
+        self.forward = None             # 工作进程中设置，把登记的事件批量发送给主进程
+        self.forward_buffer = []
+        self.flush_task = None
+
+    @classmethod
+    def from_config(cls, correlation_config):
+        """从配置文件的report_correlation节点创建"""
+        correlation_config = correlation_config or {}
+        return cls(
+            ttl=correlation_config.get("ttl", 300),
+            slice_seconds=correlation_config.get("slice_seconds", 10),
+            windows=correlation_config.get("windows") or (60, 300, 3600),
+            report_keys=correlation_config.get("report_keys"),
+            max_pending=correlation_config.get("max_pending", 1000000),
+        )
+
+    def get_stats_entry(self, kind) -> LatencyStats:
+        stats = self.stats.get(kind)
+        if stats is None:
+            stats = self.stats[kind] = LatencyStats(
+                ("sent", "matched", "missing", "unmatched"), self.slice_seconds,
+                retention_slices(self.windows, self.slice_seconds))
+        return stats
+
+    def record(self, *keys):
+        """
+        登记一个刚发送的事件，在设备的发送路径上调用
+        :param keys: 关联键，如 ("channel_event", eventId), ("plate", 车牌)，统计归入第一个关联键的事件类型
+        """
+        keys = [(key[0], *map(str, key[1:])) for key in keys]
+        sent_at = time.time()
+        if self.forward is not None:
+            with self.lock:
+                self.forward_buffer.append((keys, sent_at))
+            return
+        self.register(keys, sent_at)
+
+    def register(self, keys, sent_at):
+        entry = CorrelationEntry(keys[0][0], sent_at)
+        with self.lock:
+            for key in keys:
+                queue = self.index.get(key)
+                if queue is None:
+                    queue = self.index[key] = deque()
+                queue.append(entry)
+            self.timeline.append((keys, entry))
+            self.pending[entry.kind] = self.pending.get(entry.kind, 0) + 1
+            if len(self.timeline) > self.max_pending:
+                self.expire_oldest()
+            self.get_stats_entry(entry.kind).counters["sent"] += 1
+
+    def register_many(self, batch):
+        """登记工作进程转发的一批事件"""
+        for keys, sent_at in batch:
+            self.register(keys, sent_at)
+
+    def match(self, report):
+        """
+        收到平台上报时调用，按report_keys的顺序找到第一类包含全部关联字段的事件，匹配最早发出且未匹配的事件
+        匹配不到时上报记为该类事件无法匹配，不再尝试后面的事件类型
+        :return: 端到端时延，单位为秒，没有匹配的事件时返回None
+        """
+        fields = flatten_fields(report)
+        now = time.time()
+        with self.lock:
+            self.expire(now)
+            kind = next((kind for kind, names in self.report_keys.items() if all(name in fields for name in names)),
+                        None)
+            if kind is None:
+                self.unrecognized += 1
+                return None
+            entry = self.take((kind, *(fields[name] for name in self.report_keys[kind])))
+            if entry is None:
+                self.get_stats_entry(kind).counters["unmatched"] += 1
+                return None
+            latency = max(0.0, now - entry.sent_at)
+            self.get_stats_entry(entry.kind).record(latency, time.monotonic(), "matched")
+            return latency
+
+    def take(self, key):
+        """取出关联键下最早的未匹配事件，调用方持有锁"""
+        queue = self.index.get(key)
+        entry = None
+        while queue:
+            candidate = queue.popleft()
+            if not candidate.matched:
+                candidate.matched = True
+                self.pending[candidate.kind] -= 1
+                entry = candidate
+                break
+        if queue is not None and not queue:
+            del self.index[key]
+        return entry
+
+    def expire(self, now):
+        """把超过ttl仍未匹配的事件记为缺失，调用方持有锁"""
+        deadline = now - self.ttl
+        while self.timeline and self.timeline[0][1].sent_at < deadline:
+            self.expire_oldest()
+
+    def expire_oldest(self):
+        keys, entry = self.timeline.popleft()
+        if not entry.matched:
+            entry.matched = True
+            self.pending[entry.kind] -= 1
+            self.get_stats_entry(entry.kind).counters["missing"] += 1
+        for key in keys:
+            queue = self.index.get(key)
+            while queue and queue[0].matched:
+                queue.popleft()
+            if queue is not None and not queue:
+                del self.index[key]
+
+    def start_forwarding(self, send, interval=0.2):
+        """
+        工作进程中调用，之后登记的事件每interval秒批量交给send发送到主进程
+        :param send: 接收 [(关联键列表, 发送时间), ...] 的函数
+        """
+        self.forward = send
+        self.flush_task = PeriodicTask(interval, self.flush, blocking=True)
+        self.flush_task.start(interval)
+
+    def flush(self):
+        """发送积累的事件，工作进程退出前也调用一次"""
+        with self.lock:
+            batch, self.forward_buffer = self.forward_buffer, []
+        if batch:
+            self.forward(batch)
+
+    def get_stats(self):
+        """按事件类型返回发送、匹配、缺失、无法匹配的上报和等待中的事件数，以及端到端时延的分位数"""
+        now = time.monotonic()
+        with self.lock:
+            self.expire(time.time())
+            pending = dict(self.pending)
+            unrecognized = self.unrecognized
+        types = summarize_snapshot(merge_snapshots([snapshot_stats(self.stats, now, self.slice_seconds)]),
+                                   self.windows, self.slice_seconds)
+        for kind, summary in types.items():
+            summary["pending"] = pending.get(kind, 0)
+        return {"types": types, "unrecognizedReports": unrecognized}
+
+
+def flatten_fields(report):
+    """取出上报中所有层级的字段，同名字段以最先出现的为准，值统一转为字符串"""
+    fields = {}
+    stack = [report]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            for name, item in value.items():
+                if isinstance(item, (dict, list)):
+                    stack.append(item)
+                elif name not in fields and item is not None:
+                    fields[name] = str(item)
+        elif isinstance(value, list):
+            stack.extend(reversed(value))
+    return fields
+
+
+report_correlation = ReportCorrelation.from_config(config.get("report_correlation"))
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/25 15:00
+# @Author  : Heshouyi
+# @File    : resource_monitor.py
+# @Software: PyCharm
+# @description: 后台资源监控：事件循环调度延迟、线程数、RSS和GC暂停时间，以及按设备类型估算的单台设备内存占用，
+#               按Prometheus文本格式输出到/metrics
+
+import array
+import asyncio
+import gc
+import io
+import socket
+import sys
+import threading
+import time
+import types
+import psutil
+from core.configer import config
+from core.connections.event_loop import PeriodicTask, shared_event_loop
+from core.connections.reconnect_scheduler import reconnect_scheduler
+from core.connections.selector_reactor import reactor_pool
+from core.connections.target_pool import target_pool
+from core.heartbeat_monitor import heartbeat_monitor
+from core.logger import logger
+from core.packet_capture import packet_capture
+from core.report_correlation import report_correlation
+from core.telemetry import METRIC_PREFIX, escape_label, telemetry
+
+# 单台设备内存占用的组成部分：对象类型 -> 归入的部分，其余对象归入service
+SOCKETS = "sockets"
+BUFFERS = "buffers"
+TIMERS = "timers"
+SERVICE = "service"
+COMPONENT_TYPES = (
+    ((socket.socket,), SOCKETS),
+    ((bytes, bytearray, memoryview, array.array, io.BytesIO), BUFFERS),
+    ((asyncio.TimerHandle, asyncio.Handle), TIMERS),
+)
+COMPONENTS = (SERVICE, SOCKETS, BUFFERS, TIMERS)
+# 遍历设备对象图时不进入的对象类型：代码和类型本身由所有设备共用
+STOP_TYPES = (types.ModuleType, type, types.FunctionType, types.BuiltinFunctionType, types.CodeType,
+              types.FrameType, asyncio.AbstractEventLoop)
+
+
+class ResourceMonitor:
+    """
+    进程内的资源采样，事件循环上的探测任务每probe_interval秒执行一次，按实际执行时间与预定时间之差记录调度延迟
+    后台线程每interval秒汇总一次延迟、线程数、RSS和GC暂停，调度延迟超过lag_budget_ms时记录告警日志
+    每footprint_interval秒从各设备类型中抽取footprint_samples台设备，遍历其对象图估算单台设备的内存占用
+    主进程和每个工作进程各有一个实例，工作进程的快照经管道汇总到主进程后统一输出
+    """
+
+    def __init__(self, enabled=True, interval=5, probe_interval=0.1, lag_budget_ms=50, footprint_interval=60,
+                 footprint_samples=3, max_objects=100000):
+        self.enabled = enabled
+        self.interval = interval                    # 汇总间隔，单位为秒
+        self.probe_interval = probe_interval        # 事件循环探测任务的间隔，单位为秒
+        self.lag_budget = lag_budget_ms / 1000      # 调度延迟的告警阈值，单位为秒
+        self.footprint_interval = footprint_interval    # 估算设备内存占用的间隔，单位为秒
+        self.footprint_samples = footprint_samples  # 每种设备类型抽取的设备数，至少2台时可识别同类设备共用的对象
+        self.max_objects = max_objects              # 遍历单台设备对象图的对象数上限
+        self.name = "main"
+        self.lock = threading.Lock()
+        self.process = psutil.Process()
+        self.devices = {}               # 设备类型 -> {id(设备服务): 设备服务}
+        self.probe_task = None
+        self.probe_expected = None      # 探测任务下一次预定执行的时间
+        self.lag_max = 0.0              # 本次汇总周期内的调度延迟最大值、总和和探测次数
+        self.lag_sum = 0.0
+        self.lag_count = 0
+        self.over_budget = 0            # 调度延迟超过阈值的汇总周期数
+        self.gc_started = None          # 当前GC开始的时间
+        self.gc_stats = {}              # 代 -> [回收次数, 累计暂停时间]
+        self.gc_pause_max = 0.0         # 本次汇总周期内单次GC暂停的最大值
+        self.latest = {}                # 最近一次汇总的结果
+        self.footprint = {}             # 设备类型 -> 单台设备各组成部分的平均字节数
+        self.footprint_time = 0.0
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    @classmethod
+    def from_config(cls, monitor_config):
+        """从配置文件的resource_monitor节点创建"""
+        monitor_config = monitor_config or {}
+        return cls(
+            enabled=monitor_config.get("enabled", True),
+            interval=monitor_config.get("interval", 5),
+            probe_interval=monitor_config.get("probe_interval", 0.1),
+            lag_budget_ms=monitor_config.get("lag_budget_ms", 50),
+            footprint_interval=monitor_config.get("footprint_interval", 60),
+            footprint_samples=monitor_config.get("footprint_samples", 3),
+            max_objects=monitor_config.get("max_objects", 100000),
+        )
+
+    def set_name(self, name):
+        """工作进程在启动监控前调用，输出的指标按进程区分"""
+        self.name = name
+
+    def track(self, device_type, service):
+        """登记一台批量设备，估算内存占用时从中抽样"""
+        with self.lock:
+            self.devices.setdefault(device_type, {})[id(service)] = service
+
+    def start(self):
+        if not self.enabled or self.thread is not None:
+            return
+        gc.callbacks.append(self.on_gc)
+        self.probe_task = PeriodicTask(self.probe_interval, self.probe)
+        self.probe_task.start(self.probe_interval)
+        self.thread = threading.Thread(target=self.run, name="resource-monitor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.probe_task.cancel()
+        if self.on_gc in gc.callbacks:
+            gc.callbacks.remove(self.on_gc)
+        self.thread = None
+
+    def probe(self):
+        """事件循环线程中执行，预定时间与实际执行时间之差即为其他回调占用事件循环造成的调度延迟"""
+        now = time.monotonic()
+        if self.probe_expected is not None:
+            lag = max(0.0, now - self.probe_expected)
+            if lag > self.lag_max:
+                self.lag_max = lag
+            self.lag_sum += lag
+            self.lag_count += 1
+        self.probe_expected = now + self.probe_interval
+
+    def on_gc(self, phase, info):
+        """gc.callbacks的回调，在触发GC的线程中执行"""
+        if phase == "start":
+            self.gc_started = time.perf_counter()
+            return
+        if self.gc_started is None:
+            return
+        pause = time.perf_counter() - self.gc_started
+        self.gc_started = None
+        stats = self.gc_stats.get(info["generation"])
+        if stats is None:
+            stats = self.gc_stats[info["generation"]] = [0, 0.0]
+        stats[0] += 1
+        stats[1] += pause
+        if pause > self.gc_pause_max:
+            self.gc_pause_max = pause
+
+    def run(self):
+        next_footprint = time.monotonic() + self.interval
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.sample()
+                if time.monotonic() >= next_footprint:
+                    next_footprint = time.monotonic() + self.footprint_interval
+                    footprint = self.estimate_footprint()
+                    with self.lock:
+                        self.footprint, self.footprint_time = footprint, time.time()
+            except Exception as e:
+                logger.exception(f"资源采样失败: {e}")
+
+    def sample(self):
+        """汇总本周期的调度延迟和GC暂停，读取线程数和RSS，调度延迟超过阈值时记录告警"""
+        lag_max, lag_sum, lag_count = self.lag_max, self.lag_sum, self.lag_count
+        self.lag_max, self.lag_sum, self.lag_count = 0.0, 0.0, 0
+        gc_pause_max, self.gc_pause_max = self.gc_pause_max, 0.0
+        if lag_count == 0 and shared_event_loop.loop is not None:
+            lag_max = self.interval     # 整个周期内探测任务一次都没有执行，事件循环被阻塞
+        if lag_max > self.lag_budget:
+            self.over_budget += 1
+            logger.warning(f"{self.name}事件循环调度延迟超出预算: 最大{lag_max * 1000:.1f}ms，"
+                           f"预算{self.lag_budget * 1000:.1f}ms，本周期探测{lag_count}次")
+        with self.lock:
+            device_counts = {device_type: len(services) for device_type, services in self.devices.items()}
+        self.latest = {
+            "loopLagMax": lag_max,
+            "loopLagAvg": lag_sum / lag_count if lag_count else 0.0,
+            "loopLagOverBudget": self.over_budget,
+            "threads": threading.active_count(),
+            "rssBytes": self.process.memory_info().rss,
+            "gc": {generation: list(stats) for generation, stats in self.gc_stats.items()},
+            "gcPauseMax": gc_pause_max,
+            "devices": device_counts,
+        }
+
+    def estimate_footprint(self):
+        """
+        从每种设备类型中抽取footprint_samples台设备，遍历设备服务对象可达的对象并按类型归入各组成部分
+        遍历不进入代码、类型、事件循环和各全局单例；被多台抽样设备同时引用的对象视为共用，不计入单台设备
+        :return: {设备类型: {"sampled": 抽样数, "service"/"sockets"/"buffers"/"timers": 平均字节数}}
+        """
+        with self.lock:
+            samples = {device_type: list(services.values())[:self.footprint_samples]
+                       for device_type, services in self.devices.items()}
+        stop_ids = {id(obj) for obj in shared_objects()}
+        reached = {}    # 设备类型 -> [各抽样设备可达的 {id: 对象}]
+        owners = {}     # 对象id -> 可达该对象的抽样设备数
+        for device_type, services in samples.items():
+            for service in services:
+                objects = self.reachable(service, stop_ids)
+                reached.setdefault(device_type, []).append(objects)
+                for object_id in objects:
+                    owners[object_id] = owners.get(object_id, 0) + 1
+        footprint = {}
+        for device_type, device_objects in reached.items():
+            totals = dict.fromkeys(COMPONENTS, 0)
+            for objects in device_objects:
+                for object_id, obj in objects.items():
+                    if owners[object_id] > 1:
+                        continue
+                    totals[component_of(obj)] += sys.getsizeof(obj)
+            sampled = len(device_objects)
+            footprint[device_type] = {"sampled": sampled, **{name: total // sampled for name, total in totals.items()}}
+        return footprint
+
+    def reachable(self, root, stop_ids):
+        """广度优先遍历root可达的对象，超过max_objects时停止"""
+        objects = {id(root): root}
+        queue = [root]
+        while queue and len(objects) < self.max_objects:
+            next_queue = []
+            for obj in queue:
+                for referent in gc.get_referents(obj):
+                    referent_id = id(referent)
+                    if referent_id in objects or referent_id in stop_ids or isinstance(referent, STOP_TYPES):
+                        continue
+                    objects[referent_id] = referent
+                    next_queue.append(referent)
+            queue = next_queue
+        return objects
+
+    def snapshot(self):
+        """最近一次采样和内存占用估算的结果，可被pickle序列化，用于工作进程上报"""
+        with self.lock:
+            footprint = {device_type: dict(values) for device_type, values in self.footprint.items()}
+        return {"process": self.name, "enabled": self.thread is not None, **self.latest, "footprint": footprint,
+                "footprintTime": self.footprint_time}
+
+    @staticmethod
+    def render(snapshots):
+        """按Prometheus文本格式输出各进程的资源快照，每个进程一组带process标签的时间序列"""
+        snapshots = [snapshot for snapshot in snapshots if snapshot.get("enabled") and "rssBytes" in snapshot]
+        lines = []
+
+        def header(name, help_text, metric_type="gauge"):
+            lines.append(f"# HELP {METRIC_PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} {metric_type}")
+
+        def sample(name, value, **labels):
+            text = ",".join(f'{key}="{escape_label(label)}"' for key, label in labels.items())
+            lines.append(f"{METRIC_PREFIX}{name}{{{text}}} {value}")
+
+        header("event_loop_lag_seconds", "最近一个采样周期内事件循环的调度延迟，stat为max或avg")
+        for snapshot in snapshots:
+            sample("event_loop_lag_seconds", f"{snapshot['loopLagMax']:.6f}", process=snapshot["process"], stat="max")
+            sample("event_loop_lag_seconds", f"{snapshot['loopLagAvg']:.6f}", process=snapshot["process"], stat="avg")
+        header("event_loop_lag_over_budget_total", "调度延迟超过预算的采样周期数", "counter")
+        for snapshot in snapshots:
+            sample("event_loop_lag_over_budget_total", snapshot["loopLagOverBudget"], process=snapshot["process"])
+        header("threads", "进程中存活的线程数")
+        for snapshot in snapshots:
+            sample("threads", snapshot["threads"], process=snapshot["process"])
+        header("resident_memory_bytes", "进程的常驻内存（RSS）")
+        for snapshot in snapshots:
+            sample("resident_memory_bytes", snapshot["rssBytes"], process=snapshot["process"])
+        header("gc_collections_total", "按代统计的GC次数", "counter")
+        for snapshot in snapshots:
+            for generation, (count, _) in sorted(snapshot["gc"].items()):
+                sample("gc_collections_total", count, process=snapshot["process"], generation=generation)
+        header("gc_pause_seconds_total", "按代统计的GC累计暂停时间", "counter")
+        for snapshot in snapshots:
+            for generation, (_, pause) in sorted(snapshot["gc"].items()):
+                sample("gc_pause_seconds_total", f"{pause:.6f}", process=snapshot["process"], generation=generation)
+        header("gc_pause_max_seconds", "最近一个采样周期内单次GC暂停的最大值")
+        for snapshot in snapshots:
+            sample("gc_pause_max_seconds", f"{snapshot['gcPauseMax']:.6f}", process=snapshot["process"])
+        header("devices", "进程中的批量设备数")
+        for snapshot in snapshots:
+            for device_type, count in sorted(snapshot["devices"].items()):
+                sample("devices", count, process=snapshot["process"], device_type=device_type)
+        header("device_memory_bytes", "抽样估算的单台设备内存占用，component为service、sockets、buffers或timers")
+        for snapshot in snapshots:
+            for device_type, values in sorted(snapshot["footprint"].items()):
+                for component in COMPONENTS:
+                    sample("device_memory_bytes", values[component], process=snapshot["process"],
+                           device_type=device_type, component=component)
+        return "\n".join(lines) + "\n"
+
+
+def component_of(obj):
+    for object_types, component in COMPONENT_TYPES:
+        if isinstance(obj, object_types):
+            return component
+    return SERVICE
+
+
+def shared_objects():
+    """所有设备共用的全局对象，估算单台设备内存占用时不进入"""
+    objects = [config, logger, shared_event_loop, shared_event_loop.thread, telemetry, heartbeat_monitor,
+               report_correlation, packet_capture, target_pool, reactor_pool, reconnect_scheduler, resource_monitor]
+    objects.extend(reactor_pool.reactors)
+    objects.extend(heartbeat_monitor.stats.values())    # 同类型设备的心跳匹配器共用一份统计
+    return objects
+
+
+resource_monitor = ResourceMonitor.from_config(config.get("resource_monitor"))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/10 14:20
+# @Author  : Heshouyi
+# @File    : synthetic_picture.py
+# @Software: PyCharm
+# @description: 合成图片生成器，用于图片上传压测时按种子生成指定大小、内容各不相同的合法JPEG
+
+import random
+import re
+import struct
+import threading
+from collections import OrderedDict
+from core.logger import logger
+
+SYNTHETIC_PREFIX = "synthetic:"     # innerPic参数使用该前缀时走合成图片，格式 synthetic:<size>:<seed>
+MAX_SYNTHETIC_SIZE = 32 * 1024 * 1024   # 单张合成图片上限，J包总包数为2字节，1024字节分包时协议上限约64MB
+MOSAIC_BLOCKS = 8   # 马赛克图像宽高方向的8x8块数量，即生成64x64像素的图像
+
+# 标准亮度DC哈夫曼表（JPEG标准附录K.3），每个类别对应的码字和码长
+_DC_BITS = [0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0]
+_DC_VALUES = list(range(12))
+_DC_CODES = {0: (0b00, 2), 1: (0b010, 3), 2: (0b011, 3), 3: (0b100, 3), 4: (0b101, 3), 5: (0b110, 3),
+             6: (0b1110, 4), 7: (0b11110, 5), 8: (0b111110, 6), 9: (0b1111110, 7), 10: (0b11111110, 8),
+             11: (0b111111110, 9)}
+# AC表只有一个EOB符号，码字为1位的'0'，每个块只编码DC系数，即每块为纯色
+_AC_BITS = [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+_AC_VALUES = [0x00]
+_AC_EOB_CODE = (0b0, 1)
+
+_SIZE_PATTERN = re.compile(r"^(\d+)\s*(b|k|kb|m|mb)?$", re.IGNORECASE)
+_SIZE_UNITS = {None: 1, "b": 1, "k": 1024, "kb": 1024, "m": 1024 * 1024, "mb": 1024 * 1024}
+
+
+class _BitWriter:
+    """JPEG熵编码数据的位写入器，按协议要求对0xFF做0x00填充"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.accumulator = 0
+        self.bit_count = 0
+
+    def write(self, value, length):
+        self.accumulator = (self.accumulator << length) | (value & ((1 << length) - 1))
+        self.bit_count += length
+        while self.bit_count >= 8:
+            self.bit_count -= 8
+            byte = (self.accumulator >> self.bit_count) & 0xFF
+            self.buffer.append(byte)
+            if byte == 0xFF:
+                self.buffer.append(0x00)
+        self.accumulator &= (1 << self.bit_count) - 1
+
+    def flush(self):
+        """剩余不足一个字节的位用1填充"""
+        if self.bit_count:
+            self.write((1 << (8 - self.bit_count)) - 1, 8 - self.bit_count)
+        return bytes(self.buffer)
+
+
+def _segment(marker, payload: bytes):
+    """封装一个带长度的JPEG段"""
+    return struct.pack(">BBH", 0xFF, marker, len(payload) + 2) + payload
+
+
+def _encode_mosaic(rng: random.Random):
+    """按种子生成随机灰度马赛克的熵编码数据，每个8x8块一个灰度值"""
+    writer = _BitWriter()
+    previous_dc = 0
+    for _ in range(MOSAIC_BLOCKS * MOSAIC_BLOCKS):
+        dc = rng.randint(-128, 127)     # DQT中DC量化值为8，系数即为(灰度均值-128)
+        diff = dc - previous_dc
+        previous_dc = dc
+        category = abs(diff).bit_length()
+        code, code_length = _DC_CODES[category]
+        writer.write(code, code_length)
+        if category:
+            # 负数差值按协议写入其反码的低位
+            writer.write(diff if diff > 0 else diff - 1, category)
+        writer.write(*_AC_EOB_CODE)
+    return writer.flush()
+
+
+def _build_jpeg(size, seed):
+    """生成合法的基线灰度JPEG，并用种子随机内容的COM注释段把文件填充到指定大小"""
+    rng = random.Random(f"{seed}")
+    quant_table = bytes([8] + [rng.randint(1, 255) for _ in range(63)])    # AC量化值不影响图像，按种子随机，进一步区分文件
+
+    head = b"\xff\xd8" + _segment(0xE0, b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00")
+    body = (
+        _segment(0xDB, b"\x00" + quant_table) +
+        _segment(0xC0, struct.pack(">BHHBBBB", 8, MOSAIC_BLOCKS * 8, MOSAIC_BLOCKS * 8, 1, 1, 0x11, 0)) +
+        _segment(0xC4, b"\x00" + bytes(_DC_BITS) + bytes(_DC_VALUES)) +
+        _segment(0xC4, b"\x10" + bytes(_AC_BITS) + bytes(_AC_VALUES)) +
+        _segment(0xDA, b"\x01\x01\x00\x00\x3f\x00") +
+        _encode_mosaic(rng) +
+        b"\xff\xd9"
+    )
+
+    # 剩余长度用COM段填充，每段负载最多65533字节，段头4字节
+    padding = size - len(head) - len(body)
+    comments = bytearray()
+    if padding > 0:
+        segment_count = -(-padding // (65533 + 4))
+        payload_total = max(padding - segment_count * 4, 0)     # 不足一个段头时向上取整，最多超出3字节
+        payload = rng.randbytes(payload_total)
+        offset = 0
+        for index in range(segment_count):
+            length = payload_total // segment_count + (1 if index < payload_total % segment_count else 0)
+            comments += _segment(0xFE, payload[offset:offset + length])
+            offset += length
+    return head + bytes(comments) + body
+
+
+def parse_synthetic_name(name):
+    """
+    解析合成图片名称
+    :param name: synthetic:<size>:<seed>，size支持b/kb/mb单位，如 synthetic:50kb:1、synthetic:3MB:abc
+    :return: (size, seed)，格式错误时抛出ValueError
+    """
+    parts = name[len(SYNTHETIC_PREFIX):].split(":", 1)
+    if len(parts) != 2 or not parts[1]:
+        raise ValueError(f"合成图片名称格式应为 synthetic:<size>:<seed>，实际为: {name}")
+    match = _SIZE_PATTERN.match(parts[0].strip())
+    if not match:
+        raise ValueError(f"合成图片大小格式错误: {parts[0]}")
+    unit = match.group(2).lower() if match.group(2) else None
+    size = int(match.group(1)) * _SIZE_UNITS[unit]
+    if size <= 0 or size > MAX_SYNTHETIC_SIZE:
+        raise ValueError(f"合成图片大小需在1到{MAX_SYNTHETIC_SIZE}字节之间，实际为: {size}")
+    return size, parts[1]
+
+
+class SyntheticPictureCache:
+    """按总字节数限制容量的LRU缓存，同一个size和seed只生成一次"""
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes  # 缓存总字节上限
+        self.current_bytes = 0
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, size, seed):
+        key = (size, str(seed))
+        with self.lock:
+            picture = self.cache.get(key)
+            if picture is not None:
+                self.cache.move_to_end(key)
+                return picture
+
+        # 生成过程不持锁，不同图片可以并发生成
+        picture = _build_jpeg(size, seed)
+        with self.lock:
+            if key not in self.cache and len(picture) <= self.max_bytes:
+                self.cache[key] = picture
+                self.current_bytes += len(picture)
+                while self.current_bytes > self.max_bytes:
+                    _, evicted = self.cache.popitem(last=False)
+                    self.current_bytes -= len(evicted)
+        return picture
+
+
+synthetic_picture_cache = SyntheticPictureCache()
+
+
+def is_synthetic_name(name):
+    return bool(name) and name.startswith(SYNTHETIC_PREFIX)
+
+
+def get_synthetic_picture(name):
+    """按名称获取合成图片，格式错误时返回None"""
+    try:
+        size, seed = parse_synthetic_name(name)
+    except ValueError as e:
+        logger.error(f"合成图片参数错误: {e}")
+        return None
+    return synthetic_picture_cache.get(size, seed)
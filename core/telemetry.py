@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/22 15:00
+# @Author  : Heshouyi
+# @File    : telemetry.py
+# @Software: PyCharm
+# @description: 设备收发和协议层的计数器与直方图，按Prometheus文本格式输出
+
+import bisect
+import threading
+import weakref
+from core.configer import config
+
+METRIC_PREFIX = "findcar_"
+# 确认时延直方图的桶上限，单位为秒
+DEFAULT_ACK_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# 计数器名称 -> 说明
+CONNECTS_TOTAL = "connects_total"
+RECONNECTS_TOTAL = "reconnects_total"
+SEND_ERRORS_TOTAL = "send_errors_total"
+DECODE_ERRORS_TOTAL = "decode_errors_total"
+COUNTER_HELP = {
+    CONNECTS_TOTAL: "建连成功次数，包括重连",
+    RECONNECTS_TOTAL: "断线后自动重连并恢复会话的次数",
+    SEND_ERRORS_TOTAL: "发送失败次数，包括未连接时发送",
+    DECODE_ERRORS_TOTAL: "服务器下发数据解包失败次数",
+}
+# 收发方向 -> (包数指标, 字节数指标)
+TRAFFIC_METRICS = {
+    "sent": ("frames_sent_total", "bytes_sent_total"),
+    "received": ("frames_received_total", "bytes_received_total"),
+}
+# 瞬时值名称 -> 说明
+OUTBOX_DEPTH = "outbox_depth"
+SEND_QUEUE_BYTES = "send_queue_bytes"
+GAUGE_HELP = {
+    OUTBOX_DEPTH: "断线缓冲区中等待补发的事件数",
+    SEND_QUEUE_BYTES: "套接字发送队列中尚未被服务器确认的字节数",
+}
+ACK_LATENCY = "ack_latency_seconds"
+
+
+class DeviceTelemetry:
+    """
+    绑定了设备类型和设备标签的记录入口，设备连接和业务层在收发路径上直接调用
+    每个入口缓存自己用到的计数项，记录时只按命令码或名称查一次小字典再累加，不拼接标签、不加锁
+    并发累加在极少数情况下可能丢失一次计数，统计用途可以接受
+    """
+
+    __slots__ = ("registry", "device_type", "device", "counter_entries", "sent_entries", "received_entries",
+                 "histogram_entries", "buckets")
+
+    def __init__(self, registry, device_type, device):
+        self.registry = registry
+        self.device_type = device_type
+        self.device = device        # 不按设备输出时为空字符串，同类型的设备共用计数项
+        self.counter_entries = {}   # 计数器名 -> 注册表中的计数项
+        self.sent_entries = {}      # 命令码 -> 注册表中的 [包数, 字节数]
+        self.received_entries = {}
+        self.histogram_entries = {}     # 确认类型 -> 注册表中的直方图
+        self.buckets = registry.buckets
+
+    def count(self, name, value=1):
+        entry = self.counter_entries.get(name)
+        if entry is None:
+            entry = self.counter_entries[name] = self.registry.get_entry(
+                self.registry.counters, (name, self.device_type, self.device), 1)
+        entry[0] += value
+
+    def frame_sent(self, command_code, size):
+        entry = self.sent_entries.get(command_code)
+        if entry is None:
+            entry = self.sent_entries[command_code] = self.registry.get_entry(
+                self.registry.traffic, ("sent", self.device_type, self.device, command_code), 2)
+        entry[0] += 1
+        entry[1] += size
+
+    def frame_received(self, command_code, size):
+        entry = self.received_entries.get(command_code)
+        if entry is None:
+            entry = self.received_entries[command_code] = self.registry.get_entry(
+                self.registry.traffic, ("received", self.device_type, self.device, command_code), 2)
+        entry[0] += 1
+        entry[1] += size
+
+    def observe_ack(self, kind, latency):
+        """
+        记录一次服务器确认的等待时间
+        :param kind: 确认类型，如 register、heartbeat、image
+        :param latency: 等待时间，单位为秒
+        """
+        histogram = self.histogram_entries.get(kind)
+        if histogram is None:
+            # 各桶的计数（最后一个为超过所有上限的部分），之后是总和与次数
+            histogram = self.histogram_entries[kind] = self.registry.get_entry(
+                self.registry.histograms, (kind, self.device_type, self.device), len(self.buckets) + 3)
+        histogram[bisect.bisect_left(self.buckets, latency)] += 1
+        histogram[-2] += latency
+        histogram[-1] += 1
+
+
+class Telemetry:
+    """
+    进程内的指标注册表，所有设备共用
+    per_device为False时只按设备类型汇总，设备数量很大时输出的时间序列数不随设备数增长
+    批量设备在工作进程中时，各进程的快照经管道汇总到主进程后统一输出
+    """
+
+    def __init__(self, per_device=False, ack_buckets=DEFAULT_ACK_BUCKETS):
+        self.per_device = per_device
+        self.buckets = tuple(sorted(ack_buckets))
+        self.counters = {}      # (计数器名, 设备类型, 设备) -> [次数]
+        self.lock = threading.Lock()    # 只在创建计数项时使用，累加不加锁
+        self.traffic = {}       # (收发方向, 设备类型, 设备, 命令码) -> [包数, 字节数]
+        self.histograms = {}    # (确认类型, 设备类型, 设备) -> [各桶计数..., 总和, 次数]
+        self.clients = weakref.WeakSet()    # 设置了指标标签的设备连接，输出时读取其缓冲区和发送队列深度
+
+    @classmethod
+    def from_config(cls, telemetry_config):
+        """从配置文件的telemetry节点创建"""
+        telemetry_config = telemetry_config or {}
+        return cls(
+            per_device=telemetry_config.get("per_device", False),
+            ack_buckets=telemetry_config.get("ack_buckets") or DEFAULT_ACK_BUCKETS,
+        )
+
+    def device(self, device_type, device=None) -> DeviceTelemetry:
+        """创建设备的记录入口，device为设备标签（源IP或设备编号），per_device为False时忽略"""
+        return DeviceTelemetry(self, device_type, str(device) if self.per_device and device is not None else "")
+
+    def get_entry(self, section, key, width):
+        """取出或创建计数项，同一标签只创建一次，多个记录入口共用"""
+        entry = section.get(key)
+        if entry is None:
+            with self.lock:
+                entry = section.setdefault(key, [0] * width)
+        return entry
+
+    def track(self, client):
+        """登记设备连接，输出时读取其断线缓冲区和发送队列深度"""
+        self.clients.add(client)
+
+    def collect_gauges(self):
+        gauges = {}
+        for client in list(self.clients):
+            labels = (client.telemetry.device_type, client.telemetry.device)
+            outbox = getattr(client, "outbox", None)
+            if outbox is not None:
+                gauges[(OUTBOX_DEPTH, *labels)] = gauges.get((OUTBOX_DEPTH, *labels), 0) + len(outbox)
+            queued = client.get_send_queue_bytes()
+            if queued:
+                gauges[(SEND_QUEUE_BYTES, *labels)] = gauges.get((SEND_QUEUE_BYTES, *labels), 0) + queued
+        return gauges
+
+    def snapshot(self):
+        """拷贝当前所有指标，可被pickle序列化，用于工作进程上报"""
+        return {
+            "buckets": self.buckets,
+            "counters": {key: value[0] for key, value in list(self.counters.items())},
+            "traffic": {key: list(value) for key, value in list(self.traffic.items())},
+            "histograms": {key: list(value) for key, value in list(self.histograms.items())},
+            "gauges": self.collect_gauges(),
+        }
+
+    @staticmethod
+    def merge(snapshots):
+        """把多个进程的快照相加为一个，直方图的桶上限以第一个快照为准"""
+        merged = {"buckets": snapshots[0]["buckets"], "counters": {}, "traffic": {}, "histograms": {}, "gauges": {}}
+        for snapshot in snapshots:
+            for section in ("counters", "gauges"):
+                target = merged[section]
+                for key, value in snapshot[section].items():
+                    target[key] = target.get(key, 0) + value
+            for section in ("traffic", "histograms"):
+                target = merged[section]
+                for key, values in snapshot[section].items():
+                    if key in target:
+                        target[key] = [total + value for total, value in zip(target[key], values)]
+                    else:
+                        target[key] = list(values)
+        return merged
+
+    @staticmethod
+    def render(snapshot):
+        """按Prometheus文本格式输出快照"""
+        lines = []
+
+        def labels(device_type, device, **extra):
+            pairs = [("device_type", device_type)]
+            if device:
+                pairs.append(("device", device))
+            pairs.extend(extra.items())
+            return ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs)
+
+        for name, help_text in COUNTER_HELP.items():
+            lines.append(f"# HELP {METRIC_PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} counter")
+            for (counter, device_type, device), value in sorted(snapshot["counters"].items()):
+                if counter == name:
+                    lines.append(f"{METRIC_PREFIX}{name}{{{labels(device_type, device)}}} {value}")
+        for direction, (frames_name, bytes_name) in TRAFFIC_METRICS.items():
+            for position, name in enumerate((frames_name, bytes_name)):
+                unit = "包数" if position == 0 else "字节数"
+                lines.append(f"# HELP {METRIC_PREFIX}{name} 按命令码统计的{'发送' if direction == 'sent' else '接收'}{unit}")
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} counter")
+                for (traffic_direction, device_type, device, command), values in sorted(snapshot["traffic"].items()):
+                    if traffic_direction == direction:
+                        lines.append(f"{METRIC_PREFIX}{name}{{{labels(device_type, device, command=command)}}} "
+                                     f"{values[position]}")
+        lines.append(f"# HELP {METRIC_PREFIX}{ACK_LATENCY} 服务器确认的等待时间，按确认类型区分")
+        lines.append(f"# TYPE {METRIC_PREFIX}{ACK_LATENCY} histogram")
+        buckets = snapshot["buckets"]
+        for (kind, device_type, device), histogram in sorted(snapshot["histograms"].items()):
+            cumulative = 0
+            for bound, count in zip(buckets + ("+Inf",), histogram):
+                cumulative += count
+                lines.append(f"{METRIC_PREFIX}{ACK_LATENCY}_bucket"
+                             f"{{{labels(device_type, device, ack=kind, le=bound)}}} {cumulative}")
+            lines.append(f"{METRIC_PREFIX}{ACK_LATENCY}_sum{{{labels(device_type, device, ack=kind)}}} "
+                         f"{histogram[-2]:.6f}")
+            lines.append(f"{METRIC_PREFIX}{ACK_LATENCY}_count{{{labels(device_type, device, ack=kind)}}} "
+                         f"{histogram[-1]}")
+        for name, help_text in GAUGE_HELP.items():
+            lines.append(f"# HELP {METRIC_PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} gauge")
+            for (gauge, device_type, device), value in sorted(snapshot["gauges"].items()):
+                if gauge == name:
+                    lines.append(f"{METRIC_PREFIX}{name}{{{labels(device_type, device)}}} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+telemetry = Telemetry.from_config(config.get("telemetry"))
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2025/3/26 10:00
+# @Author  : Heshouyi
+# @File    : tracing.py
+# @Software: PyCharm
+# @description: 轻量的调用链追踪，从接口调用经业务层、上传调度到套接字写入和服务器确认，
+#               按Chrome Trace Event格式输出，可直接导入chrome://tracing或Perfetto查看
+
+import contextvars
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from core.configer import config
+from core.file_path import log_path
+
+
+class NullSpan:
+    """未采样时使用的空跨度，所有操作都不做任何事，埋点处不需要判断是否采样"""
+
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **args):
+        pass
+
+    def span(self, name, category="", **args):
+        return self
+
+    def interval(self, name, start, end, **args):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """
+    一次采样调用中的一个跨度，用with包裹时成为当前跨度，期间同一上下文中创建的跨度都属于同一次调用
+    跨线程时由调用方传递跨度对象，在新线程中用tracer.activate恢复
+    """
+
+    __slots__ = ("tracer", "trace_id", "track", "name", "category", "args", "start", "token", "root")
+
+    def __init__(self, tracer, trace_id, track, name, category, args, root=False):
+        self.tracer = tracer
+        self.trace_id = trace_id    # 调用编号，同一次调用的所有跨度相同
+        self.track = track          # 输出时的轨道编号，同一次调用的跨度显示在同一行
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+        self.token = None
+        self.root = root
+
+    def __bool__(self):
+        return True
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.token = self.tracer.current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        self.tracer.current_span.reset(self.token)
+        if exc_type is not None:
+            self.args["error"] = f"{exc_type.__name__}: {exc_value}"
+        self.tracer.emit_complete(self, self.start, end)
+        return False
+
+    def set(self, **args):
+        """补充跨度的参数，如结果码、字节数"""
+        self.args.update(args)
+
+    def span(self, name, category="", **args):
+        """创建同一次调用中的子跨度，用于没有继承上下文的线程"""
+        return Span(self.tracer, self.trace_id, self.track, name, category or self.category, args)
+
+    def interval(self, name, start, end, **args):
+        """
+        记录一段已经结束的时间，如排队、等待确认，起止时间为time.perf_counter()
+        这类时间段可能与同一调用中的其他跨度交错，按异步事件输出，显示在单独的一行
+        """
+        if start is None or end is None:
+            return
+        self.tracer.emit_interval(self, name, start, end, args)
+
+
+class Tracer:
+    """
+    进程内的追踪器，接口调用按sample_rate采样，未采样的调用及其下游埋点只做一次上下文变量读取
+    结束的跨度放入最多max_events个事件的环形缓冲区，查询时按调用编号和根跨度耗时过滤，也可导出为文件
+    """
+
+    def __init__(self, enabled=False, sample_rate=0.01, max_events=200000, directory=None):
+        self.enabled = enabled
+        self.sample_rate = sample_rate      # 接口调用的采样比例，0-1
+        self.directory = directory or os.path.join(log_path, "trace")
+        self.events = deque(maxlen=max_events)
+        self.current_span = contextvars.ContextVar("current_span", default=NULL_SPAN)
+        self.name = "main"
+        self.pid = os.getpid()
+        self.sequence = itertools.count(1)
+        self.interval_ids = itertools.count(1)  # 异步事件编号，同一调用中相互交错的时间段各自成对
+        self.perf_origin = time.perf_counter()  # 单调时钟与墙上时间的对应关系，多个进程的事件按墙上时间对齐
+        self.wall_origin = time.time()
+
+    @classmethod
+    def from_config(cls, tracing_config):
+        """从配置文件的tracing节点创建"""
+        tracing_config = tracing_config or {}
+        return cls(
+            enabled=tracing_config.get("enabled", False),
+            sample_rate=tracing_config.get("sample_rate", 0.01),
+            max_events=tracing_config.get("max_events", 200000),
+            directory=tracing_config.get("directory") or None,
+        )
+
+    def set_name(self, name):
+        """工作进程启动时调用，输出的进程名按进程区分"""
+        self.name = name
+        self.pid = os.getpid()
+
+    def start_trace(self, name, category="api", force=False, **args):
+        """
+        开始一次调用的根跨度，按采样比例决定是否记录
+        :param force: 不按采样比例，只要开启追踪就记录，如请求头中带有X-Trace: 1
+        :return: Span，未采样时返回NULL_SPAN
+        """
+        if not self.enabled or (not force and random.random() >= self.sample_rate):
+            return NULL_SPAN
+        number = next(self.sequence)
+        return Span(self, f"{self.name}-{number}", number, name, category, args, root=True)
+
+    def span(self, name, category="", **args):
+        """在当前跨度下创建子跨度，当前调用未采样时返回NULL_SPAN"""
+        parent = self.current_span.get()
+        if not parent:
+            return NULL_SPAN
+        return parent.span(name, category, **args)
+
+    def current(self):
+        """当前上下文的跨度，提交给其他线程执行的任务需要保存它"""
+        return self.current_span.get()
+
+    @contextmanager
+    def activate(self, span):
+        """在其他线程中把保存的跨度设为当前跨度，期间的埋点归入该跨度所属的调用"""
+        token = self.current_span.set(span)
+        try:
+            yield span
+        finally:
+            self.current_span.reset(token)
+
+    def timestamp(self, perf_time):
+        """把time.perf_counter()换算为以微秒为单位的墙上时间"""
+        return round((perf_time - self.perf_origin + self.wall_origin) * 1000000, 1)
+
+    def emit_complete(self, span, start, end):
+        args = dict(span.args, traceId=span.trace_id, thread=threading.current_thread().name)
+        if span.root:
+            args["root"] = True
+        self.events.append({"name": span.name, "cat": span.category, "ph": "X", "ts": self.timestamp(start),
+                            "dur": round((end - start) * 1000000, 1), "pid": self.pid, "tid": span.track,
+                            "args": args})
+
+    def emit_interval(self, span, name, start, end, args):
+        base = {"name": name, "cat": span.category, "id": f"{span.trace_id}.{next(self.interval_ids)}",
+                "pid": self.pid, "tid": span.track}
+        self.events.append({**base, "ph": "b", "ts": self.timestamp(start), "args": dict(args, traceId=span.trace_id)})
+        self.events.append({**base, "ph": "e", "ts": self.timestamp(end), "args": {"traceId": span.trace_id}})
+
+    def configure(self, enabled=None, sample_rate=None, clear=False):
+        """运行时调整开关和采样比例，clear为True时清空已记录的事件"""
+        if enabled is not None:
+            self.enabled = enabled
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if clear:
+            self.events.clear()
+        return self.get_status()
+
+    def get_status(self):
+        return {"enabled": self.enabled, "sampleRate": self.sample_rate, "eventCount": len(self.events),
+                "maxEvents": self.events.maxlen}
+
+    def collect(self, trace_id=None, min_duration_ms=None, limit=None):
+        """
+        按调用编号或根跨度的最小耗时筛选事件，limit为最多返回的调用数，保留最近的调用
+        :return: Chrome Trace Event格式的事件列表，包含进程名和轨道名元数据
+        """
+        events = list(self.events)
+        if trace_id is not None or min_duration_ms is not None or limit is not None:
+            roots = [event for event in events if event["ph"] == "X" and event["args"].get("root")]
+            if trace_id is not None:
+                roots = [event for event in roots if event["args"]["traceId"] == trace_id]
+            if min_duration_ms is not None:
+                roots = [event for event in roots if event["dur"] >= min_duration_ms * 1000]
+            if limit is not None:
+                roots = roots[-limit:]
+            selected = {event["args"]["traceId"] for event in roots}
+            events = [event for event in events if event["args"]["traceId"] in selected]
+        # 每次调用一行，以根跨度的名称和编号命名，根跨度尚未结束的调用只显示编号
+        track_names = {event["tid"]: f"{event['name']} #{event['tid']}" for event in events
+                       if event["ph"] == "X" and event["args"].get("root")}
+        metadata = [{"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": self.name}}]
+        metadata.extend({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": track,
+                         "args": {"name": track_names.get(track, f"#{track}")}}
+                        for track in sorted({event["tid"] for event in events}))
+        return metadata + events
+
+    def export(self, events):
+        """把事件写入追踪目录下的JSON文件，返回文件路径"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"trace-{time.strftime('%Y%m%d-%H%M%S')}.json")
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(trace_document(events), file, ensure_ascii=False)
+        return path
+
+
+def trace_document(events):
+    """Chrome Trace Event的JSON对象格式"""
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+tracer = Tracer.from_config(config.get("tracing"))
@@ -6,12 +6,15 @@
 # @Software: PyCharm
 # @description:
 import asyncio
+import os
 import re
 import uuid
 from functools import wraps
 from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
 from .file_path import static_path
 from .logger import logger
+from .synthetic_picture import is_synthetic_name, get_synthetic_picture
 
 
 def is_valid_ip(ip):
@@ -21,7 +24,12 @@ def is_valid_ip(ip):
 
 
 def get_inner_picture(inner_pic_name):
-    """获取引擎内置图片，以字节形式返回"""
+    """
+    获取引擎内置图片，以字节形式返回
+    名称为 synthetic:<size>:<seed> 时按种子生成指定大小的合成JPEG，不读取static目录
+    """
+    if is_synthetic_name(inner_pic_name):
+        return get_synthetic_picture(inner_pic_name)
     inner_pic_path = f"{static_path}/{inner_pic_name}.jpg"
     try:
         with open(inner_pic_path, "rb") as f:
@@ -31,6 +39,37 @@ def get_inner_picture(inner_pic_name):
         return None
 
 
+def get_stream_length(stream):
+    """
+    获取二进制流的总长度，不读取流内容
+    通过seek到末尾取得长度后恢复原读取位置，要求流支持seek（上传文件的SpooledTemporaryFile、BytesIO均支持）
+    """
+    current_position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    length = stream.tell() - current_position
+    stream.seek(current_position)
+    return length
+
+
+def read_stream_chunk(stream, size):
+    """
+    从二进制流中读取指定长度的数据，流的单次read可能返回不足size的数据，此处循环读满，直到流结束
+    :param stream: 二进制流
+    :param size: 期望读取的字节数
+    :return: 读取到的字节数据，流结束时可能不足size
+    """
+    chunk = stream.read(size)
+    if len(chunk) == size or not chunk:
+        return chunk
+    buffer = bytearray(chunk)
+    while len(buffer) < size:
+        data = stream.read(size - len(buffer))
+        if not data:
+            break
+        buffer.extend(data)
+    return bytes(buffer)
+
+
 def generate_uuid():
     """生成UUID"""
     return str(uuid.uuid4())
@@ -39,7 +78,8 @@ def generate_uuid():
 def handle_exceptions(model_name: str):
     """
     urls层通用异常处理装饰器，兼容同步函数和异步函数两种执行方式
-    统一返回500报错
+    同步函数（转发指令、等待上传完成等会阻塞）放到线程池中执行，不占用接口的事件循环
+    统一返回500报错，路由中主动抛出的HTTPException（如参数不合法返回400）原样返回
     """
     def decorator(func):
         @wraps(func)
@@ -48,7 +88,9 @@ def handle_exceptions(model_name: str):
                 if hasattr(func, '__call__') and asyncio.iscoroutinefunction(func):
                     return await func(*args, **kwargs)  # 如果是异步函数，使用 await
                 else:
-                    return func(*args, **kwargs)  # 否则直接调用同步函数
+                    return await run_in_threadpool(func, *args, **kwargs)  # 否则在线程池中执行同步函数
+            except HTTPException:
+                raise
             except Exception as e:
                 logger.exception(f"{model_name}被调用时发生异常: {e}")
                 raise HTTPException(status_code=500, detail=f"{model_name}被调用时发生异常")
@@ -9,8 +9,16 @@ from apps.parking_camera.urls import parking_camera_router
 from apps.network_led.urls import network_led_router
 from apps.network_lcd.urls import network_lcd_router
 from apps.receive_report_server.urls import receive_report_router
+from apps.send_limit.urls import send_limit_router
+from apps.target_servers.urls import target_servers_router
+from apps.fleet.urls import fleet_router
+from apps.prometheus.urls import prometheus_router
+from apps.capture.urls import capture_router
+from apps.profiling.urls import profiling_router
+from apps.tracing.urls import tracing_router
+from apps.devices.urls import devices_router
 from core.events import register_startup_and_shutdown_events
-from core.middleware import RequestLoggingMiddleware
+from core.middleware import RequestLoggingMiddleware, TracingMiddleware
 from tortoise.contrib.fastapi import register_tortoise
 from core.settings import TORTOISE_ORM
 
@@ -22,6 +30,7 @@ register_startup_and_shutdown_events(app)
 
 # 注册中间件
 app.add_middleware(RequestLoggingMiddleware)    # 日志记录每个请求信息
+app.add_middleware(TracingMiddleware)   # 按采样比例追踪接口调用，最后注册的在最外层，根跨度包含请求日志的耗时
 
 # 注册tortoise，关联orm和框架
 register_tortoise(app, config=TORTOISE_ORM, generate_schemas=True)
@@ -34,6 +43,14 @@ app.include_router(parking_camera_router, prefix="/parking_camera", tags=["车
 app.include_router(network_led_router, prefix="/network_led", tags=["LED网络屏相关接口"])
 app.include_router(network_lcd_router, prefix="/network_lcd", tags=["LCD一体屏相关接口"])
 app.include_router(receive_report_router, prefix="/receive_report", tags=["接收上报相关接口"])
+app.include_router(send_limit_router, prefix="/send_limit", tags=["发送限速相关接口"])
+app.include_router(target_servers_router, prefix="/target_servers", tags=["目标服务器相关接口"])
+app.include_router(fleet_router, prefix="/fleet", tags=["批量设备相关接口"])
+app.include_router(prometheus_router, tags=["监控指标相关接口"])     # Prometheus约定的抓取路径为/metrics，不加前缀
+app.include_router(capture_router, prefix="/capture", tags=["抓包相关接口"])
+app.include_router(profiling_router, prefix="/profiling", tags=["剖析相关接口"])
+app.include_router(tracing_router, prefix="/tracing", tags=["追踪相关接口"])
+app.include_router(devices_router, prefix="/devices", tags=["设备时间序列相关接口"])
 
 if __name__ == "__main__":
     uvicorn.run(app="main:app", host="127.0.0.1", port=8000, reload=True)